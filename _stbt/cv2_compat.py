@@ -11,6 +11,9 @@ from distutils.version import LooseVersion
 
 import cv2
 
+from .config import get_config
+from .logging import ddebug
+
 version = LooseVersion(cv2.__version__).version
 
 if version >= [3, 2, 0]:
@@ -45,3 +48,38 @@ if version >= [3, 0, 0]:
 else:
     FILLED = cv2.cv.CV_FILLED  # pylint: disable=c-extension-no-member,no-member
     LINE_AA = cv2.CV_AA  # pylint: disable=c-extension-no-member
+
+
+_opencl = None
+
+
+def use_opencl():
+    """True if we should run image-processing on OpenCV's transparent API
+    (`cv2.UMat`), which uses an OpenCL device if there is one (this can be a
+    CPU-only OpenCL runtime like POCL). Enable it with ``[global] opencl =
+    true``. If OpenCV doesn't have OpenCL support, or there isn't an OpenCL
+    device, we fall back to plain numpy arrays.
+    """
+    global _opencl
+    if not get_config("global", "opencl", type_=bool):
+        return False
+    if _opencl is None:
+        _opencl = bool(version >= [3, 0, 0] and cv2.ocl.haveOpenCL())
+        if _opencl:
+            cv2.ocl.setUseOpenCL(True)
+        else:
+            ddebug("stbt: OpenCL isn't available, so [global] opencl has no "
+                   "effect")
+    return _opencl
+
+
+def to_umat(image):
+    if image is None:
+        return None
+    return cv2.UMat(image)
+
+
+def from_umat(image):
+    if isinstance(image, getattr(cv2, "UMat", ())):
+        return image.get()
+    return image
@@ -8,6 +8,7 @@ from __future__ import absolute_import
 import cv2
 import numpy
 
+from . import cv2_compat
 from .config import get_config
 from .imgutils import (crop, _frame_repr, pixel_bounding_box, _validate_region)
 from .logging import ddebug, ImageLogger
@@ -64,11 +65,18 @@ class MotionDiff(FrameDiffer):
 
         self.prev_frame_gray = self.gray(initial_frame)
 
-    def gray(self, frame):
-        return cv2.cvtColor(crop(frame, self.region), cv2.COLOR_BGR2GRAY)
+        # Buffers re-used by each call to `diff`, so that we don't allocate
+        # frame-sized images for each frame:
+        self._spare_gray = numpy.empty_like(self.prev_frame_gray)
+        self._absdiff = numpy.empty_like(self.prev_frame_gray)
+        self._eroded = numpy.empty_like(self.prev_frame_gray)
+
+    def gray(self, frame, dst=None):
+        return cv2.cvtColor(crop(frame, self.region), cv2.COLOR_BGR2GRAY,
+                            dst=dst)
 
     def diff(self, frame):
-        frame_gray = self.gray(frame)
+        frame_gray = self.gray(frame, dst=self._spare_gray)
 
         imglog = ImageLogger("MotionDiff", region=self.region,
                              min_size=self.min_size,
@@ -77,23 +85,37 @@ class MotionDiff(FrameDiffer):
         imglog.imwrite("gray", frame_gray)
         imglog.imwrite("previous_frame_gray", self.prev_frame_gray)
 
-        absdiff = cv2.absdiff(self.prev_frame_gray, frame_gray)
+        if cv2_compat.use_opencl():
+            # OpenCV runs the same functions on the OpenCL device when we give
+            # it `cv2.UMat`s. They allocate their own output on the device,
+            # instead of using our numpy buffers.
+            a = cv2_compat.to_umat(self.prev_frame_gray)
+            b = cv2_compat.to_umat(frame_gray)
+            mask = cv2_compat.to_umat(self.mask)
+            absdiff_dst = eroded_dst = None
+        else:
+            a, b, mask = self.prev_frame_gray, frame_gray, self.mask
+            absdiff_dst, eroded_dst = self._absdiff, self._eroded
+
+        absdiff = cv2.absdiff(a, b, dst=absdiff_dst)
         imglog.imwrite("absdiff", absdiff)
 
-        if self.mask is not None:
-            absdiff = cv2.bitwise_and(absdiff, self.mask)
+        if mask is not None:
+            absdiff = cv2.bitwise_and(absdiff, mask, dst=absdiff)
             imglog.imwrite("mask", self.mask)
             imglog.imwrite("absdiff_masked", absdiff)
 
         _, thresholded = cv2.threshold(
             absdiff, int((1 - self.noise_threshold) * 255), 255,
-            cv2.THRESH_BINARY)
+            cv2.THRESH_BINARY, dst=absdiff)
         imglog.imwrite("absdiff_threshold", thresholded)
         if self.kernel is not None:
             thresholded = cv2.morphologyEx(
                 thresholded, cv2.MORPH_OPEN,
-                cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+                cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)),
+                dst=eroded_dst)
             imglog.imwrite("absdiff_threshold_erode", thresholded)
+        thresholded = cv2_compat.from_umat(thresholded)
 
         out_region = pixel_bounding_box(thresholded)
         if out_region:
@@ -112,6 +134,7 @@ class MotionDiff(FrameDiffer):
             # the differences between frames 2 and 3 might be small but we'd see
             # the difference by looking between 1 and 3.
             self.prev_frame = frame
+            self._spare_gray = self.prev_frame_gray
             self.prev_frame_gray = frame_gray
 
         result = MotionResult(getattr(frame, "time", None), motion,
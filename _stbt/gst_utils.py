@@ -229,3 +229,40 @@ class PipelineRunner(object):
     def __del__(self):
         self.pipeline.set_state(Gst.State.NULL)
         self.pipeline.get_state(0)
+
+
+def frames_from_video(filename):
+    """Decodes a video file (any format that GStreamer's ``decodebin`` can
+    play) and yields each frame as a BGR `stbt.Frame`. Each frame's ``time``
+    is its timestamp within the video, in seconds.
+
+    The decoder runs ahead by at most a couple of frames, so this doesn't
+    use much memory even for long videos.
+    """
+    pipeline = Gst.parse_launch(
+        "filesrc name=src ! decodebin ! videoconvert ! "
+        "video/x-raw,format=BGR ! "
+        "appsink name=sink sync=false max-buffers=2 emit-signals=false")
+    pipeline.get_by_name("src").set_property("location", filename)
+    appsink = pipeline.get_by_name("sink")
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        while True:
+            # We don't block forever in "pull-sample" because if the pipeline
+            # fails (for example the file isn't a video) we wouldn't get EOS.
+            sample = appsink.emit("try-pull-sample", Gst.SECOND)
+            if sample is not None:
+                sample.time = float(sample.get_buffer().pts) / Gst.SECOND
+                yield array_from_sample(sample)
+                continue
+            message = bus.pop_filtered(Gst.MessageType.ERROR)
+            if message is not None:
+                err, dbg = message.parse_error()
+                raise RuntimeError("Error decoding %s: %s\n\n%s" %
+                                   (filename, err, dbg))
+            if appsink.get_property("eos"):
+                return
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+        pipeline.get_state(0)
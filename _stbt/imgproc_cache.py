@@ -237,11 +237,18 @@ class NotCachable(Exception):
 
 class _ArgsEncoder(json.JSONEncoder):
     def default(self, o):  # pylint:disable=method-hidden
-        from _stbt.match import MatchParameters
+        from _stbt.match import (MatchParameters, _FramePyramid,
+                                 _PreparedTemplate)
         if isinstance(o, ImageLogger):
             if o.enabled:
                 raise NotCachable()
             return None
+        elif isinstance(o, _FramePyramid):
+            # Derived from the frame, which is already part of the key.
+            return None
+        elif isinstance(o, _PreparedTemplate):
+            # Derived from the reference image.
+            return o.image
         elif isinstance(o, LooseVersion):
             return str(o)
         elif isinstance(o, set):
@@ -252,7 +259,9 @@ class _ArgsEncoder(json.JSONEncoder):
                 "match_threshold": o.match_threshold,
                 "confirm_method": o.confirm_method.value,
                 "confirm_threshold": o.confirm_threshold,
-                "erode_passes": o.erode_passes}
+                "erode_passes": o.erode_passes,
+                "match_engine": o.match_engine.value,
+                "first_pass_grayscale": o.first_pass_grayscale}
         elif isinstance(o, numpy.ndarray):
             h = Xxhash64()
             h.update(numpy.ascontiguousarray(o).data)
@@ -412,6 +421,30 @@ def test_that_cache_speeds_up_match_all():
                    ['match', 'region', 'first_pass_result', 'frame', 'image'])
 
 
+def test_that_match_cache_key_includes_pyramid_levels():
+    import stbt_core as stbt
+    from _stbt.config import _config_init
+    import cv2
+
+    frame = cv2.imread('tests/buttons.png')
+    config = _config_init()
+    pyramid_levels = config.get("match", "pyramid_levels")
+
+    with named_temporary_directory() as tmpdir, \
+            setup_cache(tmpdir), enable_caching():
+        try:
+            stbt.match('tests/button.png', frame=frame)
+            entries = _cache.stat()["entries"]
+            stbt.match('tests/button.png', frame=frame)
+            assert _cache.stat()["entries"] == entries
+
+            config.set("match", "pyramid_levels", "1")
+            stbt.match('tests/button.png', frame=frame)
+            assert _cache.stat()["entries"] > entries
+        finally:
+            config.set("match", "pyramid_levels", pyramid_levels)
+
+
 def test_that_cache_speeds_up_ocr():
     import stbt_core as stbt
     import cv2
@@ -403,9 +403,11 @@ def pixel_bounding_box(img):
     Region(x=1, y=1, right=5, bottom=6)
     """
     if len(img.shape) == 2:
-        pass
+        channel_axes = ()
     elif len(img.shape) == 3 and img.shape[2] == 3:
-        img = img.max(axis=2)
+        # Reduce over the channels at the same time as the rows/columns,
+        # rather than making a single-channel copy of the image first.
+        channel_axes = (2,)
     else:
         raise ValueError("Single-channel or 3-channel (BGR) image required. "
                          "Provided image has shape %r" % (img.shape,))
@@ -413,7 +415,7 @@ def pixel_bounding_box(img):
     out = [None, None, None, None]
 
     for axis in (0, 1):
-        flat = numpy.any(img, axis=axis)
+        flat = numpy.any(img, axis=(axis,) + channel_axes)
         indices = numpy.where(flat)[0]
         if len(indices) == 0:
             return None
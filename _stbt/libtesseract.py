@@ -0,0 +1,197 @@
+"""
+A ctypes wrapper around Tesseract's C API (libtesseract). This lets `stbt.ocr`
+run Tesseract inside the stbt process, instead of running the ``tesseract``
+command (which has to load its language data from disk) for every call.
+
+We use Tesseract's own result renderers (the same ones that the ``tesseract``
+command uses) so that the output is identical to the ``tesseract`` command's.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+import ctypes
+import ctypes.util
+
+import numpy
+
+from .utils import to_bytes, to_unicode
+
+_libtesseract = None
+
+
+def load():
+    """Loads libtesseract. Raises `OSError` if it isn't installed."""
+    global _libtesseract
+    if _libtesseract is not None:
+        return _libtesseract
+
+    filename = ctypes.util.find_library("tesseract")
+    if filename is None:
+        raise OSError("libtesseract isn't installed")
+    lib = ctypes.CDLL(filename)
+
+    _TessBaseAPI = ctypes.c_void_p
+    _TessResultRenderer = ctypes.c_void_p
+
+    # const char* TessVersion();
+    lib.TessVersion.argtypes = []
+    lib.TessVersion.restype = ctypes.c_char_p
+
+    # TessBaseAPI* TessBaseAPICreate();
+    lib.TessBaseAPICreate.argtypes = []
+    lib.TessBaseAPICreate.restype = _TessBaseAPI
+
+    # void TessBaseAPIDelete(TessBaseAPI* handle);
+    lib.TessBaseAPIDelete.argtypes = [_TessBaseAPI]
+    lib.TessBaseAPIDelete.restype = None
+
+    # int TessBaseAPIInit1(TessBaseAPI* handle, const char* datapath,
+    #                      const char* language, TessOcrEngineMode oem,
+    #                      char** configs, int configs_size);
+    lib.TessBaseAPIInit1.argtypes = [
+        _TessBaseAPI, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_char_p), ctypes.c_int]
+    lib.TessBaseAPIInit1.restype = ctypes.c_int
+
+    # void TessBaseAPISetPageSegMode(TessBaseAPI* handle,
+    #                                TessPageSegMode mode);
+    lib.TessBaseAPISetPageSegMode.argtypes = [_TessBaseAPI, ctypes.c_int]
+    lib.TessBaseAPISetPageSegMode.restype = None
+
+    # void TessBaseAPISetInputName(TessBaseAPI* handle, const char* name);
+    lib.TessBaseAPISetInputName.argtypes = [_TessBaseAPI, ctypes.c_char_p]
+    lib.TessBaseAPISetInputName.restype = None
+
+    # void TessBaseAPISetImage(TessBaseAPI* handle,
+    #                          const unsigned char* imagedata, int width,
+    #                          int height, int bytes_per_pixel,
+    #                          int bytes_per_line);
+    lib.TessBaseAPISetImage.argtypes = [
+        _TessBaseAPI, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int]
+    lib.TessBaseAPISetImage.restype = None
+
+    # int TessBaseAPIRecognize(TessBaseAPI* handle, ETEXT_DESC* monitor);
+    lib.TessBaseAPIRecognize.argtypes = [_TessBaseAPI, ctypes.c_void_p]
+    lib.TessBaseAPIRecognize.restype = ctypes.c_int
+
+    # void TessBaseAPIClearAdaptiveClassifier(TessBaseAPI* handle);
+    lib.TessBaseAPIClearAdaptiveClassifier.argtypes = [_TessBaseAPI]
+    lib.TessBaseAPIClearAdaptiveClassifier.restype = None
+
+    # void TessBaseAPIClear(TessBaseAPI* handle);
+    lib.TessBaseAPIClear.argtypes = [_TessBaseAPI]
+    lib.TessBaseAPIClear.restype = None
+
+    # TessResultRenderer* TessTextRendererCreate(const char* outputbase);
+    # TessResultRenderer* TessHOcrRendererCreate(const char* outputbase);
+    for f in [lib.TessTextRendererCreate, lib.TessHOcrRendererCreate]:
+        f.argtypes = [ctypes.c_char_p]
+        f.restype = _TessResultRenderer
+
+    # void TessDeleteResultRenderer(TessResultRenderer* renderer);
+    lib.TessDeleteResultRenderer.argtypes = [_TessResultRenderer]
+    lib.TessDeleteResultRenderer.restype = None
+
+    # BOOL TessResultRendererBeginDocument(TessResultRenderer* renderer,
+    #                                      const char* title);
+    lib.TessResultRendererBeginDocument.argtypes = [
+        _TessResultRenderer, ctypes.c_char_p]
+    lib.TessResultRendererBeginDocument.restype = ctypes.c_int
+
+    # BOOL TessResultRendererAddImage(TessResultRenderer* renderer,
+    #                                 TessBaseAPI* api);
+    lib.TessResultRendererAddImage.argtypes = [
+        _TessResultRenderer, _TessBaseAPI]
+    lib.TessResultRendererAddImage.restype = ctypes.c_int
+
+    # BOOL TessResultRendererEndDocument(TessResultRenderer* renderer);
+    lib.TessResultRendererEndDocument.argtypes = [_TessResultRenderer]
+    lib.TessResultRendererEndDocument.restype = ctypes.c_int
+
+    _libtesseract = lib
+    return lib
+
+
+def version():
+    return to_unicode(load().TessVersion())
+
+
+class TessBaseAPI(object):
+    """An initialised instance of Tesseract for a given language, engine &
+    configuration. This loads the language data once, so it's much faster
+    to re-use one instance for many images.
+
+    Not thread-safe: Don't call `recognize` from several threads at the same
+    time.
+
+    :param str datapath: The tessdata directory (the same as the
+        ``TESSDATA_PREFIX`` environment variable for the ``tesseract``
+        command) or None for the default.
+    :param str lang: Like the ``tesseract`` command's ``-l``.
+    :param int oem: Like the ``tesseract`` command's ``--oem``.
+    :param configs: The names of config files in ``<datapath>/configs``.
+    """
+    def __init__(self, datapath, lang, oem, configs=()):
+        self._handle = None
+        self._lib = load()
+        self._handle = self._lib.TessBaseAPICreate()
+        argv = (ctypes.c_char_p * len(configs))(
+            *[to_bytes(x) for x in configs])
+        if self._lib.TessBaseAPIInit1(
+                self._handle, None if datapath is None else to_bytes(datapath),
+                to_bytes(lang), oem, argv, len(configs)) != 0:
+            self.close()
+            raise RuntimeError(
+                "Failed to initialise Tesseract with lang=%r" % (lang,))
+
+    def close(self):
+        if self._handle is not None:
+            self._lib.TessBaseAPIDelete(self._handle)
+            self._handle = None
+
+    def __del__(self):
+        self.close()
+
+    def recognize(self, image, mode, outputbase, hocr=False):
+        """Runs OCR on ``image`` (a BGR or greyscale numpy array) with page
+        segmentation mode ``mode``, and writes the text (or hOCR if ``hocr``
+        is True) to ``outputbase + ".txt"`` (or ``".hocr"``), like the
+        ``tesseract`` command does.
+        """
+        lib = self._lib
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        elif image.ndim == 3:
+            assert image.shape[2] == 3
+            # Tesseract expects RGB:
+            image = image[:, :, ::-1]
+        image = numpy.ascontiguousarray(image)
+        h, w = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+
+        # Each instance of the `tesseract` command starts with an empty
+        # adaptive classifier, so we reset it for identical results.
+        lib.TessBaseAPIClearAdaptiveClassifier(self._handle)
+        lib.TessBaseAPISetPageSegMode(self._handle, int(mode))
+        lib.TessBaseAPISetImage(
+            self._handle, image.ctypes.data, w, h, bytes_per_pixel,
+            image.strides[0])
+        lib.TessBaseAPISetInputName(self._handle, b"input.png")
+
+        if hocr:
+            renderer = lib.TessHOcrRendererCreate(to_bytes(outputbase))
+        else:
+            renderer = lib.TessTextRendererCreate(to_bytes(outputbase))
+        try:
+            if (lib.TessBaseAPIRecognize(self._handle, None) < 0 or
+                    not lib.TessResultRendererBeginDocument(renderer, b"") or
+                    not lib.TessResultRendererAddImage(renderer,
+                                                       self._handle) or
+                    not lib.TessResultRendererEndDocument(renderer)):
+                raise RuntimeError("Tesseract failed")
+        finally:
+            lib.TessDeleteResultRenderer(renderer)
+            lib.TessBaseAPIClear(self._handle)
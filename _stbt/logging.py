@@ -148,6 +148,8 @@ class ImageLogger(object):
             raise ValueError("Image for name '%s' already logged" % name)
         if image is None:
             return
+        if isinstance(image, getattr(cv2, "UMat", ())):
+            image = image.get()  # See `cv2_compat.use_opencl`
         if image.dtype == numpy.float32:
             # Scale `cv2.matchTemplate` heatmap output in range
             # [0.0, 1.0] to visible grayscale range [0, 255].
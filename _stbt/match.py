@@ -15,7 +15,9 @@ from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-impor
 
 import enum
 import itertools
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import numpy
@@ -23,10 +25,11 @@ import numpy
 from . import cv2_compat
 from .config import ConfigurationError, get_config
 from .imgproc_cache import memoize_iterator
-from .imgutils import (crop, _frame_repr, _image_region, limit_time, load_image,
-                       _validate_region)
+from .imgutils import (crop, _frame_repr, Image, _image_region, limit_time,
+                       load_image, _validate_region)
 from .logging import (_Annotation, ddebug, debug, draw_on, get_debug_level,
                       ImageLogger)
+from .match_fft import match_template_fft
 from .types import Position, Region, UITestFailure
 from .utils import native_str, to_native_str
 
@@ -35,6 +38,11 @@ try:
 except ImportError:
     sqdiff = None
 
+try:
+    from .xxhash import Xxhash64
+except (ImportError, OSError):  # libxxhash.so hasn't been built
+    Xxhash64 = None
+
 
 class MatchMethod(enum.Enum):
     SQDIFF = "sqdiff"
@@ -57,6 +65,16 @@ class ConfirmMethod(enum.Enum):
         return native_str(self)
 
 
+class MatchEngine(enum.Enum):
+    AUTO = "auto"
+    SPATIAL = "spatial"
+    FFT = "fft"
+
+    # For nicer formatting in generated API documentation:
+    def __repr__(self):
+        return native_str(self)
+
+
 class MatchParameters(object):
     """Parameters to customise the image processing algorithm used by
     `match`, `wait_for_match`, and `press_until_match`.
@@ -139,11 +157,48 @@ class MatchParameters(object):
       to account for noise and slight rendering differences. Useful values are
       1 (the default) and 0 (to disable this step).
 
+    :type match_engine: `MatchEngine`
+    :param match_engine:
+      How the first pass calculates ``match_method``. For reference images
+      without transparency this affects the speed of the first pass, not its
+      result (other than floating-point rounding differences). The allowed
+      values are:
+
+      :MatchEngine.SPATIAL:
+        OpenCV's :ocv:pyfunc:`cv2.matchTemplate`, run separately on each
+        region of interest. This is the default.
+
+      :MatchEngine.FFT:
+        Cross-correlation in the frequency domain, calculated once for all
+        the regions of interest. This is faster for large reference images,
+        particularly ones with transparency. For reference images with
+        transparency it follows OpenCV 3.2's masked ``cv2.matchTemplate``,
+        which can give different results from the ``cv2.matchTemplate`` of
+        newer versions of OpenCV (and so from ``SPATIAL``).
+
+      :MatchEngine.AUTO:
+        Use ``FFT`` when the reference image is large compared to the area
+        being searched; otherwise ``SPATIAL``. Reference images with
+        transparency always use ``SPATIAL``, so this gives the same results
+        as ``SPATIAL``.
+
+    :param bool first_pass_grayscale:
+      If True, the first pass converts the video frame and the reference
+      image to grayscale before searching. This makes the first pass about 3
+      times faster for color frames, but it can't tell apart images that
+      differ only in color, so the certainty it reports (``first_pass_result``)
+      is different. The second pass (``confirm_method``) always compares
+      grayscale images anyway, so it isn't affected. This is useful for
+      coarse checks like "is the menu visible?". Defaults to False.
+
+    Added in v33: The ``match_engine`` and ``first_pass_grayscale``
+    parameters.
     """
 
     def __init__(self, match_method=None, match_threshold=None,
                  confirm_method=None, confirm_threshold=None,
-                 erode_passes=None):
+                 erode_passes=None, match_engine=None,
+                 first_pass_grayscale=None):
 
         if match_method is None:
             match_method = get_config(
@@ -159,22 +214,33 @@ class MatchParameters(object):
                 'match', 'confirm_threshold', type_=float)
         if erode_passes is None:
             erode_passes = get_config('match', 'erode_passes', type_=int)
+        if match_engine is None:
+            match_engine = get_config(
+                'match', 'match_engine', type_=MatchEngine)
+        if first_pass_grayscale is None:
+            first_pass_grayscale = get_config(
+                'match', 'first_pass_grayscale', type_=bool)
 
         match_method = MatchMethod(match_method)
         confirm_method = ConfirmMethod(confirm_method)
+        match_engine = MatchEngine(match_engine)
 
         self.match_method = match_method
         self.match_threshold = match_threshold
         self.confirm_method = confirm_method
         self.confirm_threshold = confirm_threshold
         self.erode_passes = erode_passes
+        self.match_engine = match_engine
+        self.first_pass_grayscale = bool(first_pass_grayscale)
 
     def __repr__(self):
         return (
             "MatchParameters(match_method=%r, match_threshold=%r, "
-            "confirm_method=%r, confirm_threshold=%r, erode_passes=%r)"
+            "confirm_method=%r, confirm_threshold=%r, erode_passes=%r, "
+            "match_engine=%r, first_pass_grayscale=%r)"
             % (self.match_method, self.match_threshold,
-               self.confirm_method, self.confirm_threshold, self.erode_passes))
+               self.confirm_method, self.confirm_threshold, self.erode_passes,
+               self.match_engine, self.first_pass_grayscale))
 
 
 class MatchResult(object):
@@ -268,19 +334,29 @@ def match(image, frame=None, match_parameters=None, region=Region.ALL):
     :param region:
       Only search within the specified region of the video frame.
 
+      If ``region`` is the same size as the reference image (or ``frame`` is)
+      and ``match_method`` is ``MatchMethod.SQDIFF`` (the default), there is
+      only one place that the reference image can be, so instead of
+      searching we compare the pixels directly. This is much faster, and it
+      gives the same result (``match`` and ``region``) as the search would.
+
     :returns:
       A `MatchResult`, which will evaluate to true if a match was found,
-      false otherwise.
+      false otherwise. If the image matches in several places, this is the
+      best match; use `match_all` to get all of them. (`wait_for_match` can
+      prefer a different match: See its documentation.)
 
     Added in v30: Support transparency in the reference image, and new match
     method ``MatchMethod.SQDIFF``.
     """
-    result = next(_match_all(image, frame, match_parameters, region))
-    if result.match:
-        debug("Match found: %s" % str(result))
-    else:
-        debug("No match found. Closest match: %s" % str(result))
-    return result
+    return _match(image, frame=frame, match_parameters=match_parameters,
+                  region=region)
+
+
+def _match(image, frame, match_parameters, region, frame_pyramids=None,
+           hint=None, early_exit=False):
+    return Matcher(image, match_parameters, region)._match(
+        frame, frame_pyramids, hint, early_exit)
 
 
 def match_all(image, frame=None, match_parameters=None, region=Region.ALL):
@@ -317,95 +393,376 @@ def match_all(image, frame=None, match_parameters=None, region=Region.ALL):
             break
 
 
-def _match_all(image, frame, match_parameters, region):
+def match_many(images, frame=None, match_parameters=None,
+               region=Region.ALL):
     """
-    Generator that yields a sequence of zero or more truthy MatchResults,
-    followed by a falsey MatchResult.
-    """
-    if match_parameters is None:
-        match_parameters = MatchParameters()
+    Search for several images in a single video frame.
+
+    This is equivalent to calling `match` once for each image, but it is
+    faster because the image-processing work that only depends on the frame
+    is done once, and shared between all the images. This is useful, for
+    example, in a FrameObject that checks for several different icons.
+
+    :param images: An iterable of the images to search for. Each image can be
+      a filename or a numpy array, as for the ``image`` parameter of `match`.
+
+    The other arguments are the same as `match`. All the images are searched
+    for with the same ``match_parameters`` and ``region``.
+
+    :returns:
+      A list of `MatchResult` objects, one for each image in ``images`` (in the
+      same order).
+
+    Example:
 
+    .. code-block:: python
+
+        play, pause = stbt.match_many(["play.png", "pause.png"])
+
+    Added in v33.
+    """
     if frame is None:
         from stbt_core import get_frame
         frame = get_frame()
 
-    # Normalise single channel images to shape (h, w, 1) rather than just (h, w)
-    frame = frame.view()
-    if len(frame.shape) == 2:
-        frame.shape = frame.shape + (1,)
-    if len(frame.shape) != 3:
-        raise ValueError(
-            "Invalid shape for frame: %r. Shape must have 2 or 3 elements" %
-            (frame.shape,))
-
-    t = load_image(image, color_channels={1: 1, 3: (3, 4)}[frame.shape[2]])
-
-    if any(frame.shape[x] < t.shape[x] for x in (0, 1)):
-        raise ValueError("Frame %r must be larger than reference image %r"
-                         % (frame.shape, t.shape))
-    if any(t.shape[x] < 1 for x in (0, 1)):
-        raise ValueError("Reference image %r must contain some data"
-                         % (t.shape,))
-    if (frame.shape[2], t.shape[2]) not in [(1, 1), (3, 3), (3, 4)]:
-        raise ValueError(
-            "Frame %r and reference image %r must have the same number of "
-            "channels" % (frame.shape, t.shape))
-
-    if t.shape[2] == 4:
-        if cv2_compat.version < [3, 0, 0]:
-            raise ValueError(
-                "Reference image %s has alpha channel, but transparency "
-                "support requires OpenCV 3.0 or greater (you have %s)."
-                % (t.relative_filename, cv2_compat.version))
+    # Load the images on this thread: `load_image` looks for relative
+    # filenames next to the caller's source file, which isn't on the stack of
+    # the worker threads.
+    matchers = [Matcher(image, match_parameters, region) for image in images]
+    frame_pyramids = {}
+    return _parallel_map(
+        lambda matcher: matcher._match(frame, frame_pyramids),  # pylint:disable=protected-access
+        matchers)
 
-        if match_parameters.match_method not in (MatchMethod.SQDIFF,
-                                                 MatchMethod.CCORR_NORMED):
-            # See `matchTemplateMask`:
-            # https://github.com/opencv/opencv/blob/3.2.0/modules/imgproc/src/templmatch.cpp#L840-L917
-            raise ValueError(
-                "Reference image %s has alpha channel, but transparency "
-                "support requires match_method SQDIFF or CCORR_NORMED "
-                "(you specified %s)."
-                % (t.relative_filename, match_parameters.match_method))
 
-    input_region = _validate_region(frame, region)
-    if input_region.height < t.shape[0] or input_region.width < t.shape[1]:
-        raise ValueError("%r must be larger than reference image %r"
-                         % (input_region, t.shape))
+def _match_all(image, frame, match_parameters, region, frame_pyramids=None,
+               hint=None, early_exit=False):
+    """
+    Generator that yields a sequence of zero or more truthy MatchResults,
+    followed by a falsey MatchResult.
+
+    See `Matcher._match_all` for the parameters.
+    """
+    return Matcher(image, match_parameters, region)._match_all(
+        frame, frame_pyramids, hint, early_exit)
 
-    imglog = ImageLogger(
-        "match", match_parameters=match_parameters,
-        template_name=t.filename or "<Image>",
-        input_region=input_region)
 
-    # pylint:disable=undefined-loop-variable
-    try:
-        for (matched, match_region, first_pass_matched,
-             first_pass_certainty) in _find_matches(
-                crop(frame, input_region), t, match_parameters, imglog):
-
-            match_region = Region.from_extents(*match_region) \
-                                 .translate(input_region)
-            result = MatchResult(
-                getattr(frame, "time", None), matched, match_region,
-                first_pass_certainty, frame, t, first_pass_matched)
-            imglog.append(matches=result)
-            draw_on(frame, result, label="match(%s)" % (
-                "<Image>" if t.relative_filename is None else
-                repr(to_native_str(t.relative_filename))))
-            yield result
+class Matcher(object):
+    """A reference image, prepared for searching in many video frames.
+
+    `match` has to load the reference image, check that it is compatible with
+    ``match_parameters``, read the ``[match]`` configuration, etc. every time
+    you call it. ``Matcher`` does this work once, so it is faster to call
+    `Matcher.match` in a loop (or in a FrameObject property) than `match`.
+
+    The arguments are the same as for `match`. The image is loaded (and
+    relative filenames are resolved) when you create the ``Matcher``, so
+    changes to the image file after that aren't noticed. The configuration
+    (such as ``[match] pyramid_levels``) is also read when you create the
+    ``Matcher``.
+
+    Example:
+
+    .. code-block:: python
+
+        PLAY_BUTTON = stbt.Matcher("play.png", region=stbt.Region(
+            x=20, y=600, right=100, bottom=680))
 
-    finally:
+        class Player(stbt.FrameObject):
+            @property
+            def is_visible(self):
+                return bool(PLAY_BUTTON.match(self._frame))
+
+    :ivar stbt.Image image: The reference image, as given to `load_image`.
+    :ivar MatchParameters match_parameters:
+    :ivar Region region:
+
+    Added in v33.
+    """
+    def __init__(self, image, match_parameters=None, region=Region.ALL):
+        if match_parameters is None:
+            match_parameters = MatchParameters()
+
+        self.image = load_image(image, color_channels=(1, 3, 4))
+        # If we were given a filename (not an image that the caller may have
+        # cropped or modified), see `_template`:
+        self._from_file = not isinstance(image, numpy.ndarray)
+        self.match_parameters = match_parameters
+        self.region = region
+
+        self._pyramid_levels = _get_pyramid_levels_config()
+
+        # Keyed by the number of channels in the frame:
+        self._templates = {}
+        # Keyed by the frame's (height, width):
+        self._input_regions = {}
+
+    def __repr__(self):
+        return "Matcher(%s, match_parameters=%r, region=%r)" % (
+            "<Image>" if self.image.relative_filename is None else
+            repr(to_native_str(self.image.relative_filename)),
+            self.match_parameters, self.region)
+
+    def match(self, frame=None):
+        """Search for the reference image in a single video frame.
+
+        Equivalent to ``stbt.match(image, frame, match_parameters, region)``;
+        see `match`.
+
+        :returns: A `MatchResult`.
+        """
+        return self._match(frame)
+
+    def match_all(self, frame=None):
+        """Search for all instances of the reference image in a single video
+        frame.
+
+        Equivalent to ``stbt.match_all(image, frame, match_parameters,
+        region)``; see `match_all`.
+
+        :returns: An iterator of zero or more `MatchResult` objects.
+        """
+        any_matches = False
+        for result in self._match_all(frame):
+            if result.match:
+                debug("Match found: %s" % str(result))
+                any_matches = True
+                yield result
+            else:
+                if not any_matches:
+                    debug("No match found. Closest match: %s" % str(result))
+                break
+
+    def _match(self, frame, frame_pyramids=None, hint=None,
+               early_exit=False):
+        result = next(self._match_all(frame, frame_pyramids, hint,
+                                      early_exit))
+        if result.match:
+            debug("Match found: %s" % str(result))
+        elif early_exit:
+            # The first pass may have given up early, in which case it didn't
+            # calculate the certainty exactly (see `_find_matches`).
+            debug("No match found. Closest match (first_pass_result is an "
+                  "upper bound): %s" % str(result))
+        else:
+            debug("No match found. Closest match: %s" % str(result))
+        return result
+
+    def _template(self, channels):
+        """The reference image in the right format for frames with
+        ``channels`` channels; the `_PreparedTemplate` to search for in the
+        (possibly grayscale, see `MatchParameters.first_pass_grayscale`)
+        frame; and the label for `draw_on`.
+        """
         try:
-            _log_match_image_debug(imglog)
-        except Exception:  # pylint:disable=broad-except
+            return self._templates[channels]
+        except KeyError:
             pass
 
+        if channels == 1 and self._from_file:
+            # Use OpenCV's grayscale decoder, like `load_image` would if we
+            # hadn't loaded the image already. (Its results are slightly
+            # different from converting the color image with `cvtColor`.)
+            t = load_image(self.image.absolute_filename, color_channels=1)
+            t = Image(t, filename=self.image.filename)
+        else:
+            t = load_image(self.image,
+                           color_channels={1: 1, 3: (3, 4)}[channels])
+
+        if any(t.shape[x] < 1 for x in (0, 1)):
+            raise ValueError("Reference image %r must contain some data"
+                             % (t.shape,))
+
+        if t.shape[2] == 4:
+            if cv2_compat.version < [3, 0, 0]:
+                raise ValueError(
+                    "Reference image %s has alpha channel, but transparency "
+                    "support requires OpenCV 3.0 or greater (you have %s)."
+                    % (t.relative_filename, cv2_compat.version))
+
+            if self.match_parameters.match_method not in (
+                    MatchMethod.SQDIFF, MatchMethod.CCORR_NORMED):
+                # See `matchTemplateMask`:
+                # https://github.com/opencv/opencv/blob/3.2.0/modules/imgproc/src/templmatch.cpp#L840-L917
+                raise ValueError(
+                    "Reference image %s has alpha channel, but transparency "
+                    "support requires match_method SQDIFF or CCORR_NORMED "
+                    "(you specified %s)."
+                    % (t.relative_filename, self.match_parameters.match_method))
+
+        if self.match_parameters.first_pass_grayscale and channels == 3:
+            # Like `load_image(t, color_channels=1)` but keeping the alpha
+            # channel, if any.
+            gray = cv2.cvtColor(t, cv2.COLOR_BGR2GRAY if t.shape[2] == 3
+                                else cv2.COLOR_BGRA2GRAY)
+            prepared = _prepare_template(numpy.dstack(
+                [gray] + ([t[:, :, 3]] if t.shape[2] == 4 else [])))
+        else:
+            prepared = _prepare_template(t)
+
+        # `setdefault` is atomic, in case several threads are using this
+        # `Matcher`.
+        return self._templates.setdefault(
+            channels, (t, prepared, _match_label(t)))
+
+    def _input_region(self, frame, t):
+        key = frame.shape[:2]
+        try:
+            return self._input_regions[key]
+        except KeyError:
+            pass
+        if any(frame.shape[x] < t.shape[x] for x in (0, 1)):
+            raise ValueError("Frame %r must be larger than reference image %r"
+                             % (frame.shape, t.shape))
+        input_region = _validate_region(frame, self.region)
+        if input_region.height < t.shape[0] or input_region.width < t.shape[1]:
+            raise ValueError("%r must be larger than reference image %r"
+                             % (input_region, t.shape))
+        return self._input_regions.setdefault(key, input_region)
+
+    def _match_all(self, frame, frame_pyramids=None, hint=None,
+                   early_exit=False):
+        """
+        Generator that yields a sequence of zero or more truthy MatchResults,
+        followed by a falsey MatchResult.
+
+        :param dict frame_pyramids: If given, the `_FramePyramid` for each
+            ``region`` of ``frame`` (and whether it was converted to
+            grayscale) is stored here, so that it can be re-used by
+            subsequent calls for the same frame (see `match_many`).
+        :param Region hint: Where we expect to find the image (in frame
+            coordinates). See `_find_matches`.
+        :param bool early_exit: See `_find_matches`.
+        """
+        if frame is None:
+            from stbt_core import get_frame
+            frame = get_frame()
+
+        # Normalise single channel images to shape (h, w, 1) rather than just
+        # (h, w)
+        frame = frame.view()
+        if len(frame.shape) == 2:
+            frame.shape = frame.shape + (1,)
+        if len(frame.shape) != 3:
+            raise ValueError(
+                "Invalid shape for frame: %r. Shape must have 2 or 3 elements"
+                % (frame.shape,))
+        if frame.shape[2] not in (1, 3):
+            raise ValueError(
+                "Frame %r and reference image %r must have the same number of "
+                "channels" % (frame.shape, self.image.shape))
+
+        t, prepared, label = self._template(frame.shape[2])
+        input_region = self._input_region(frame, t)
+
+        imglog = ImageLogger(
+            "match", match_parameters=self.match_parameters,
+            template_name=t.filename or "<Image>",
+            input_region=input_region)
+
+        grayscale = (self.match_parameters.first_pass_grayscale and
+                     frame.shape[2] == 3)
+        frame_pyramid = (None if frame_pyramids is None else
+                         frame_pyramids.get((input_region, grayscale)))
+        if frame_pyramid is None:
+            image = crop(frame, input_region)
+            if grayscale:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                image = image.reshape(image.shape + (1,))
+            frame_pyramid = _FramePyramid(image)
+            if frame_pyramids is not None:
+                # `setdefault` is atomic, in case `match_many` is running on
+                # several threads.
+                frame_pyramid = frame_pyramids.setdefault(
+                    (input_region, grayscale), frame_pyramid)
+        image = frame_pyramid.image
+
+        if hint is not None:
+            hint = hint.translate(-input_region.x, -input_region.y)
+
+        # pylint:disable=undefined-loop-variable
+        try:
+            for (matched, match_region, first_pass_matched,
+                 first_pass_certainty) in _find_matches(
+                    image, prepared, self.match_parameters,
+                    self._pyramid_levels, imglog, frame_pyramid, hint,
+                    early_exit):
+
+                match_region = Region.from_extents(*match_region) \
+                                     .translate(input_region)
+                result = MatchResult(
+                    getattr(frame, "time", None), matched, match_region,
+                    first_pass_certainty, frame, t, first_pass_matched)
+                imglog.append(matches=result)
+                draw_on(frame, result, label=label)
+                yield result
+
+        finally:
+            try:
+                _log_match_image_debug(imglog)
+            except Exception:  # pylint:disable=broad-except
+                pass
+
+
+def _get_pyramid_levels_config():
+    """The ``[match] pyramid_levels`` configuration: An int, or None for
+    "auto" (see `_PreparedTemplate.auto_pyramid_levels`).
+    """
+    if get_config("match", "pyramid_levels").strip().lower() == "auto":
+        return None
+    pyramid_levels = get_config("match", "pyramid_levels", type_=int)
+    if pyramid_levels <= 0:
+        raise ConfigurationError(
+            "'match.pyramid_levels' must be 'auto' or > 0")
+    return pyramid_levels
+
+
+def _resolve_pyramid_levels(pyramid_levels, template, imglog=None):
+    if pyramid_levels is None:
+        pyramid_levels = template.auto_pyramid_levels()
+        ddebug("stbt-match: Using %d pyramid levels for template %s"
+               % (pyramid_levels, template.shape))
+        if imglog is not None:
+            imglog.set(auto_pyramid_levels=pyramid_levels)
+    return pyramid_levels
+
+
+# See `wait_for_match` and `_find_matches`.
+_HINT_MARGIN_PX = 32
+
+
+def _match_label(image):
+    return "match(%s)" % (
+        "<Image>" if image.relative_filename is None else
+        repr(to_native_str(image.relative_filename)))
+
+
+def _is_region_unchanged(previous_pixels, frame, region):
+    """Returns True if the pixels of ``frame`` within ``region`` are identical
+    to ``previous_pixels``.
+
+    This is much cheaper than running our image-matching algorithm: It
+    doesn't allocate any memory, and it stops at the first difference.
+    """
+    pixels = crop(frame, _validate_region(frame, region))
+    if (previous_pixels.shape != pixels.shape or
+            previous_pixels.dtype != pixels.dtype):
+        return False
+    return cv2.norm(previous_pixels, pixels, cv2.NORM_INF) == 0
+
 
 def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
                    match_parameters=None, region=Region.ALL, frames=None):
     """Search for an image in the device-under-test's video stream.
 
+    If the image matches in several places, this doesn't always return the
+    same match as `match` would: After a frame where the image matched, it
+    first searches near the previous match, and if the image still matches
+    there it returns that match, even if there is a better match elsewhere in
+    the frame. This follows a moving selection (and it's faster) but it means
+    that if you need the best match in the frame, you should call `match` on
+    the returned frame.
+
     :param image: The image to search for. See `match`.
 
     :type timeout_secs: int or float or None
@@ -429,27 +786,48 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     :returns: `MatchResult` when the image is found.
     :raises: `MatchTimeout` if no match is found after ``timeout_secs`` seconds.
     """
-    if match_parameters is None:
-        match_parameters = MatchParameters()
-
     if frames is None:
         import stbt_core
         frames = stbt_core.frames(timeout_secs=timeout_secs)
     else:
         frames = limit_time(frames, timeout_secs)
 
+    matcher = Matcher(image, match_parameters, region)
+    image = matcher.image
+
     match_count = 0
     last_pos = Position(0, 0)
-    image = load_image(image)
+    res = None
+    hint = None
+    previous_pixels = None
     debug("Searching for " + (image.relative_filename or "<Image>"))
     for frame in frames:
-        res = match(image, match_parameters=match_parameters,
-                    region=region, frame=frame)
+        if (previous_pixels is not None and
+                _is_region_unchanged(previous_pixels, frame, region)):
+            # The screen is static, so the result would be the same as for
+            # the previous frame.
+            res = MatchResult(
+                getattr(frame, "time", None), res.match, res.region,
+                res.first_pass_result, frame, res.image,
+                res._first_pass_matched)  # pylint:disable=protected-access
+            ddebug("Frame unchanged; re-using previous result: %s" % res)
+            draw_on(frame, res, label=_match_label(image))
+        else:
+            # We only report the certainty of the final result, so we don't
+            # need to calculate it exactly for frames that don't match:
+            res = matcher._match(frame, hint=hint, early_exit=True)  # pylint:disable=protected-access
+            # Take a copy: The `frames` iterator might re-use the same buffer
+            # for the next frame.
+            previous_pixels = crop(
+                frame, _validate_region(frame, region)).copy()
         if res.match and (match_count == 0 or res.position == last_pos):
             match_count += 1
         else:
             match_count = 0
         last_pos = res.position
+        # A moving selection usually only moves slightly between frames, so
+        # look near the previous match first:
+        hint = res.region.dilate(_HINT_MARGIN_PX) if res.match else None
         if match_count == consecutive_matches:
             debug("Matched " + (image.relative_filename or "<Image>"))
             return res
@@ -480,7 +858,8 @@ class MatchTimeout(UITestFailure):
 
 
 @memoize_iterator({"version": "31"})
-def _find_matches(image, template, match_parameters, imglog):
+def _find_matches(image, template, match_parameters, pyramid_levels, imglog,
+                  frame_pyramid=None, hint=None, early_exit=False):
     """Our image-matching algorithm.
 
     Runs 2 passes: `_find_candidate_matches` to locate potential matches, then
@@ -490,29 +869,353 @@ def _find_matches(image, template, match_parameters, imglog):
     tuples for each location where `template` is found within `image`, followed
     by a single `(False, position, certainty)` tuple when there are no further
     matching locations.
+
+    :param template: The reference image, or its `_PreparedTemplate`.
+    :param int pyramid_levels: The ``[match] pyramid_levels`` configuration
+        (None means "auto").
+        This is a parameter (rather than reading the configuration here) so
+        that it is part of the key when the results are cached by
+        `memoize_iterator`.
+    :param _FramePyramid frame_pyramid: The pyramid of ``image``, if it has
+        already been calculated.
+    :param Region hint: Where we expect to find ``template`` in ``image``. If
+        given, we first search at full resolution within this region only; if
+        that finds a match, we yield that single match without searching the
+        rest of the image. Otherwise we fall back to the normal search. This
+        is only suitable when you only want the first match, not `match_all`.
+    :param bool early_exit: If True, the first pass may give up as soon as it
+        knows that ``template`` doesn't match, in which case the certainty it
+        reports is only an upper bound (below ``match_threshold``). This is
+        only suitable when you don't need to report the certainty of a
+        failed match.
     """
 
-    if template.shape[2] == 4:
-        # Normalise transparency channel to either 0 or 255
-        mask = template[:, :, 3]
-        mask[mask < 255] = 0
+    template = _prepare_template(template)
+    if frame_pyramid is None:
+        frame_pyramid = _FramePyramid(image)
+
+    if (hint is not None and not imglog.enabled and
+            template.shape[:2] != image.shape[:2]):
+        region, certainty = _find_candidate_match_near(
+            image, template, match_parameters, pyramid_levels, hint)
+        if region is not None and _confirm_matches(
+                image, [region], template, match_parameters)[0]:
+            ddebug("Level 0: Matched near %s at %s" % (hint, region))
+            yield (True, list(region), True, certainty)
+            return
 
-    # pylint:disable=undefined-loop-variable
-    for i, first_pass_matched, region, first_pass_certainty in \
-            _find_candidate_matches(image, template, match_parameters, imglog):
-        confirmed = (
-            first_pass_matched and
-            _confirm_match(image, region, template, match_parameters,
-                           imwrite=lambda name, img: imglog.imwrite(
-                               "match%d-%s" % (i, name), img)))  # pylint:disable=cell-var-from-loop
-
-        yield (confirmed, list(region), first_pass_matched,
-               first_pass_certainty)
-        if not confirmed:
-            break
+    candidates = _find_candidate_matches(
+        frame_pyramid, template, match_parameters, pyramid_levels, imglog,
+        early_exit)
+
+    if imglog.enabled:
+        # pylint:disable=undefined-loop-variable
+        for i, first_pass_matched, region, first_pass_certainty in candidates:
+            confirmed = (
+                first_pass_matched and
+                _confirm_match(image, region, template, match_parameters,
+                               imwrite=lambda name, img: imglog.imwrite(
+                                   "match%d-%s" % (i, name), img)))  # pylint:disable=cell-var-from-loop
+
+            yield (confirmed, list(region), first_pass_matched,
+                   first_pass_certainty)
+            if not confirmed:
+                break
+        return
 
+    # Confirm the first candidate on its own, because `match` only needs the
+    # first result. If we're asked for more (`match_all`) we confirm the
+    # remaining candidates in batches of increasing size, so that we don't
+    # search for many more candidates than the caller asks for. With a
+    # threshold of 0 the first pass matches everywhere, so it never runs out
+    # of candidates (see `_find_candidate_matches`); then we confirm each
+    # candidate on its own.
+    batch_size = 1
+    while True:
+        batch = list(itertools.islice(candidates, batch_size))
+        if not batch:
+            return
+        confirmed = iter(_confirm_matches(
+            image, [region for _, first_pass_matched, region, _ in batch
+                    if first_pass_matched],
+            template, match_parameters))
+        for _, first_pass_matched, region, first_pass_certainty in batch:
+            matched = first_pass_matched and next(confirmed)
+            yield (matched, list(region), first_pass_matched,
+                   first_pass_certainty)
+            if not matched:
+                return
+        if match_parameters.match_threshold > 0:
+            batch_size = min(batch_size * 2, _MAX_CONFIRM_BATCH_SIZE)
+
+
+# See `_find_matches`.
+_MAX_CONFIRM_BATCH_SIZE = 64
+
+
+# Maximum number of reference images kept by `_prepare_template`.
+_TEMPLATE_CACHE_SIZE = 32
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
+def _prepare_template(template):
+    """Returns a `_PreparedTemplate` for ``template`` (which can be a
+    `_PreparedTemplate` already, from `Matcher`).
+
+    Test scripts typically search for the same reference image in many
+    consecutive frames (for example in `wait_for_match`), so we keep the
+    `_PreparedTemplate` of the most recently used reference images in an LRU
+    cache. The cache key is a hash of the image's pixels, so crops of an image,
+    or changes to it in memory or on disk, get their own cache entry.
+    """
+    if isinstance(template, _PreparedTemplate):
+        return template
+    if Xxhash64 is None:
+        return _PreparedTemplate(template)
+    h = Xxhash64()
+    h.update(numpy.ascontiguousarray(template).data)
+    key = (h.digest(), template.shape, template.dtype.str)
+
+    with _template_cache_lock:
+        prepared = _template_cache.pop(key, None)
+        if prepared is None:
+            # A copy, in case the caller modifies their image later.
+            prepared = _PreparedTemplate(numpy.array(template))
+            while len(_template_cache) >= _TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+        _template_cache[key] = prepared
+    return prepared
+
+
+# See `_PreparedTemplate.auto_pyramid_levels`.
+_AUTO_PYRAMID_MAX_LEVELS = 5
+_AUTO_PYRAMID_MIN_SIZE = 16
+_AUTO_PYRAMID_MIN_DETAIL = 0.5
+
+
+def _gradient_energy(gray, mask=None):
+    gray = gray.astype(numpy.float32)
+    energy = (cv2.Sobel(gray, cv2.CV_32F, 1, 0) ** 2 +
+              cv2.Sobel(gray, cv2.CV_32F, 0, 1) ** 2)
+    if mask is not None:
+        energy = energy[mask.reshape(mask.shape[:2]) == 255]
+    return float(energy.sum())
+
+
+class _PreparedTemplate(object):
+    """The parts of our image-matching algorithm that only depend on the
+    reference image, not on the frame: The alpha mask, the template & mask
+    pyramids used by `_find_candidate_matches`, and the grayscale / normalised
+    template used by `_confirm_match`. These are calculated lazily the first
+    time they are needed.
+
+    :ivar image: The reference image as given (including its alpha channel, if
+        any). This is BGR, BGRA, grayscale, or grayscale + alpha (for
+        `MatchParameters.first_pass_grayscale`).
+    :ivar template: The reference image without its alpha channel.
+    :ivar mask: The alpha channel, normalised to either 0 or 255; or None if
+        the reference image doesn't have an alpha channel.
+    """
+    def __init__(self, image):
+        self.image = image
+        if image.shape[2] in (2, 4):
+            # Normalise transparency channel to either 0 or 255
+            mask = image[:, :, -1].copy()
+            mask[mask < 255] = 0
+            self.mask = mask
+            self.template = image[:, :, :-1]
+        else:
+            self.mask = None
+            self.template = image
+        self.shape = self.template.shape
+        self._pyramids = {}
+        self._confirm_templates = {}
+        self._confirm_tiles = {}
+        self._auto_pyramid_levels = None
+
+    def auto_pyramid_levels(self):
+        """The number of pyramid levels to use with ``[match] pyramid_levels
+        = auto``.
+
+        Each pyramid level halves the width & height of the frame and of the
+        template, so the first pass is much faster with more levels -- but
+        only if the template is still recognisable at the smallest level.
+        Otherwise we get lots of false candidates at the smallest level
+        (which are slow to check at the larger levels) or we miss the match.
+        So we keep adding levels (up to `_AUTO_PYRAMID_MAX_LEVELS`) until the
+        template would be smaller than `_AUTO_PYRAMID_MIN_SIZE` pixels, or
+        until it loses its detail.
+
+        We measure detail as the gradient energy: The sum of the squared
+        Sobel gradient over the (opaque pixels of the) template. Downsampling
+        halves the energy of a sharp edge (the edge is half as long, but just
+        as sharp) so we compare each level against that; fine texture, such
+        as small text, loses much more. A flat template doesn't have any
+        detail to lose, so it gets as many levels as its size allows.
+        """
+        if self._auto_pyramid_levels is not None:
+            return self._auto_pyramid_levels
+
+        gray = self.confirm_template(ConfirmMethod.ABSDIFF)[0][1]
+        gray = gray.reshape(gray.shape[:2])
+        mask = self.mask
+        energy0 = _gradient_energy(gray, mask)
+        levels = 1
+        while levels < _AUTO_PYRAMID_MAX_LEVELS:
+            gray = cv2.pyrDown(gray, borderType=cv2.BORDER_REPLICATE)
+            if min(gray.shape[:2]) < _AUTO_PYRAMID_MIN_SIZE:
+                break
+            if mask is not None:
+                mask = cv2.pyrDown(mask, borderType=cv2.BORDER_REPLICATE)
+                cv2.threshold(mask, 254, 255, cv2.THRESH_BINARY, mask)
+            if energy0 > 0 and (_gradient_energy(gray, mask) * 2 ** levels <
+                                _AUTO_PYRAMID_MIN_DETAIL * energy0):
+                break
+            levels += 1
+
+        self._auto_pyramid_levels = levels
+        return levels
+
+    def pyramids(self, levels):
+        """Returns ``(template_pyramid, mask_pyramid)``; see `_build_pyramid`.
+        """
+        try:
+            return self._pyramids[levels]
+        except KeyError:
+            pass
+        if self.mask is not None and self.template.shape[2] == 3:
+            # OpenCV wants mask to match template's number of channels
+            mask = cv2.cvtColor(self.mask, cv2.COLOR_GRAY2BGR)
+        else:
+            mask = self.mask
+        mask_pyramid = _build_pyramid(mask, levels, is_mask=True)
+        template_pyramid = _build_pyramid(self.template, len(mask_pyramid),
+                                          is_template=True)
+        self._pyramids[levels] = (template_pyramid, mask_pyramid)
+        return self._pyramids[levels]
+
+    def confirm_template(self, confirm_method):
+        """The template's side of `_confirm_match`.
+
+        Returns a list of ``(name, image)`` for each processing step, for
+        debug logging. The last image in the list is the one to compare
+        against the frame.
+        """
+        try:
+            return self._confirm_templates[confirm_method]
+        except KeyError:
+            pass
+        if self.template.shape[2] == 3:
+            gray = cv2.cvtColor(self.template, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = self.template.copy()
+        steps = [("confirm-template_gray", gray)]
+        if confirm_method == ConfirmMethod.NORMED_ABSDIFF:
+            normalized = gray.copy()
+            cv2.normalize(normalized, normalized, 0, 255, cv2.NORM_MINMAX,
+                          mask=self.mask)
+            steps.append(("confirm-template_gray_normalized", normalized))
+        if self.mask is not None:
+            steps.append(("confirm-template_masked",
+                          cv2.bitwise_and(steps[-1][1], self.mask)))
+        self._confirm_templates[confirm_method] = steps
+        return steps
+
+    def confirm_tiles(self, confirm_method, n):
+        """The template's side of `_confirm_matches`: ``(template, mask)``
+        from `confirm_template`, each repeated ``n`` times vertically.
+        """
+        h = self.shape[0]
+        if n == 1:
+            # The common case (`match`). Don't copy: the template might be as
+            # large as the frame.
+            template = self.confirm_template(confirm_method)[-1][1]
+            return template.reshape(template.shape[:2]), self.mask
+        tiles = self._confirm_tiles.get(confirm_method)
+        if tiles is None or tiles[0].shape[0] < n * h:
+            template = self.confirm_template(confirm_method)[-1][1]
+            template = template.reshape(template.shape[:2])
+            count = max(n, 8)
+            tiles = (numpy.tile(template, (count, 1)),
+                     None if self.mask is None else
+                     numpy.tile(self.mask, (count, 1)))
+            self._confirm_tiles[confirm_method] = tiles
+        template, mask = tiles
+        return template[:n * h], None if mask is None else mask[:n * h]
+
+
+class _FramePyramid(object):
+    """The image pyramid of the frame (see `_build_pyramid`), calculated
+    lazily the first time it is needed.
+
+    Unlike `_PreparedTemplate` this is only valid for a single frame (and
+    region), but it can be shared between all the reference images searched
+    for in that frame (see `match_many`).
+    """
+    def __init__(self, image):
+        self.image = image
+        self._levels = 0
+        self._pyramid = None
+        self._lock = threading.Lock()
 
-def _find_candidate_matches(image, template, match_parameters, imglog):
+    def pyramid(self, levels):
+        with self._lock:
+            if levels > self._levels:
+                self._pyramid = _build_pyramid(self.image, levels)
+                self._levels = levels
+            return self._pyramid[:levels]
+
+
+_thread_pool = None
+_thread_pool_size = 0
+_thread_pool_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def _parallel_map(f, items):
+    """Like ``map(f, items)`` (but returns a list), running ``f`` on a shared
+    pool of ``[match] threads`` threads.
+
+    This is useful for functions that spend most of their time in OpenCV,
+    which releases the GIL. Nested calls (from ``f`` itself) run serially, to
+    avoid deadlocking the pool.
+    """
+    global _thread_pool, _thread_pool_size
+
+    items = list(items)
+    threads = get_config("match", "threads", type_=int)
+    if (threads <= 1 or len(items) <= 1 or
+            getattr(_thread_local, "in_pool", False)):
+        return [f(x) for x in items]
+
+    def run(x):
+        _thread_local.in_pool = True
+        try:
+            return f(x)
+        finally:
+            _thread_local.in_pool = False
+
+    with _thread_pool_lock:
+        if _thread_pool_size != threads:
+            if _thread_pool is not None:
+                _thread_pool.close()
+            _thread_pool = ThreadPool(threads)
+            _thread_pool_size = threads
+        pool = _thread_pool
+    return pool.map(run, items)
+
+
+_MATCH_METHODS = {
+    MatchMethod.SQDIFF: cv2.TM_SQDIFF,
+    MatchMethod.SQDIFF_NORMED: cv2.TM_SQDIFF_NORMED,
+    MatchMethod.CCORR_NORMED: cv2.TM_CCORR_NORMED,
+    MatchMethod.CCOEFF_NORMED: cv2.TM_CCOEFF_NORMED,
+}
+
+
+def _find_candidate_matches(frame_pyramid, template, match_parameters,
+                            levels, imglog, early_exit=False):
     """First pass: Search for `template` in the entire `image`.
 
     This searches the entire image, so speed is more important than accuracy.
@@ -523,24 +1226,18 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
     http://opencv-code.com/tutorials/fast-template-matching-with-image-pyramid
     """
 
+    image = frame_pyramid.image
     imglog.imwrite("source", image)
-    imglog.imwrite("template", template)
-    imglog.set(template_shape=template.shape)
-    if template.shape[2] == 4:
-        imglog.imwrite("mask", template[:, :, 3])
-
-    ddebug("Original image %s, template %s" % (image.shape, template.shape))
+    # PNG doesn't support grayscale + alpha; we log the mask separately.
+    imglog.imwrite("template", template.image
+                   if template.image.shape[2] != 2 else template.template)
+    imglog.set(template_shape=template.image.shape)
+    imglog.imwrite("mask", template.mask)
 
-    method = {  # pylint:disable=redefined-outer-name
-        MatchMethod.SQDIFF: cv2.TM_SQDIFF,
-        MatchMethod.SQDIFF_NORMED: cv2.TM_SQDIFF_NORMED,
-        MatchMethod.CCORR_NORMED: cv2.TM_CCORR_NORMED,
-        MatchMethod.CCOEFF_NORMED: cv2.TM_CCOEFF_NORMED,
-    }[match_parameters.match_method]
+    ddebug("Original image %s, template %s" % (image.shape,
+                                                template.image.shape))
 
-    levels = get_config("match", "pyramid_levels", type_=int)
-    if levels <= 0:
-        raise ConfigurationError("'match.pyramid_levels' must be > 0")
+    method = _MATCH_METHODS[match_parameters.match_method]
 
     if (match_parameters.match_method == MatchMethod.SQDIFF and
             template.shape[:2] == image.shape[:2] and
@@ -549,8 +1246,22 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
         # etc.  This is particularly useful for full-image matching.
         ddebug("stbt-match: frame and template sizes match: Using fast-path")
         imglog.set(fast_path=True)
-        s, n = sqdiff(template, image)
-        if n == 0:
+        # The most values that can contribute to the square difference (that
+        # is, if the template has no transparent pixels):
+        max_n = image.size
+        if (early_exit and not imglog.enabled and
+                match_parameters.match_threshold > 0):
+            max_total = ((1 - match_parameters.match_threshold) *
+                         max_n * 255 * 255)
+        else:
+            max_total = None
+        s, n = sqdiff(template.image, image,
+                      threads=get_config("match", "threads", type_=int),
+                      max_total=max_total)
+        if max_total is not None and s > max_total:
+            # `sqdiff` gave up early: This is an upper bound.
+            certainty = 1 - float(s) / (max_n * 255 * 255)
+        elif n == 0:
             certainty = 1
         else:
             certainty = 1 - float(s) / (n * 255 * 255)
@@ -559,17 +1270,12 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
         yield (0, False, _image_region(image), 0.)
         return
 
-    if template.shape[2] == 4:
-        # OpenCV wants mask to match template's number of channels
-        mask = cv2.cvtColor(template[:, :, 3], cv2.COLOR_GRAY2BGR)
-        template = template[:, :, 0:3]
-    else:
-        mask = None
-
-    mask_pyramid = _build_pyramid(mask, levels, is_mask=True)
-    template_pyramid = _build_pyramid(template, len(mask_pyramid),
-                                      is_template=True)
-    image_pyramid = _build_pyramid(image, len(template_pyramid))
+    levels = _resolve_pyramid_levels(levels, template, imglog)
+    template_pyramid, mask_pyramid = template.pyramids(levels)
+    # The frame's pyramid may be shared with other templates that have more
+    # levels, so we ask for `levels` rather than `len(template_pyramid)` to
+    # avoid building it twice:
+    image_pyramid = frame_pyramid.pyramid(levels)[:len(template_pyramid)]
     roi_mask = None  # Initial region of interest: The whole image.
 
     for level in reversed(range(len(image_pyramid))):
@@ -584,7 +1290,7 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
 
         heatmap, heatmap_scale = _match_template(
             image_pyramid[level], template_pyramid[level], mask_pyramid[level],
-            method, roi_mask, level, imwrite)
+            method, match_parameters.match_engine, roi_mask, level, imwrite)
 
         # Relax the threshold slightly for scaled-down pyramid levels to
         # compensate for scaling artifacts.
@@ -617,32 +1323,127 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
     region = Region(*_upsample(best_match_position, level),
                     width=template.shape[1], height=template.shape[0])
 
-    for i in itertools.count():
+    imglog.imwrite("match0-heatmap", heatmap, scale=heatmap_scale)
+    yield (0, matched, region, certainty)
+    if not matched:
+        return
+    assert level == 0
 
-        imglog.imwrite("match%d-heatmap" % i, heatmap, scale=heatmap_scale)
+    if imglog.enabled or threshold <= 0:
+        # Slow path, so that we can log the heatmap after each match. (With a
+        # threshold of 0 every position matches, even excluded ones.)
+        more_matches = _find_next_matches(heatmap, heatmap_scale, threshold,
+                                          region, imglog)
+    else:
+        more_matches = _non_maximum_suppression(heatmap, heatmap_scale,
+                                                threshold, region)
+    for i, (matched, region, certainty) in enumerate(more_matches, start=1):
         yield (i, matched, region, certainty)
-        if not matched:
-            return
-        assert level == 0
 
+
+def _find_next_matches(heatmap, heatmap_scale, threshold, region, imglog):
+    """Yields ``(matched, region, certainty)`` for each match after ``region``
+    (the best match in ``heatmap``), followed by the closest non-match.
+    """
+    i = 0
+    while True:
         # Exclude any positions that would overlap the previous match, then
         # keep iterating until we don't find any more matches.
-        exclude = region.extend(x=-(region.width - 1), y=-(region.height - 1))
-        cv2.rectangle(
-            heatmap,
-            # -1 because cv2.rectangle considers the bottom-right point to be
-            # *inside* the rectangle.
-            (exclude.x, exclude.y), (exclude.right - 1, exclude.bottom - 1),
-            heatmap_scale,
-            cv2_compat.FILLED)
-
+        _exclude_match(heatmap, region, heatmap_scale)
         matched, best_match_position, certainty = _find_best_match_position(
-            heatmap, heatmap_scale, threshold, level)
+            heatmap, heatmap_scale, threshold, 0)
         region = Region(*best_match_position,
-                        width=template.shape[1], height=template.shape[0])
+                        width=region.width, height=region.height)
+        i += 1
+        imglog.imwrite("match%d-heatmap" % i, heatmap, scale=heatmap_scale)
+        yield (matched, region, certainty)
+        if not matched:
+            return
 
 
-def _match_template(image, template, mask, method, roi_mask, level, imwrite):  # pylint:disable=redefined-outer-name
+def _non_maximum_suppression(heatmap, heatmap_scale, threshold, region):
+    """Gives the same results as `_find_next_matches`, but faster when there
+    are many matches.
+
+    `_find_next_matches` scans the whole heatmap twice for each match (to
+    exclude the previous match, and to find the next best position).
+    Instead, we find all the positions that are above the threshold with a
+    single scan, and sort them. Then we take each position in turn, skipping
+    positions that overlap a previous match. Ties are broken in row-major
+    order, the same as `cv2.minMaxLoc`.
+
+    ``threshold`` must be > 0, so that excluded positions never match.
+    """
+    _exclude_match(heatmap, region, heatmap_scale)
+    # The same calculation as `_find_best_match_position`:
+    values = heatmap.ravel()
+    candidates = numpy.flatnonzero(
+        1 - values.astype(numpy.float64) / heatmap_scale >= threshold)
+    candidates = candidates[numpy.argsort(values[candidates], kind="mergesort")]
+
+    for index in candidates:
+        y, x = divmod(int(index), heatmap.shape[1])
+        certainty = 1 - float(heatmap[y, x]) / heatmap_scale
+        if certainty < threshold:
+            # Excluded because it overlaps a previous match
+            continue
+        ddebug("Level 0: Matched at %s with certainty %s" % (
+            Position(x, y), certainty))
+        region = Region(x, y, width=region.width, height=region.height)
+        yield (True, region, certainty)
+        _exclude_match(heatmap, region, heatmap_scale)
+
+    matched, best_match_position, certainty = _find_best_match_position(
+        heatmap, heatmap_scale, threshold, 0)
+    yield (matched, Region(*best_match_position, width=region.width,
+                           height=region.height), certainty)
+
+
+def _exclude_match(heatmap, region, heatmap_scale):
+    """Set the heatmap to "no match" at any positions that would overlap
+    ``region``.
+    """
+    exclude = region.extend(x=-(region.width - 1), y=-(region.height - 1))
+    cv2.rectangle(
+        heatmap,
+        # -1 because cv2.rectangle considers the bottom-right point to be
+        # *inside* the rectangle.
+        (exclude.x, exclude.y), (exclude.right - 1, exclude.bottom - 1),
+        heatmap_scale,
+        cv2_compat.FILLED)
+
+
+def _find_candidate_match_near(image, template, match_parameters, levels,
+                               hint):
+    """Like the first pass (`_find_candidate_matches`), but only searches
+    within ``hint``, and only at pyramid level 0.
+
+    Returns ``(region, certainty)`` if it found a match; ``(None, None)``
+    otherwise.
+    """
+    search = Region.intersect(hint, _image_region(image))
+    if (search is None or search.width < template.shape[1] or
+            search.height < template.shape[0]):
+        return None, None
+
+    template_pyramid, mask_pyramid = template.pyramids(
+        _resolve_pyramid_levels(levels, template))
+    heatmap, heatmap_scale = _match_template(
+        crop(image, search), template_pyramid[0], mask_pyramid[0],
+        _MATCH_METHODS[match_parameters.match_method],
+        match_parameters.match_engine, None, 0,
+        imwrite=lambda name, img, scale=1: None)
+    matched, position, certainty = _find_best_match_position(
+        heatmap, heatmap_scale, match_parameters.match_threshold, 0)
+    if not matched:
+        return None, None
+    return (Region(position.x + search.x, position.y + search.y,
+                   width=template.shape[1], height=template.shape[0]),
+            certainty)
+
+
+def _match_template(image, template, mask, method, engine, roi_mask, level,  # pylint:disable=redefined-outer-name
+                    imwrite):
 
     ddebug("Level %d: image %s, template %s" % (
         level, image.shape, template.shape))
@@ -692,21 +1493,60 @@ def _match_template(image, template, mask, method, roi_mask, level, imwrite):  #
                 thickness=1)
         imwrite("source_with_rois", source_with_rois)
 
+    opencl = (cv2_compat.use_opencl() and
+              not _use_fft(engine, template, mask, rois))
+    if opencl:
+        # Upload the images once; each ROI below is a view into `umat_image`.
+        umat_image = cv2_compat.to_umat(image)
+        umat_template = cv2_compat.to_umat(template)
+
     if mask is not None:
-        kwargs = {"mask": mask}
+        kwargs = {"mask": cv2_compat.to_umat(mask) if opencl else mask}
     else:
         kwargs = {}  # For OpenCV < 3.0.0
-    for roi in rois:
+
+    def match_roi(roi, out=None):
         r = roi.extend(right=template.shape[1] - 1,
                        bottom=template.shape[0] - 1)
         ddebug("Level %d: Searching in %s" % (level, r))
-        cv2.matchTemplate(
+        if opencl:
+            heatmap = cv2.matchTemplate(
+                cv2.UMat(umat_image, (r.y, r.bottom), (r.x, r.right)),
+                umat_template,
+                method,
+                **kwargs).get()
+            if out is not None:
+                out[...] = heatmap
+            return heatmap
+        return cv2.matchTemplate(
             image[r.to_slice()],
             template,
             method,
-            matches_heatmap[roi.to_slice()],
+            out,
             **kwargs)
 
+    if _use_fft(engine, template, mask, rois):
+        # Calculate the heatmap for all the ROIs at once.
+        bbox = Region.bounding_box(*rois)
+        r = bbox.extend(right=template.shape[1] - 1,
+                        bottom=template.shape[0] - 1)
+        ddebug("Level %d: Searching in %s using FFT" % (level, r))
+        heatmap = match_template_fft(image[r.to_slice()], template, method,
+                                     mask)
+        for roi in rois:
+            matches_heatmap[roi.to_slice()] = \
+                heatmap[roi.translate(-bbox.x, -bbox.y).to_slice()]
+    elif (len(rois) > 1 and not opencl and
+          get_config("match", "threads", type_=int) > 1):
+        # The ROIs can overlap, so each thread writes to its own output and
+        # we copy them into the heatmap in the same order as the serial case
+        # below, so that the result is deterministic.
+        for roi, heatmap in zip(rois, _parallel_map(match_roi, rois)):
+            matches_heatmap[roi.to_slice()] = heatmap
+    else:
+        for roi in rois:
+            match_roi(roi, matches_heatmap[roi.to_slice()])
+
     if method == cv2.TM_SQDIFF:
         # OpenCV's SQDIFF_NORMED normalises by the pixel intensity across
         # the reference image and the source image patch. This doesn't work
@@ -735,6 +1575,32 @@ def _match_template(image, template, mask, method, roi_mask, level, imwrite):  #
     return matches_heatmap, scale
 
 
+def _use_fft(engine, template, mask, rois):
+    if not rois:
+        return False
+    if engine != MatchEngine.AUTO:
+        return engine == MatchEngine.FFT
+    if mask is not None:
+        # `match_template_fft`'s masked matching doesn't give the same results
+        # as `cv2.matchTemplate`'s (see `MatchParameters.match_engine`), so we
+        # don't let the choice depend on the size of each pyramid level.
+        return False
+    # The cost of `cv2.matchTemplate` is roughly proportional to the area it
+    # searches, which is each ROI extended by the size of the template. With
+    # large templates & several ROIs those areas overlap a lot, so it's
+    # cheaper to calculate the bounding box of the ROIs once.
+    h, w = template.shape[:2]
+    spatial_area = sum((r.width + w - 1) * (r.height + h - 1) for r in rois)
+    bbox = Region.bounding_box(*rois)
+    fft_area = (bbox.width + w - 1) * (bbox.height + h - 1) * _FFT_COST
+    return fft_area < spatial_area
+
+
+# The cost of `match_template_fft` relative to `cv2.matchTemplate` for the
+# same area (see `_use_fft`).
+_FFT_COST = 2.0
+
+
 def _find_best_match_position(matches_heatmap, scale, threshold, level):
     min_value, _, min_location, _ = cv2.minMaxLoc(matches_heatmap)
     min_value /= scale
@@ -761,15 +1627,19 @@ def _build_pyramid(image, levels, is_template=False, is_mask=False):
     """
     if image is None:
         return [None] * levels
+    opencl = cv2_compat.use_opencl()
     pyramid = [image]
-    previous = image
+    previous = cv2_compat.to_umat(image) if opencl else image
+    shape = image.shape
     for _ in range(levels - 1):
-        if any(x < 20 for x in previous.shape[:2]):
+        if any(x < 20 for x in shape[:2]):
             break
         downsampled = cv2.pyrDown(previous, borderType=cv2.BORDER_REPLICATE)
         if is_mask:
             cv2.threshold(downsampled, 254, 255, cv2.THRESH_BINARY, downsampled)
         previous = downsampled
+        downsampled = cv2_compat.from_umat(downsampled)
+        shape = downsampled.shape
         if is_template or is_mask:
             # Ignore pixels on the edge of the template, because pyrDown's
             # blurring will affect them differently than the corresponding
@@ -784,8 +1654,11 @@ def _build_pyramid(image, levels, is_template=False, is_mask=False):
             # matched at pixel 0,0 of the frame, so we won't need to adjust
             # the match position afterwards).
             downsampled = downsampled[1:, 1:]
-        if is_mask and numpy.count_nonzero(downsampled) // 3 < 400:
-            break
+        if is_mask:
+            channels = downsampled.size // (downsampled.shape[0] *
+                                            downsampled.shape[1])
+            if numpy.count_nonzero(downsampled) // channels < 400:
+                break
         pyramid.append(downsampled)
     return pyramid
 
@@ -815,33 +1688,26 @@ def _confirm_match(image, region, template, match_parameters, imwrite):
     if match_parameters.confirm_method == ConfirmMethod.NONE:
         return True
 
-    if template.shape[2] == 4:
-        # Create transparency mask from alpha channel
-        mask = template[:, :, 3]
-        template = template[:, :, 0:3]
-    else:
-        mask = None
+    mask = template.mask
+    template_steps = template.confirm_template(match_parameters.confirm_method)
+    for name, img in template_steps:
+        imwrite(name, img)
+    template = template_steps[-1][1]
 
     # Set Region Of Interest to the "best match" location
     image = image[region.y:region.bottom, region.x:region.right]
     imwrite("confirm-source_roi", image)
     if image.shape[2] == 3:
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
     imwrite("confirm-source_roi_gray", image)
-    imwrite("confirm-template_gray", template)
 
     if match_parameters.confirm_method == ConfirmMethod.NORMED_ABSDIFF:
         cv2.normalize(image, image, 0, 255, cv2.NORM_MINMAX, mask=mask)
-        cv2.normalize(template, template, 0, 255, cv2.NORM_MINMAX, mask=mask)
         imwrite("confirm-source_roi_gray_normalized", image)
-        imwrite("confirm-template_gray_normalized", template)
 
     if mask is not None:
         image = cv2.bitwise_and(image, mask)
-        template = cv2.bitwise_and(template, mask)
         imwrite("confirm-source_roi_masked", image)
-        imwrite("confirm-template_masked", template)
 
     absdiff = cv2.absdiff(image, template)
     _, thresholded = cv2.threshold(
@@ -858,6 +1724,77 @@ def _confirm_match(image, region, template, match_parameters, imwrite):
     return cv2.countNonZero(eroded) == 0
 
 
+def _confirm_matches(image, regions, template, match_parameters):
+    """Like `_confirm_match` (without the debug logging) for a batch of
+    candidate ``regions`` of ``image``. Returns a list of bools.
+
+    This is faster than calling `_confirm_match` for each region: The regions
+    are converted to grayscale & stacked vertically into a single image so
+    that most of the steps are a single OpenCV call for the whole batch,
+    writing into scratch buffers that are re-used across calls. The steps
+    that depend on the neighbouring pixels (``normalize`` of each region, and
+    ``erode``) are done on each region separately, so the results are
+    identical.
+    """
+    if match_parameters.confirm_method == ConfirmMethod.NONE:
+        return [True] * len(regions)
+    if not regions:
+        return []
+
+    n = len(regions)
+    h, w = template.shape[:2]
+    mask = template.mask
+    template_tiles, mask_tiles = template.confirm_tiles(
+        match_parameters.confirm_method, n)
+
+    gray = _scratch("confirm-gray", (n * h, w))
+    for i, region in enumerate(regions):
+        roi = image[region.y:region.bottom, region.x:region.right]
+        if image.shape[2] == 3:
+            cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY, dst=gray[i * h:(i + 1) * h])
+        else:
+            gray[i * h:(i + 1) * h] = roi.reshape((h, w))
+
+    if match_parameters.confirm_method == ConfirmMethod.NORMED_ABSDIFF:
+        for i in range(n):
+            tile = gray[i * h:(i + 1) * h]
+            cv2.normalize(tile, tile, 0, 255, cv2.NORM_MINMAX, mask=mask)
+
+    if mask is not None:
+        cv2.bitwise_and(gray, mask_tiles, dst=gray)
+
+    absdiff = cv2.absdiff(gray, template_tiles,
+                          dst=_scratch("confirm-absdiff", (n * h, w)))
+    cv2.threshold(absdiff, int((1 - match_parameters.confirm_threshold) * 255),
+                  255, cv2.THRESH_BINARY, dst=absdiff)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    eroded = _scratch("confirm-eroded", (h, w))
+    results = []
+    for i in range(n):
+        cv2.erode(absdiff[i * h:(i + 1) * h], kernel, dst=eroded,
+                  iterations=match_parameters.erode_passes)
+        results.append(cv2.countNonZero(eroded) == 0)
+    return results
+
+
+_scratch_buffers = threading.local()
+
+
+def _scratch(name, shape, dtype=numpy.uint8):
+    """A temporary array that is re-used by subsequent calls on the same
+    thread, to avoid allocating memory in hot loops.
+
+    The contents are uninitialised, and they are only valid until the next
+    call with the same ``name``.
+    """
+    size = int(numpy.prod(shape))
+    buf = getattr(_scratch_buffers, name, None)
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = numpy.empty(size, dtype=dtype)
+        setattr(_scratch_buffers, name, buf)
+    return buf[:size].reshape(shape)
+
+
 def _merge_regions(regions):
     """Discard regions that are entirely contained within another region."""
     regions.sort(key=lambda r: r.width * r.height)
@@ -933,6 +1870,11 @@ def _log_match_image_debug(imglog):
         {% endfor %}
         </table>
         {% else %}
+        {% if auto_pyramid_levels %}
+        <p>Using up to <b>{{auto_pyramid_levels}} pyramid levels</b>, chosen
+        automatically for this template (<code>[match] pyramid_levels =
+        auto</code>).</p>
+        {% endif %}
         <table class="table">
         <tr>
           <th>Pyramid level</th>
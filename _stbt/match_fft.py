@@ -0,0 +1,229 @@
+# coding: utf-8
+
+"""Template matching in the frequency domain.
+
+`match_template_fft` is equivalent to OpenCV's `cv2.matchTemplate` (within
+floating-point rounding error) but it calculates the cross-correlation of the
+image & template using the Fast Fourier Transform. Its cost depends on the
+size of the image, but hardly at all on the size of the template, so it is
+faster than `cv2.matchTemplate` for large templates -- and in particular for
+large templates with a transparency mask.
+
+With a mask, it is equivalent to OpenCV 3.2's masked `cv2.matchTemplate`.
+Newer versions of OpenCV treat the mask differently, so they can give
+different results.
+"""
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+
+import cv2
+import numpy
+
+
+FLT_EPSILON = numpy.finfo(numpy.float32).eps
+
+
+def match_template_fft(image, template, method, mask=None):
+    """Equivalent to ``cv2.matchTemplate(image, template, method, mask=mask)``.
+
+    :param numpy.ndarray image: 8-bit image with 1 or more channels.
+    :param numpy.ndarray template: 8-bit image with the same number of
+        channels as ``image``, and no larger than ``image``.
+    :param int method: One of ``cv2.TM_SQDIFF``, ``cv2.TM_SQDIFF_NORMED``,
+        ``cv2.TM_CCORR_NORMED`` or ``cv2.TM_CCOEFF_NORMED``. If ``mask`` is
+        given, only ``cv2.TM_SQDIFF`` and ``cv2.TM_CCORR_NORMED`` are
+        supported, as with OpenCV 3.2.
+    :param numpy.ndarray mask: Optional 8-bit mask with the same size as
+        ``template`` and either 1 channel or the same number of channels as
+        ``template``.
+
+    :returns: A float32 array of shape ``(image height - template height + 1,
+        image width - template width + 1)``.
+
+    With a mask we give the same results as OpenCV 3.2's ``matchTemplateMask``:
+    It scales the 8-bit image, template and mask to the range [0, 1] before
+    matching. (Newer versions of OpenCV treat 8-bit masks as binary masks and
+    don't scale the image or template, but stb-tester's first pass relies on
+    the OpenCV 3.2 behaviour.)
+    """
+    image = _channels(numpy.asarray(image))
+    template = _channels(numpy.asarray(template))
+    if image.shape[2] != template.shape[2]:
+        raise ValueError("Image %r and template %r must have the same number "
+                         "of channels" % (image.shape, template.shape))
+    if (image.shape[0] < template.shape[0] or
+            image.shape[1] < template.shape[1]):
+        raise ValueError("Image %r must be larger than template %r"
+                         % (image.shape, template.shape))
+
+    correlator = _Correlator(image.shape[:2], template.shape[:2])
+    if mask is None:
+        return _match_template_fft(correlator, image, template, method)
+    else:
+        return _match_template_fft_masked(
+            correlator, image, template,
+            _channels(numpy.asarray(mask)).astype(numpy.float64) / 255.,
+            method)
+
+
+def _match_template_fft(correlator, image, template, method):
+    # This follows OpenCV's `common_matchTemplate`: The sums over each window
+    # of the image come from box filters, and the only thing we need the
+    # cross-correlation for is the sum of image * template.
+    n_channels = image.shape[2]
+    h, w = template.shape[:2]
+    # We use float64 throughout: The sums can overflow OpenCV's integer
+    # intermediate values, and float32 isn't precise enough.
+    image = image.astype(numpy.float64)
+    template = template.astype(numpy.float64)
+    if method == cv2.TM_CCOEFF_NORMED:
+        template_mean = template.reshape(-1, n_channels).mean(axis=0)
+        template_norm = numpy.sum((template - template_mean) ** 2)
+        if template_norm < numpy.finfo(numpy.float64).eps:
+            return numpy.ones(correlator.result_shape, dtype=numpy.float32)
+    else:
+        template_norm = numpy.sum(template ** 2)
+    template_sum2 = numpy.sum(template ** 2)
+
+    num = correlator.correlate(
+        [(image[:, :, c], template[:, :, c]) for c in range(n_channels)])
+    window_sum2 = correlator.crop(_window_sums(
+        _sum_channels(cv2.multiply(image, image)), h, w))
+
+    if method == cv2.TM_CCOEFF_NORMED:
+        window_sum = _channels(correlator.crop(_window_sums(image, h, w)))
+        num -= numpy.dot(window_sum, template_mean)
+        window_mean2 = numpy.sum(window_sum ** 2, axis=2) / (h * w)
+    else:
+        window_mean2 = 0
+
+    if method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED):
+        num = numpy.maximum(window_sum2 - 2 * num + template_sum2, 0)
+    if method == cv2.TM_SQDIFF:
+        return num.astype(numpy.float32)
+
+    diff2 = numpy.maximum(window_sum2 - window_mean2, 0)
+    t = numpy.where(diff2 <= numpy.minimum(0.5, 10 * FLT_EPSILON * window_sum2),
+                    0, numpy.sqrt(diff2) * numpy.sqrt(template_norm))
+    return _normalise(num, t, method).astype(numpy.float32)
+
+
+def _match_template_fft_masked(correlator, image, template, mask, method):
+    # This follows OpenCV 3.2's `matchTemplateMask`. Unlike the unmasked case
+    # the window sums are weighted by the mask, so they are cross-correlations
+    # too. `mask` has already been scaled to [0, 1]; we scale the image &
+    # template at the end.
+    if method not in (cv2.TM_SQDIFF, cv2.TM_CCORR_NORMED):
+        raise ValueError("Unsupported method %r for masked matching" % method)
+    n_channels = image.shape[2]
+    if mask.shape[2] == 1:
+        mask = numpy.repeat(mask, n_channels, axis=2)
+    image = image.astype(numpy.float64)
+    template = template.astype(numpy.float64)
+    mask2 = mask ** 2
+    templ_mask2 = template * mask2
+
+    if _all_channels_equal(mask2):
+        # Σ_c corr(image_c², mask²) == corr(Σ_c image_c², mask²), which saves
+        # a DFT per channel. This is the usual case: stb-tester's masks come
+        # from the reference image's alpha channel.
+        image2_mask2 = correlator.correlate(
+            [(_sum_channels(cv2.multiply(image, image)), mask2[:, :, 0])])
+    else:
+        image2_mask2 = correlator.correlate(
+            [(image[:, :, c] ** 2, mask2[:, :, c]) for c in range(n_channels)])
+    image_templ_mask2 = correlator.correlate(
+        [(image[:, :, c], templ_mask2[:, :, c]) for c in range(n_channels)])
+
+    if method == cv2.TM_SQDIFF:
+        templ_mask2_sum = numpy.sum(template * templ_mask2)
+        return ((image2_mask2 - 2 * image_templ_mask2 + templ_mask2_sum) /
+                (255. ** 2)).astype(numpy.float32)
+    else:
+        templ_norm = numpy.sqrt(numpy.sum((template * mask) ** 2))
+        t = numpy.sqrt(numpy.maximum(image2_mask2, 0)) * templ_norm
+        # OpenCV gives NaN where t == 0 (for example if the mask is completely
+        # transparent). We give 0 instead, which means "no match".
+        out = numpy.zeros(t.shape)
+        numpy.divide(image_templ_mask2, t, out=out, where=t != 0)
+        return out.astype(numpy.float32)
+
+
+class _Correlator(object):
+    """Calculates the cross-correlation of same-sized images with same-sized
+    templates, using the DFT.
+
+    The image & template are zero-padded to the same DFT size so that the
+    correlation doesn't wrap around within the region we're interested in (the
+    positions where the template lies entirely within the image).
+    """
+    def __init__(self, image_shape, template_shape):
+        self.result_shape = (image_shape[0] - template_shape[0] + 1,
+                             image_shape[1] - template_shape[1] + 1)
+        self.dft_shape = (cv2.getOptimalDFTSize(image_shape[0]),
+                          cv2.getOptimalDFTSize(image_shape[1]))
+
+    def dft(self, a):
+        padded = numpy.zeros(self.dft_shape)
+        padded[:a.shape[0], :a.shape[1]] = a
+        return cv2.dft(padded, nonzeroRows=a.shape[0])
+
+    def correlate(self, pairs):
+        """Σ cross-correlation(image, template) for each (image, template) in
+        ``pairs``. Summing in the frequency domain means we only need one
+        inverse DFT.
+        """
+        spectrum = None
+        for image, template in pairs:
+            product = cv2.mulSpectrums(self.dft(image), self.dft(template), 0,
+                                       conjB=True)
+            if spectrum is None:
+                spectrum = product
+            else:
+                spectrum += product
+        return self.crop(
+            cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT))
+
+    def crop(self, a):
+        return a[:self.result_shape[0], :self.result_shape[1]]
+
+
+def _normalise(num, t, method):
+    # The same as OpenCV's `common_matchTemplate`, including its handling of
+    # rounding errors.
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        normalised = num / t
+    out_of_range = 0 if method != cv2.TM_SQDIFF_NORMED else 1
+    return numpy.where(
+        numpy.abs(num) < t, normalised,
+        numpy.where(numpy.abs(num) < t * 1.125, numpy.sign(num),
+                    out_of_range))
+
+
+def _window_sums(a, h, w):
+    """The sum of each ``h`` x ``w`` window of ``a``, indexed by the window's
+    top-left corner. Only the windows that fit entirely within ``a`` are
+    valid.
+    """
+    return cv2.boxFilter(a, -1, (w, h), anchor=(0, 0), normalize=False,
+                         borderType=cv2.BORDER_CONSTANT)
+
+
+def _sum_channels(a):
+    if a.ndim == 2:
+        return a
+    return cv2.transform(a, numpy.ones((1, a.shape[2])))
+
+
+def _all_channels_equal(a):
+    return all(numpy.array_equal(a[:, :, 0], a[:, :, c])
+               for c in range(1, a.shape[2]))
+
+
+def _channels(a):
+    if a.ndim == 2:
+        return a.reshape(a.shape + (1,))
+    return a
@@ -6,18 +6,26 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
 
+import atexit
 import errno
 import glob
+import math
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from distutils.version import LooseVersion
 from enum import IntEnum
 
 import cv2
 import numpy
 
-from . import imgproc_cache
+from . import imgproc_cache, libtesseract
 from .config import get_config
 from .imgutils import crop, _frame_repr, _validate_region
 from .logging import debug, ImageLogger, warn
@@ -26,6 +34,11 @@ from .utils import (
     basestring, named_temporary_directory, native_int, native_str, text_type,
     to_unicode)
 
+try:
+    from .xxhash import Xxhash64
+except (ImportError, OSError):  # libxxhash.so hasn't been built
+    Xxhash64 = None
+
 # Tesseract sometimes has a hard job distinguishing certain glyphs such as
 # ligatures and different forms of the same punctuation.  We strip out this
 # superfluous information improving matching accuracy with minimal effect on
@@ -295,6 +308,170 @@ def ocr(frame=None, region=Region.ALL,
     return text
 
 
+def ocr_async(frame=None, region=Region.ALL,
+              mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
+              lang=None, tesseract_config=None, tesseract_user_words=None,
+              tesseract_user_patterns=None, upsample=True, text_color=None,
+              text_color_threshold=None, engine=None, char_whitelist=None,
+              corrections=None):
+    """Start reading the text in a region of a frame, without waiting for
+    the result.
+
+    The arguments are the same as `ocr`. Returns an `OcrFuture`; call its
+    ``result()`` method to get the text that `ocr` would have returned.
+
+    Use this to OCR several regions at the same time: stb-tester runs up to
+    ``workers`` OCR calls at once, where ``workers`` is set in the ``[ocr]``
+    section of the stb-tester configuration file (it defaults to 1, in which
+    case ``ocr_async`` runs the OCR before returning). For example, in a
+    FrameObject for a grid of TV-guide cells:
+
+    .. code-block:: python
+
+        futures = [stbt.ocr_async(self._frame, cell.region)
+                   for cell in grid]
+        titles = [f.result() for f in futures]
+
+    Added in v33.
+    """
+    if frame is None:
+        from stbt_core import get_frame
+        frame = get_frame()
+
+    # Check the region now, so that the exception comes from the caller's
+    # line of code.
+    _validate_region(frame, region)
+
+    return _submit_ocr(
+        ocr, frame, region, mode, lang, tesseract_config,
+        tesseract_user_words, tesseract_user_patterns, upsample, text_color,
+        text_color_threshold, engine, char_whitelist, corrections)
+
+
+def ocr_many(regions, frame=None,
+             mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
+             lang=None, tesseract_config=None, tesseract_user_words=None,
+             tesseract_user_patterns=None, upsample=True, text_color=None,
+             text_color_threshold=None, engine=None, char_whitelist=None,
+             corrections=None):
+    """Read the text in several regions of a single video frame.
+
+    This is equivalent to calling `ocr` once for each region, but it is
+    faster: The regions are read concurrently (by up to ``workers`` threads,
+    configured in the ``[ocr]`` section of the stb-tester configuration
+    file), re-using Tesseract instances that have already loaded the
+    language data. Each region's result is cached separately, so if only
+    some of the regions have changed since the last frame, only those
+    regions are read again.
+
+    :param regions: An iterable of `Region` objects.
+
+    The other arguments are the same as `ocr`. All the regions are read with
+    the same parameters.
+
+    :returns: A list of strings, one for each region in ``regions`` (in the
+        same order).
+
+    Example, in a FrameObject for a grid of TV-guide cells:
+
+    .. code-block:: python
+
+        @property
+        def titles(self):
+            return stbt.ocr_many([cell.region for cell in self._grid],
+                                 frame=self._frame)
+
+    Added in v33.
+    """
+    if frame is None:
+        from stbt_core import get_frame
+        frame = get_frame()
+
+    regions = list(regions)
+    for region in regions:
+        _validate_region(frame, region)
+
+    futures = [
+        _submit_ocr(
+            ocr, frame, region, mode, lang, tesseract_config,
+            tesseract_user_words, tesseract_user_patterns, upsample,
+            text_color, text_color_threshold, engine, char_whitelist,
+            corrections)
+        for region in regions]
+    return [f.result() for f in futures]
+
+
+class OcrFuture(object):
+    """The result of `ocr_async`. This has a subset of the API of Python 3's
+    ``concurrent.futures.Future``.
+
+    Added in v33.
+    """
+    def __init__(self, async_result=None, value=None, exception=None):
+        self._async_result = async_result
+        self._value = value
+        self._exception = exception
+
+    def done(self):
+        """True if the result is available."""
+        return self._async_result is None or self._async_result.ready()
+
+    def result(self, timeout=None):
+        """Waits for the OCR to finish, and returns the text.
+
+        :param float timeout: Maximum number of seconds to wait. Raises
+            ``multiprocessing.TimeoutError`` if the OCR hasn't finished by
+            then. Defaults to waiting forever.
+
+        Raises the same exceptions as `ocr`.
+        """
+        if self._async_result is not None:
+            return self._async_result.get(timeout)
+        if self._exception is not None:
+            raise self._exception  # pylint:disable=raising-bad-type
+        return self._value
+
+
+_ocr_pool = None
+_ocr_pool_size = 0
+_ocr_pool_lock = threading.Lock()
+_ocr_thread_local = threading.local()
+
+
+def _submit_ocr(f, *args):
+    """Runs ``f(*args)`` on a shared pool of ``[ocr] workers`` threads, and
+    returns an `OcrFuture` for its result.
+
+    Tesseract (whether it's in-process or a subprocess) releases the GIL, so
+    this can use more than one CPU core. Nested calls (from a worker thread)
+    run immediately, to avoid deadlocking the pool.
+    """
+    global _ocr_pool, _ocr_pool_size
+
+    workers = get_config("ocr", "workers", type_=int)
+    if workers <= 1 or getattr(_ocr_thread_local, "in_pool", False):
+        try:
+            return OcrFuture(value=f(*args))
+        except Exception as e:  # pylint:disable=broad-except
+            return OcrFuture(exception=e)
+
+    def run(*args):
+        _ocr_thread_local.in_pool = True
+        try:
+            return f(*args)
+        finally:
+            _ocr_thread_local.in_pool = False
+
+    with _ocr_pool_lock:
+        if _ocr_pool_size != workers:
+            if _ocr_pool is not None:
+                _ocr_pool.close()
+            _ocr_pool = ThreadPool(workers)
+            _ocr_pool_size = workers
+        pool = _ocr_pool
+    return OcrFuture(pool.apply_async(run, args))
+
+
 def match_text(text, frame=None, region=Region.ALL,
                mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD, lang=None,
                tesseract_config=None, case_sensitive=False, upsample=True,
@@ -528,25 +705,14 @@ def _tesseract(frame, region, mode, lang, _config, user_patterns, user_words,
                char_whitelist=char_whitelist,
                tesseract_version=tesseract_version)
 
-    frame = crop(frame, region)
-
-    if text_color is not None:
-        if upsample:
-            frame = _upsample(frame, imglog)
-            upsample = False
-
-        # Calculate distance of each pixel from `text_color`, then discard
-        # everything further than `text_color_threshold` distance away.
-        diff = numpy.subtract(frame, text_color, dtype=numpy.int32)
-        frame = numpy.sqrt((diff[:, :, 0] ** 2 +
-                            diff[:, :, 1] ** 2 +
-                            diff[:, :, 2] ** 2) // 3) \
-                     .astype(numpy.uint8)
-        imglog.imwrite("text_color_difference", frame)
-        _, frame = cv2.threshold(frame, text_color_threshold, 255,
-                                 cv2.THRESH_BINARY)
-        imglog.imwrite("text_color_threshold", frame)
+    frame, upsample = _preprocess(frame, region, upsample, text_color,
+                                  text_color_threshold, imglog)
 
+    if not imglog.enabled and _use_libtesseract(mode, tesseract_version):
+        return _tesseract_in_process(frame, mode, lang, _config,  # pylint:disable=unexpected-keyword-arg
+                                     user_patterns, user_words, upsample,
+                                     engine, char_whitelist, imglog,
+                                     tesseract_version, use_cache=True)
     return _tesseract_subprocess(frame, mode, lang, _config,  # pylint:disable=unexpected-keyword-arg
                                  user_patterns, user_words, upsample,
                                  engine, char_whitelist, imglog,
@@ -568,75 +734,63 @@ def _tesseract_subprocess(
     if upsample:
         frame = _upsample(frame, imglog)
 
-    # $XDG_RUNTIME_DIR is likely to be on tmpfs:
-    tmpdir = os.environ.get("XDG_RUNTIME_DIR", None)
+    _config = _tesseract_config(_config, user_patterns, user_words,
+                                char_whitelist, tesseract_version)
+    if imglog.enabled:
+        _config['tessedit_write_images'] = True
 
-    with named_temporary_directory(prefix='stbt-ocr-', dir=tmpdir) as tmp:
+    if tesseract_version >= LooseVersion("3.05"):
+        psm_flag = "--psm"
+    else:
+        psm_flag = "-psm"
 
-        if tesseract_version >= LooseVersion("3.05"):
-            psm_flag = "--psm"
+    args = [psm_flag, str(int(mode))] + engine_flags
+    tessenv = os.environ.copy()
+
+    if _config or user_words or user_patterns:
+        tessdata = _tessdata_prefix(lang, _config, user_patterns, user_words,
+                                    tessdata_suffix, tesseract_version)
+    else:
+        tessdata = _noop_contextmanager()
+    with tessdata as tessdata_prefix:
+        if tessdata_prefix is not None:
+            tessenv['TESSDATA_PREFIX'] = tessdata_prefix
+        if _config:
+            args += ['stbtester']
+
+        if imglog.enabled or tesseract_version < LooseVersion("4.0"):
+            return _tesseract_with_files(frame, lang, args, tessenv, imglog)
         else:
-            psm_flag = "-psm"
+            return _tesseract_with_pipes(frame, lang, args, tessenv)
 
-        cmd = ["tesseract", '-l', lang,
-               tmp + '/input.png',
-               tmp + '/output',
-               psm_flag, str(int(mode))] + engine_flags
-
-        tessenv = os.environ.copy()
-
-        if (_config or user_words or user_patterns or char_whitelist or
-                imglog.enabled):
-            tessdata_dir = tmp + '/tessdata'
-            os.mkdir(tessdata_dir)
-            _symlink_copy_dir(_find_tessdata_dir(tessdata_suffix), tmp)
-            tessenv['TESSDATA_PREFIX'] = tmp + '/'
-            if tesseract_version >= LooseVersion("4.0.0"):
-                tessenv['TESSDATA_PREFIX'] += "tessdata"
-
-        if ('tessedit_create_hocr' in _config and
-                tesseract_version >= LooseVersion('3.04')):
-            _config['tessedit_create_txt'] = 0
-
-        if user_words:
-            if 'user_words_suffix' in _config:
-                raise ValueError(
-                    "You cannot specify 'user_words' and " +
-                    "'tesseract_config[\"user_words_suffix\"]' " +
-                    "at the same time")
-            with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(to_unicode(x) for x in user_words))
-            _config['user_words_suffix'] = 'user-words'
-
-        if user_patterns:
-            if 'user_patterns_suffix' in _config:
-                raise ValueError(
-                    "You cannot specify 'user_patterns' and " +
-                    "'tesseract_config[\"user_patterns_suffix\"]' " +
-                    "at the same time")
-            with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(to_unicode(x) for x in user_patterns))
-            _config['user_patterns_suffix'] = 'user-patterns'
-
-        if char_whitelist:
-            if 'tessedit_char_whitelist' in _config:
-                raise ValueError(
-                    "You cannot specify 'char_whitelist' and " +
-                    "'tesseract_config[\"tessedit_char_whitelist\"]' " +
-                    "at the same time")
-            _config["tessedit_char_whitelist"] = char_whitelist
 
-        if imglog.enabled:
-            _config['tessedit_write_images'] = True
+def _tesseract_with_pipes(frame, lang, args, tessenv):
+    # PNM is uncompressed, so it's much faster than PNG to encode (and for
+    # Tesseract to decode); and we don't need a temporary directory because
+    # Tesseract reads the image from stdin & writes the result to stdout.
+    _, data = cv2.imencode(".pnm", frame)
+    cmd = ["tesseract", "-l", lang, "stdin", "stdout"] + args
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, env=tessenv)
+    stdout, stderr = p.communicate(data.tobytes())
+    if p.returncode != 0:
+        warn("Tesseract failed: %s" % stderr.decode("utf-8", "replace"))
+        raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
+    return stdout.decode("utf-8")
 
-        if _config:
-            with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
-                for k, v in _config.items():
-                    if isinstance(v, bool):
-                        cfg.write(('%s %s\n' % (k, 'T' if v else 'F')))
-                    else:
-                        cfg.write("%s %s\n" % (k, to_unicode(v)))
-            cmd += ['stbtester']
+
+def _tesseract_with_files(frame, lang, args, tessenv, imglog):
+    # We need the temporary directory for Tesseract's debug images (see
+    # `tessedit_write_images`), and older versions of Tesseract can't use
+    # stdin & stdout.
+
+    # $XDG_RUNTIME_DIR is likely to be on tmpfs:
+    tmpdir = os.environ.get("XDG_RUNTIME_DIR", None)
+
+    with named_temporary_directory(prefix='stbt-ocr-', dir=tmpdir) as tmp:
+        cmd = ["tesseract", '-l', lang,
+               tmp + '/input.png',
+               tmp + '/output'] + args
 
         cv2.imwrite(tmp + '/input.png', frame)
         try:
@@ -658,6 +812,380 @@ def _tesseract_subprocess(
                     return f.read()
 
 
+@imgproc_cache.memoize({"version": "32"})
+def _tesseract_in_process(
+        frame, mode, lang, _config, user_patterns, user_words, upsample,
+        engine, char_whitelist, imglog, tesseract_version):
+
+    if upsample:
+        frame = _upsample(frame, imglog)
+
+    _config = _tesseract_config(_config, user_patterns, user_words,
+                                char_whitelist, tesseract_version)
+    with _tesseract_instance(lang, engine, _config, user_patterns, user_words,
+                             tesseract_version) as tesseract:
+        return tesseract.recognize(
+            frame, mode, hocr=bool(_config.get('tessedit_create_hocr')))
+
+
+def _tesseract_config(_config, user_patterns, user_words, char_whitelist,
+                      tesseract_version):
+    """The Tesseract config variables for the given `ocr` parameters."""
+    _config = dict(_config)
+
+    if ('tessedit_create_hocr' in _config and
+            tesseract_version >= LooseVersion('3.04')):
+        _config['tessedit_create_txt'] = 0
+
+    if user_words:
+        if 'user_words_suffix' in _config:
+            raise ValueError(
+                "You cannot specify 'user_words' and " +
+                "'tesseract_config[\"user_words_suffix\"]' " +
+                "at the same time")
+        _config['user_words_suffix'] = 'user-words'
+
+    if user_patterns:
+        if 'user_patterns_suffix' in _config:
+            raise ValueError(
+                "You cannot specify 'user_patterns' and " +
+                "'tesseract_config[\"user_patterns_suffix\"]' " +
+                "at the same time")
+        _config['user_patterns_suffix'] = 'user-patterns'
+
+    if char_whitelist:
+        if 'tessedit_char_whitelist' in _config:
+            raise ValueError(
+                "You cannot specify 'char_whitelist' and " +
+                "'tesseract_config[\"tessedit_char_whitelist\"]' " +
+                "at the same time")
+        _config["tessedit_char_whitelist"] = char_whitelist
+
+    return _config
+
+
+def _make_tessdata_dir(tmp, lang, _config, user_patterns, user_words,
+                       tessdata_suffix, tesseract_version):
+    """Tesseract only reads user-words, user-patterns & config files from its
+    "tessdata" directory, so we create a "tessdata" directory in ``tmp`` with
+    symlinks to the system's tessdata, plus our files.
+
+    Returns the value for ``TESSDATA_PREFIX``.
+    """
+    tessdata_dir = tmp + '/tessdata'
+    os.mkdir(tessdata_dir)
+    _symlink_copy_dir(_find_tessdata_dir(tessdata_suffix), tmp)
+
+    if user_words:
+        with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(to_unicode(x) for x in user_words))
+
+    if user_patterns:
+        with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(to_unicode(x) for x in user_patterns))
+
+    if _config:
+        with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
+            cfg.write(_tesseract_config_file(_config))
+
+    tessdata_prefix = tmp + '/'
+    if tesseract_version >= LooseVersion("4.0.0"):
+        tessdata_prefix += "tessdata"
+    return tessdata_prefix
+
+
+def _tesseract_config_file(_config):
+    lines = []
+    for k, v in _config.items():
+        if isinstance(v, bool):
+            lines.append('%s %s\n' % (k, 'T' if v else 'F'))
+        else:
+            lines.append("%s %s\n" % (k, to_unicode(v)))
+    return "".join(lines)
+
+
+# Maximum number of tessdata directories (see `_make_tessdata_dir`) to keep.
+_TESSDATA_CACHE_SIZE = 32
+# {key: _TessdataDir} in least-recently-used order.
+_tessdata_cache = OrderedDict()
+_tessdata_cache_lock = threading.Lock()
+
+
+class _TessdataDir(object):
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.users = 0
+        self.evicted = False
+
+
+@contextmanager
+def _tessdata_prefix(lang, _config, user_patterns, user_words,
+                     tessdata_suffix, tesseract_version):
+    """Yields the ``TESSDATA_PREFIX`` of a tessdata directory created by
+    `_make_tessdata_dir`. We keep these directories in an LRU cache, so that
+    we create one for each distinct set of parameters instead of one for
+    each `ocr` call. A directory is deleted when it has been evicted from
+    the cache and nobody is using it.
+    """
+    key = (lang, _tesseract_config_file(_config),
+           tuple(to_unicode(x) for x in user_patterns or ()),
+           tuple(to_unicode(x) for x in user_words or ()),
+           tessdata_suffix)
+    with _tessdata_cache_lock:
+        tessdata = _tessdata_cache.pop(key, None)
+        if tessdata is None:
+            # $XDG_RUNTIME_DIR is likely to be on tmpfs:
+            path = tempfile.mkdtemp(
+                prefix='stbt-ocr-', dir=os.environ.get("XDG_RUNTIME_DIR"))
+            try:
+                tessdata = _TessdataDir(path, _make_tessdata_dir(
+                    path, lang, _config, user_patterns, user_words,
+                    tessdata_suffix, tesseract_version))
+            except Exception:
+                shutil.rmtree(path, ignore_errors=True)
+                raise
+        _tessdata_cache[key] = tessdata
+        tessdata.users += 1
+        while len(_tessdata_cache) > _TESSDATA_CACHE_SIZE:
+            _, old = _tessdata_cache.popitem(last=False)
+            old.evicted = True
+            if old.users == 0:
+                shutil.rmtree(old.path, ignore_errors=True)
+    try:
+        yield tessdata.prefix
+    finally:
+        with _tessdata_cache_lock:
+            tessdata.users -= 1
+            if tessdata.evicted and tessdata.users == 0:
+                shutil.rmtree(tessdata.path, ignore_errors=True)
+
+
+@atexit.register
+def _clear_tessdata_cache():
+    with _tessdata_cache_lock:
+        for tessdata in _tessdata_cache.values():
+            shutil.rmtree(tessdata.path, ignore_errors=True)
+        _tessdata_cache.clear()
+
+
+@contextmanager
+def _noop_contextmanager():
+    yield None
+
+
+_libtesseract_available = None
+
+
+def _use_libtesseract(mode, tesseract_version):
+    """Whether we can run Tesseract in the stbt process (see
+    `_stbt.libtesseract`) instead of running the ``tesseract`` command. We
+    fall back to the ``tesseract`` command if libtesseract isn't installed,
+    or if it's a different version.
+    """
+    global _libtesseract_available
+
+    if not get_config("ocr", "in_process", type_=bool):
+        return False
+    if mode in (OcrMode.ORIENTATION_AND_SCRIPT_DETECTION_ONLY,
+                OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD_OR_OCR):
+        # The `tesseract` command doesn't run the OCR engine in these modes.
+        return False
+
+    if _libtesseract_available is None:
+        try:
+            lib_version = LooseVersion(libtesseract.version())
+        except (OSError, AttributeError) as e:
+            debug("Running the tesseract command for OCR because "
+                  "libtesseract isn't available: %s" % e)
+            _libtesseract_available = False
+        else:
+            if tesseract_version < LooseVersion("4.0"):
+                debug("Running the tesseract command for OCR because "
+                      "libtesseract %s is too old" % lib_version)
+                _libtesseract_available = False
+            elif lib_version != tesseract_version:
+                debug("Running the tesseract command for OCR because "
+                      "libtesseract %s is a different version to the "
+                      "tesseract command (%s)"
+                      % (lib_version, tesseract_version))
+                _libtesseract_available = False
+            else:
+                _libtesseract_available = True
+    return _libtesseract_available
+
+
+class _TesseractInstance(object):
+    """A `libtesseract.TessBaseAPI` (which has loaded the language data), so
+    that we can re-use it for many `ocr` calls with the same parameters.
+    """
+    def __init__(self, lang, engine, _config, user_patterns, user_words,
+                 tesseract_version):
+        self.tmp = None
+        if _config or user_words or user_patterns:
+            tessdata = _tessdata_prefix(lang, _config, user_patterns,
+                                        user_words, '', tesseract_version)
+        else:
+            tessdata = _noop_contextmanager()
+        # Tesseract only reads the tessdata directory during initialisation.
+        with tessdata as tessdata_prefix:
+            self.api = libtesseract.TessBaseAPI(
+                tessdata_prefix, lang, int(engine),
+                configs=['stbtester'] if _config else [])
+        # For Tesseract's output. $XDG_RUNTIME_DIR is likely to be on tmpfs:
+        self.tmp = tempfile.mkdtemp(
+            prefix='stbt-ocr-', dir=os.environ.get("XDG_RUNTIME_DIR", None))
+
+    def __del__(self):
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def recognize(self, frame, mode, hocr):
+        outputbase = self.tmp + '/output'
+        self.api.recognize(frame, mode, outputbase, hocr)
+        with open(outputbase + (".hocr" if hocr else ".txt")) as f:
+            return f.read()
+
+
+# Maximum number of distinct (lang, engine, config, ...) parameters to keep
+# warm `_TesseractInstance`s for.
+_TESSERACT_CACHE_SIZE = 8
+# {key: [idle _TesseractInstance, ...]} in least-recently-used order.
+_tesseract_cache = OrderedDict()
+_tesseract_cache_lock = threading.Lock()
+
+
+@contextmanager
+def _tesseract_instance(lang, engine, _config, user_patterns, user_words,
+                        tesseract_version):
+    """Checks out a warm `_TesseractInstance` for the given parameters from
+    an LRU cache, so that each thread (see ``[ocr] workers``) has its own
+    instance. A new instance is created if all the instances for these
+    parameters are in use.
+    """
+    key = (lang, int(engine), _tesseract_config_file(_config),
+           tuple(to_unicode(x) for x in user_patterns or ()),
+           tuple(to_unicode(x) for x in user_words or ()))
+    with _tesseract_cache_lock:
+        idle = _tesseract_cache.pop(key, [])
+        _tesseract_cache[key] = idle
+        while len(_tesseract_cache) > _TESSERACT_CACHE_SIZE:
+            _tesseract_cache.popitem(last=False)
+        tesseract = idle.pop() if idle else None
+    if tesseract is None:
+        # Not holding the lock, because this loads the language data.
+        tesseract = _TesseractInstance(
+            lang, engine, _config, user_patterns, user_words,
+            tesseract_version)
+    try:
+        yield tesseract
+    finally:
+        with _tesseract_cache_lock:
+            idle = _tesseract_cache.get(key)
+            if idle is not None:  # Otherwise it has been evicted
+                idle.append(tesseract)
+
+
+@atexit.register
+def _clear_tesseract_cache():
+    with _tesseract_cache_lock:
+        _tesseract_cache.clear()
+
+
+# Maximum number of images preprocessed by `_preprocess` to keep.
+_PREPROCESS_CACHE_SIZE = 16
+# {key: preprocessed image} in least-recently-used order.
+_preprocess_cache = OrderedDict()
+_preprocess_cache_lock = threading.Lock()
+
+
+def _preprocess(frame, region, upsample, text_color, text_color_threshold,
+                imglog):
+    """Crops ``frame`` to ``region`` and, if ``text_color`` is given,
+    upsamples it & binarises it according to its distance from
+    ``text_color``.
+
+    Returns the image & whether it still needs upsampling.
+
+    Test scripts typically read the same region of many consecutive frames
+    (for example in `wait_until`), and the region often doesn't change, so we
+    keep the most recent results in an LRU cache keyed by a hash of the
+    region's pixels.
+    """
+    frame = crop(frame, region)
+    if text_color is None:
+        return frame, upsample
+
+    if imglog.enabled or Xxhash64 is None:
+        # The debug images are a side-effect that the cache can't reproduce.
+        return _text_color_mask(frame, upsample, text_color,
+                                text_color_threshold, imglog), False
+
+    h = Xxhash64()
+    h.update(numpy.ascontiguousarray(frame).data)
+    key = (h.digest(), frame.shape, tuple(int(x) for x in text_color),
+           text_color_threshold, bool(upsample))
+    with _preprocess_cache_lock:
+        out = _preprocess_cache.pop(key, None)
+        if out is not None:
+            _preprocess_cache[key] = out
+            return out, False
+
+    out = _text_color_mask(frame, upsample, text_color, text_color_threshold,
+                           imglog)
+    # The same image may be returned to several callers, so it mustn't be
+    # modified:
+    out.flags.writeable = False
+    with _preprocess_cache_lock:
+        _preprocess_cache[key] = out
+        while len(_preprocess_cache) > _PREPROCESS_CACHE_SIZE:
+            _preprocess_cache.popitem(last=False)
+    return out, False
+
+
+# The square of each possible difference between 2 uint8 values.
+_SQUARES = numpy.arange(256, dtype=numpy.float32).reshape(1, 256, 1) ** 2
+
+
+def _text_color_mask(frame, upsample, text_color, text_color_threshold,
+                     imglog):
+    if upsample:
+        # Bilinear interpolation followed by our (non-linear) threshold isn't
+        # the same as the threshold followed by interpolation, so we have to
+        # upsample first.
+        frame = _upsample(frame, imglog)
+
+    # We discard every pixel whose distance from `text_color` (the RMS of the
+    # differences of each channel, rounded down) is more than
+    # `text_color_threshold`. That is:
+    #
+    #     floor(sqrt((db² + dg² + dr²) // 3)) > threshold
+    #
+    # which is the same as:
+    #
+    #     db² + dg² + dr² >= 3 * (threshold + 1)²
+    #
+    # so we don't need the square root. This needs an integer threshold: The
+    # distance is an integer, so "> threshold" is the same as "> floor(
+    # threshold)" (`cv2.threshold` also rounds the threshold down for 8-bit
+    # images). All these values are integers smaller than 2²⁴ so float32 is
+    # exact.
+    threshold = int(math.floor(text_color_threshold))
+    # OpenCV only accepts python numbers in a scalar, not numpy integers
+    # (for example if `text_color` is a pixel of a frame):
+    diff = cv2.absdiff(frame, tuple(int(x) for x in text_color) + (0,))
+    squared_distance = cv2.transform(cv2.LUT(diff, _SQUARES),
+                                     numpy.ones((1, 3), dtype=numpy.float32))
+    if imglog.enabled:
+        imglog.imwrite("text_color_difference",
+                       numpy.sqrt(squared_distance // 3).astype(numpy.uint8))
+    frame = cv2.compare(squared_distance,
+                        3 * max(threshold + 1, 0) ** 2,
+                        cv2.CMP_GE)
+    imglog.imwrite("text_color_threshold", frame)
+    return frame
+
+
 def _upsample(frame, imglog):
     # We scale image up 3x before feeding it to tesseract as this
     # significantly reduces the error rate by more than 6x in tests.  This
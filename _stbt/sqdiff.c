@@ -1,5 +1,14 @@
 #include <stdint.h>
 #include <assert.h>
+#include <pthread.h>
+
+#if defined(__SSE2__)
+#include <emmintrin.h>
+#endif
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define HAVE_AVX2_DISPATCH 1
+#endif
 
 enum PixelDepth {
     PIXEL_DEPTH_U8 = 0,
@@ -8,22 +17,125 @@ enum PixelDepth {
     PIXEL_DEPTH_BGRA = 3,
 };
 
-static uint32_t sqdiff_U8(
-    const unsigned char* a, const unsigned char* b,
-    uint16_t len_px);
-static uint32_t sqdiff_BGRx(
-    const unsigned char* t, const unsigned char* f,
-    uint16_t len_px);
-static uint32_t sqdiff_BGRA(
-    uint32_t *count,
-    const unsigned char* t, const unsigned char* f,
-    uint16_t len_px);
-
 typedef struct _SqdiffResult {
     uint64_t total;
     uint32_t count;
 } SqdiffResult;
 
+/* Each of these calculates the square difference of a single row of len_px
+ * pixels, adding the number of non-transparent pixels to *count (BGRA only).
+ */
+typedef uint64_t (*SqdiffRowFn)(uint32_t *count,
+                                const uint8_t* t, const uint8_t* f,
+                                uint32_t len_px);
+
+SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+                            const uint8_t *f, uint32_t f_stride,
+                            uint32_t width_px, uint32_t height_px,
+                            int color_depth, int max_threads,
+                            uint64_t max_total);
+static uint64_t sqdiff_U8(uint32_t *count,
+                          const uint8_t* a, const uint8_t* b, uint32_t len);
+static uint64_t sqdiff_BGRx(uint32_t *count,
+                            const uint8_t* t, const uint8_t* f, uint32_t len);
+static uint64_t sqdiff_BGRA(uint32_t *count,
+                            const uint8_t* t, const uint8_t* f, uint32_t len);
+#if defined(__SSE2__)
+static uint64_t sqdiff_U8_sse2(uint32_t *count,
+                               const uint8_t* a, const uint8_t* b,
+                               uint32_t len);
+#endif
+#if defined(HAVE_AVX2_DISPATCH)
+static uint64_t sqdiff_U8_avx2(uint32_t *count,
+                               const uint8_t* a, const uint8_t* b,
+                               uint32_t len);
+static uint64_t sqdiff_BGRx_avx2(uint32_t *count,
+                                 const uint8_t* t, const uint8_t* f,
+                                 uint32_t len);
+static uint64_t sqdiff_BGRA_avx2(uint32_t *count,
+                                 const uint8_t* t, const uint8_t* f,
+                                 uint32_t len);
+#endif
+
+/* Don't start a thread for less than this many bytes of frame. Starting a
+ * thread costs tens of microseconds, which is about the time it takes to
+ * process this much data. */
+#define MIN_BYTES_PER_THREAD (512 * 1024)
+
+typedef struct _SqdiffJob {
+    SqdiffRowFn row_fn;
+    const uint8_t *t;
+    uint32_t t_stride;
+    const uint8_t *f;
+    uint32_t f_stride;
+    uint32_t width;
+    uint32_t height;
+    uint64_t max_total;
+    /* Shared between the jobs, so they can all stop once one of them has
+     * exceeded max_total. */
+    int *exceeded;
+    SqdiffResult result;
+} SqdiffJob;
+
+static void *sqdiff_rows(void *arg)
+{
+    SqdiffJob *job = arg;
+    for (uint32_t y = 0; y < job->height; y++) {
+        job->result.total += job->row_fn(
+            &job->result.count,
+            job->t + (uint64_t) y * job->t_stride,
+            job->f + (uint64_t) y * job->f_stride,
+            job->width);
+        if (job->result.total > job->max_total) {
+            __atomic_store_n(job->exceeded, 1, __ATOMIC_RELAXED);
+            break;
+        }
+        if (__atomic_load_n(job->exceeded, __ATOMIC_RELAXED))
+            break;
+    }
+    return NULL;
+}
+
+static SqdiffRowFn select_row_fn(int color_depth, uint32_t *width)
+{
+    int avx2 = 0;
+#if defined(HAVE_AVX2_DISPATCH)
+    avx2 = __builtin_cpu_supports("avx2");
+#endif
+
+    switch (color_depth) {
+    case PIXEL_DEPTH_BGR:
+        /* BGR is the same as U8, but 3 times as wide */
+        *width *= 3;
+        /* fall through */
+    case PIXEL_DEPTH_U8:
+#if defined(HAVE_AVX2_DISPATCH)
+        if (avx2)
+            return sqdiff_U8_avx2;
+#endif
+#if defined(__SSE2__)
+        return sqdiff_U8_sse2;
+#else
+        return sqdiff_U8;
+#endif
+    case PIXEL_DEPTH_BGRx:
+#if defined(HAVE_AVX2_DISPATCH)
+        if (avx2)
+            return sqdiff_BGRx_avx2;
+#endif
+        return sqdiff_BGRx;
+    case PIXEL_DEPTH_BGRA:
+#if defined(HAVE_AVX2_DISPATCH)
+        if (avx2)
+            return sqdiff_BGRA_avx2;
+#endif
+        return sqdiff_BGRA;
+    default:
+        assert(0);
+        return NULL;
+    }
+}
+
 /* Computes the square difference between template t and frame f and counts
  * the number of pixels not masked.
  *
@@ -38,13 +150,35 @@ typedef struct _SqdiffResult {
  * t_stride and f_stride are the strides between lines measured in bytes for
  * t and f respectively.
  *
+ * The rows are split between up to max_threads threads (including the calling
+ * thread) if the template is large enough to make that worthwhile.
+ *
  * Returns a struct with the total square difference and count of
  * non-transparent pixels.
  */
-SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
-                    const uint8_t *f, uint16_t f_stride,
-                    uint16_t width_px, uint16_t height_px,
-                    int color_depth)
+SqdiffResult sqdiff(const uint8_t *t, uint32_t t_stride,
+                    const uint8_t *f, uint32_t f_stride,
+                    uint32_t width_px, uint32_t height_px,
+                    int color_depth, int max_threads)
+{
+    return sqdiff_bounded(t, t_stride, f, f_stride, width_px, height_px,
+                          color_depth, max_threads, UINT64_MAX);
+}
+
+/* The same as sqdiff, but gives up as soon as the total square difference
+ * exceeds max_total. In that case the returned total is greater than
+ * max_total but it only covers the rows processed so far, and the returned
+ * count is 0.
+ *
+ * This is for when we only need to know whether the template matches: For a
+ * frame that is very different from the template we'll only have to look at
+ * a few rows.
+ */
+SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+                            const uint8_t *f, uint32_t f_stride,
+                            uint32_t width_px, uint32_t height_px,
+                            int color_depth, int max_threads,
+                            uint64_t max_total)
 {
     assert(width_px > 0 && height_px > 0);
 
@@ -53,44 +187,88 @@ SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
     switch (color_depth) {
     case PIXEL_DEPTH_U8:
         assert(f_stride >= width_px && t_stride >= width_px);
-        out.count = width_px * height_px;
-        for (uint16_t y = 0; y < height_px; y++)
-            out.total += sqdiff_U8(
-                t + y * t_stride, f + y * f_stride, width_px);
         break;
     case PIXEL_DEPTH_BGR:
         assert(f_stride >= width_px * 3 && t_stride >= width_px * 3);
-        out.count = width_px * height_px * 3;
-        for (uint16_t y = 0; y < height_px; y++)
-            out.total += sqdiff_U8(
-                t + y * t_stride, f + y * f_stride, width_px * 3);
         break;
     case PIXEL_DEPTH_BGRx:
+    case PIXEL_DEPTH_BGRA:
         assert(f_stride >= width_px * 3 && t_stride >= width_px * 4);
+        break;
+    default:
+        assert(0);
+    }
+
+    uint32_t width = width_px;
+    SqdiffRowFn row_fn = select_row_fn(color_depth, &width);
+
+    uint64_t bytes = (uint64_t) width_px * height_px *
+                     (color_depth == PIXEL_DEPTH_U8 ? 1 : 3);
+    uint64_t n_threads = bytes / MIN_BYTES_PER_THREAD;
+    if (n_threads > (uint64_t) max_threads)
+        n_threads = max_threads;
+    if (n_threads > height_px)
+        n_threads = height_px;
+    if (n_threads < 1)
+        n_threads = 1;
+
+    int exceeded = 0;
+    SqdiffJob jobs[n_threads];
+    pthread_t threads[n_threads];
+    int started[n_threads];
+    uint32_t y = 0;
+    for (uint32_t i = 0; i < n_threads; i++) {
+        uint32_t rows = (height_px - y) / (n_threads - i);
+        SqdiffJob job = {row_fn,
+                         t + (uint64_t) y * t_stride, t_stride,
+                         f + (uint64_t) y * f_stride, f_stride,
+                         width, rows, max_total, &exceeded, {0, 0}};
+        jobs[i] = job;
+        y += rows;
+    }
+    /* Job 0 runs on this thread. If we can't start a thread we run its job
+     * on this thread too. */
+    for (uint32_t i = 1; i < n_threads; i++)
+        started[i] = pthread_create(&threads[i], NULL, sqdiff_rows,
+                                    &jobs[i]) == 0;
+    sqdiff_rows(&jobs[0]);
+    for (uint32_t i = 1; i < n_threads; i++) {
+        if (started[i])
+            pthread_join(threads[i], NULL);
+        else
+            sqdiff_rows(&jobs[i]);
+    }
+
+    for (uint32_t i = 0; i < n_threads; i++) {
+        out.total += jobs[i].result.total;
+        out.count += jobs[i].result.count;
+    }
+    if (exceeded) {
+        out.count = 0;
+        return out;
+    }
+
+    switch (color_depth) {
+    case PIXEL_DEPTH_U8:
+        out.count = width_px * height_px;
+        break;
+    case PIXEL_DEPTH_BGR:
+    case PIXEL_DEPTH_BGRx:
         out.count = width_px * height_px * 3;
-        for (uint16_t y = 0; y < height_px; y++)
-            out.total += sqdiff_BGRx(
-                t + y * t_stride, f + y * f_stride, width_px);
         break;
     case PIXEL_DEPTH_BGRA:
-        assert(f_stride >= width_px * 3 && t_stride >= width_px * 4);
-        out.count = 0;
-        for (uint16_t y = 0; y < height_px; y++)
-            out.total += sqdiff_BGRA(
-                &out.count, t + y * t_stride, f + y * f_stride, width_px);
         out.count *= 3;
         break;
-    default:
-        assert(0);
     }
     return out;
 }
 
-static uint32_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
-                          uint16_t len)
+static uint64_t sqdiff_U8(uint32_t *count,
+                          const uint8_t* a, const uint8_t* b, uint32_t len)
 {
-    uint32_t this_total = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    (void) count;
+    uint64_t this_total = 0;
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff = a[n] - b[n];
         uint16_t sqdiff = diff * diff;
         this_total += sqdiff;
@@ -98,11 +276,12 @@ static uint32_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
     return this_total;
 }
 
-static uint32_t sqdiff_BGRx(const unsigned char* t, const unsigned char* f,
-                            uint16_t len)
+static uint64_t sqdiff_BGRx(uint32_t *count,
+                            const uint8_t* t, const uint8_t* f, uint32_t len)
 {
-    uint32_t this_total = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    (void) count;
+    uint64_t this_total = 0;
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff_b = t[0] - f[0];
         int16_t diff_g = t[1] - f[1];
         int16_t diff_r = t[2] - f[2];
@@ -114,13 +293,12 @@ static uint32_t sqdiff_BGRx(const unsigned char* t, const unsigned char* f,
     return this_total;
 }
 
-static uint32_t sqdiff_BGRA(uint32_t *count,
-                            const unsigned char* t, const unsigned char* f,
-                            uint16_t len)
+static uint64_t sqdiff_BGRA(uint32_t *count,
+                            const uint8_t* t, const uint8_t* f, uint32_t len)
 {
-    uint32_t this_total = 0;
-    uint16_t this_count = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    uint64_t this_total = 0;
+    uint32_t this_count = 0;
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff_b = t[0] - f[0];
         int16_t diff_g = t[1] - f[1];
         int16_t diff_r = t[2] - f[2];
@@ -137,3 +315,167 @@ static uint32_t sqdiff_BGRA(uint32_t *count,
     *count += this_count;
     return this_total;
 }
+
+/* The SIMD implementations accumulate into 32-bit lanes. Each iteration adds
+ * at most 4 * 255^2 to each lane, so we move the lanes into a 64-bit total
+ * every ACCUMULATE_ITERATIONS iterations, before they can overflow. */
+#define ACCUMULATE_ITERATIONS 4096
+
+#if defined(__SSE2__)
+
+static uint64_t hsum_epi32_sse2(__m128i v)
+{
+    uint32_t lanes[4];
+    _mm_storeu_si128((__m128i*) lanes, v);
+    return (uint64_t) lanes[0] + lanes[1] + lanes[2] + lanes[3];
+}
+
+static uint64_t sqdiff_U8_sse2(uint32_t *count,
+                               const uint8_t* a, const uint8_t* b,
+                               uint32_t len)
+{
+    const __m128i zero = _mm_setzero_si128();
+    uint64_t this_total = 0;
+    uint32_t n = 0;
+    while (n + 16 <= len) {
+        __m128i acc = _mm_setzero_si128();
+        for (uint32_t i = 0; i < ACCUMULATE_ITERATIONS && n + 16 <= len;
+                i++, n += 16) {
+            __m128i va = _mm_loadu_si128((const __m128i*)(a + n));
+            __m128i vb = _mm_loadu_si128((const __m128i*)(b + n));
+            __m128i lo = _mm_sub_epi16(_mm_unpacklo_epi8(va, zero),
+                                       _mm_unpacklo_epi8(vb, zero));
+            __m128i hi = _mm_sub_epi16(_mm_unpackhi_epi8(va, zero),
+                                       _mm_unpackhi_epi8(vb, zero));
+            acc = _mm_add_epi32(acc, _mm_madd_epi16(lo, lo));
+            acc = _mm_add_epi32(acc, _mm_madd_epi16(hi, hi));
+        }
+        this_total += hsum_epi32_sse2(acc);
+    }
+    return this_total + sqdiff_U8(count, a + n, b + n, len - n);
+}
+
+#endif /* __SSE2__ */
+
+#if defined(HAVE_AVX2_DISPATCH)
+
+__attribute__((target("avx2")))
+static uint64_t hsum_epi32_avx2(__m256i v)
+{
+    uint32_t lanes[8];
+    _mm256_storeu_si256((__m256i*) lanes, v);
+    uint64_t total = 0;
+    for (int i = 0; i < 8; i++)
+        total += lanes[i];
+    return total;
+}
+
+/* Square difference of 32 bytes, as 8 32-bit lanes */
+__attribute__((target("avx2")))
+static inline __m256i sqdiff_32_avx2(__m256i a, __m256i b)
+{
+    __m256i lo = _mm256_sub_epi16(
+        _mm256_cvtepu8_epi16(_mm256_castsi256_si128(a)),
+        _mm256_cvtepu8_epi16(_mm256_castsi256_si128(b)));
+    __m256i hi = _mm256_sub_epi16(
+        _mm256_cvtepu8_epi16(_mm256_extracti128_si256(a, 1)),
+        _mm256_cvtepu8_epi16(_mm256_extracti128_si256(b, 1)));
+    return _mm256_add_epi32(_mm256_madd_epi16(lo, lo),
+                            _mm256_madd_epi16(hi, hi));
+}
+
+__attribute__((target("avx2")))
+static uint64_t sqdiff_U8_avx2(uint32_t *count,
+                               const uint8_t* a, const uint8_t* b,
+                               uint32_t len)
+{
+    uint64_t this_total = 0;
+    uint32_t n = 0;
+    while (n + 32 <= len) {
+        __m256i acc = _mm256_setzero_si256();
+        for (uint32_t i = 0; i < ACCUMULATE_ITERATIONS && n + 32 <= len;
+                i++, n += 32) {
+            acc = _mm256_add_epi32(acc, sqdiff_32_avx2(
+                _mm256_loadu_si256((const __m256i*)(a + n)),
+                _mm256_loadu_si256((const __m256i*)(b + n))));
+        }
+        this_total += hsum_epi32_avx2(acc);
+    }
+    return this_total + sqdiff_U8(count, a + n, b + n, len - n);
+}
+
+/* Loads 8 BGR pixels (24 bytes) from f and expands them to BGR0. Reads 28
+ * bytes, so the caller must make sure that's in bounds. */
+__attribute__((target("avx2")))
+static inline __m256i load_BGR_as_BGRx_avx2(const uint8_t* f)
+{
+    const __m256i shuffle = _mm256_setr_epi8(
+        0, 1, 2, -1, 3, 4, 5, -1, 6, 7, 8, -1, 9, 10, 11, -1,
+        0, 1, 2, -1, 3, 4, 5, -1, 6, 7, 8, -1, 9, 10, 11, -1);
+    __m256i v = _mm256_inserti128_si256(
+        _mm256_castsi128_si256(_mm_loadu_si128((const __m128i*) f)),
+        _mm_loadu_si128((const __m128i*)(f + 12)), 1);
+    return _mm256_shuffle_epi8(v, shuffle);
+}
+
+/* We process 8 pixels per iteration, but read 28 bytes = 9.33 pixels of the
+ * frame, so we stop the vectorised loop this many pixels before the end of
+ * the row. */
+#define BGR_OVERREAD_PX 2
+
+__attribute__((target("avx2")))
+static uint64_t sqdiff_BGRx_avx2(uint32_t *count,
+                                 const uint8_t* t, const uint8_t* f,
+                                 uint32_t len)
+{
+    const __m256i bgr_mask = _mm256_set1_epi32(0x00ffffff);
+    uint64_t this_total = 0;
+    uint32_t n = 0;
+    while (n + 8 + BGR_OVERREAD_PX <= len) {
+        __m256i acc = _mm256_setzero_si256();
+        for (uint32_t i = 0;
+                i < ACCUMULATE_ITERATIONS && n + 8 + BGR_OVERREAD_PX <= len;
+                i++, n += 8) {
+            __m256i vt = _mm256_and_si256(
+                _mm256_loadu_si256((const __m256i*)(t + n * 4)), bgr_mask);
+            __m256i vf = load_BGR_as_BGRx_avx2(f + n * 3);
+            acc = _mm256_add_epi32(acc, sqdiff_32_avx2(vt, vf));
+        }
+        this_total += hsum_epi32_avx2(acc);
+    }
+    return this_total + sqdiff_BGRx(count, t + n * 4, f + n * 3, len - n);
+}
+
+__attribute__((target("avx2")))
+static uint64_t sqdiff_BGRA_avx2(uint32_t *count,
+                                 const uint8_t* t, const uint8_t* f,
+                                 uint32_t len)
+{
+    const __m256i bgr_mask = _mm256_set1_epi32(0x00ffffff);
+    const __m256i alpha_mask = _mm256_set1_epi32((int) 0xff000000);
+    uint64_t this_total = 0;
+    uint32_t this_count = 0;
+    uint32_t n = 0;
+    while (n + 8 + BGR_OVERREAD_PX <= len) {
+        __m256i acc = _mm256_setzero_si256();
+        for (uint32_t i = 0;
+                i < ACCUMULATE_ITERATIONS && n + 8 + BGR_OVERREAD_PX <= len;
+                i++, n += 8) {
+            __m256i vt = _mm256_loadu_si256((const __m256i*)(t + n * 4));
+            /* All ones for pixels where alpha == 255 */
+            __m256i present = _mm256_cmpeq_epi32(
+                _mm256_and_si256(vt, alpha_mask), alpha_mask);
+            __m256i vf = _mm256_and_si256(load_BGR_as_BGRx_avx2(f + n * 3),
+                                          present);
+            vt = _mm256_and_si256(_mm256_and_si256(vt, bgr_mask), present);
+            acc = _mm256_add_epi32(acc, sqdiff_32_avx2(vt, vf));
+            this_count += __builtin_popcount(
+                _mm256_movemask_ps(_mm256_castsi256_ps(present)));
+        }
+        this_total += hsum_epi32_avx2(acc);
+    }
+    *count += this_count;
+    return this_total + sqdiff_BGRA(count, t + n * 4, f + n * 3, len - n);
+}
+
+#endif /* HAVE_AVX2_DISPATCH */
@@ -23,66 +23,113 @@ class _SqdiffResult(ctypes.Structure):
                 ("count", ctypes.c_uint32)]
 
 
-# SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
-#                     const uint8_t *f, uint16_t f_stride,
-#                     uint16_t width_px, uint16_t height_px,
-#                     int color_depth)
+# SqdiffResult sqdiff(const uint8_t *t, uint32_t t_stride,
+#                     const uint8_t *f, uint32_t f_stride,
+#                     uint32_t width_px, uint32_t height_px,
+#                     int color_depth, int max_threads)
 
 _libstbt.sqdiff.restype = _SqdiffResult
 _libstbt.sqdiff.argtypes = [
-    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
-    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
-    ctypes.c_uint16, ctypes.c_uint16,
-    ctypes.c_int
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.c_uint32, ctypes.c_uint32,
+    ctypes.c_int, ctypes.c_int
+]
+
+# SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+#                             const uint8_t *f, uint32_t f_stride,
+#                             uint32_t width_px, uint32_t height_px,
+#                             int color_depth, int max_threads,
+#                             uint64_t max_total)
+
+_libstbt.sqdiff_bounded.restype = _SqdiffResult
+_libstbt.sqdiff_bounded.argtypes = [
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.c_uint32, ctypes.c_uint32,
+    ctypes.c_int, ctypes.c_int,
+    ctypes.c_uint64
 ]
 
 
+PIXEL_DEPTH_U8 = 0
 PIXEL_DEPTH_BGR = 1
 PIXEL_DEPTH_BGRx = 2
 PIXEL_DEPTH_BGRA = 3
 
+# (template pixel stride, template channels, frame channels) -> color_depth
 COLOR_DEPTH_LOOKUP = {
-    (3, 3): PIXEL_DEPTH_BGR,
-    (4, 3): PIXEL_DEPTH_BGRx,
-    (4, 4): PIXEL_DEPTH_BGRA,
+    (1, 1, 1): PIXEL_DEPTH_U8,
+    (3, 3, 3): PIXEL_DEPTH_BGR,
+    (4, 3, 3): PIXEL_DEPTH_BGRx,
+    (4, 4, 3): PIXEL_DEPTH_BGRA,
 }
 
 
-def sqdiff(template, frame):
+def sqdiff(template, frame, threads=1, max_total=None):
+    """Returns the total square difference between ``template`` and
+    ``frame``, and the number of values that contributed to it (pixels x
+    channels, excluding pixels that are transparent in ``template``).
+
+    Large images are split into horizontal stripes that are processed by up to
+    ``threads`` threads.
+
+    If ``max_total`` is given we may stop as soon as the total exceeds it. In
+    that case the total returned is greater than ``max_total`` but it isn't
+    the total for the whole image, and the count is meaningless.
+    """
     if template.shape[:2] != frame.shape[:2]:
         raise ValueError("Template and frame must be the same size")
     try:
-        return _sqdiff_c(template, frame)
+        return _sqdiff_c(template, frame, threads, max_total)
     except NotImplementedError as e:
         debug("sqdiff Missed fast-path: %s" % e)
         return _sqdiff_numpy(template, frame)
 
 
-def _sqdiff_c(template, frame):
+def _sqdiff_c(template, frame, threads=1, max_total=None):
     if template.dtype != numpy.uint8 or frame.dtype != numpy.uint8:
         raise NotImplementedError("dtype must be uint8")
 
+    if template.strides[0] < 0 or frame.strides[0] < 0 or \
+            max(template.strides[0], frame.strides[0]) >= 2 ** 32:
+        raise NotImplementedError("Row stride must fit in uint32")
+
     if frame.strides[2] != 1 or template.strides[2] != 1 or \
-            frame.strides[1] != 3:
+            frame.strides[1] != frame.shape[2]:
         raise NotImplementedError("Pixel data must be contiguous")
 
-    color_depth = COLOR_DEPTH_LOOKUP[(template.strides[1], template.shape[2])]
+    try:
+        color_depth = COLOR_DEPTH_LOOKUP[
+            (template.strides[1], template.shape[2], frame.shape[2])]
+    except KeyError:
+        raise NotImplementedError(
+            "Unsupported pixel layout: template %r with strides %r, frame %r"
+            % (template.shape, template.strides, frame.shape))
 
     t = template.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
     f = frame.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
 
-    out = _libstbt.sqdiff(t, template.strides[0],
-                          f, frame.strides[0],
-                          template.shape[1], template.shape[0], color_depth)
+    if max_total is None:
+        out = _libstbt.sqdiff(t, template.strides[0],
+                              f, frame.strides[0],
+                              template.shape[1], template.shape[0],
+                              color_depth, threads)
+    else:
+        out = _libstbt.sqdiff_bounded(t, template.strides[0],
+                                      f, frame.strides[0],
+                                      template.shape[1], template.shape[0],
+                                      color_depth, threads,
+                                      max(0, int(max_total)))
     return out.total, out.count
 
 
 def _sqdiff_numpy(template, frame):
     template = template.astype(numpy.int64)
     frame = frame.astype(numpy.int64)
-    if template.shape[2] == 4:
+    if template.shape[2] in (2, 4):
         # Masked
-        x = ((template[:, :, :3] - frame) ** 2)[template[:, :, 3] == 255]
+        x = ((template[:, :, :-1] - frame) ** 2)[template[:, :, -1] == 255]
     else:
         x = (template - frame) ** 2
     return numpy.sum(x), x.size
@@ -144,6 +191,48 @@ def test_sqdiff_c_numpy_equivalence():
             assert (_sqdiff_numpy(t, frame_cropped) ==
                     _sqdiff_c(t, frame_cropped))
 
+        # Greyscale
+        t = numpy.ascontiguousarray(template[:, :, :1])
+        f = frame_cropped[:, :, 1:2].copy()
+        assert _sqdiff_numpy(t, f) == _sqdiff_c(t, f)
+
+
+def test_sqdiff_c_numpy_equivalence_4k():
+    # Rows too wide for the old uint16 strides, large enough to be split
+    # between threads, and odd sizes to exercise the non-SIMD tails.
+    for w, h in [(3840, 2160), (3839, 2161), (17, 3), (1, 1)]:
+        f = numpy.random.randint(0, 256, (h, w, 3), dtype=numpy.uint8)
+        t = numpy.random.randint(0, 256, (h, w, 3), dtype=numpy.uint8)
+        tt = numpy.random.randint(0, 256, (h, w, 4), dtype=numpy.uint8)
+        tt[:, :, 3] = numpy.where(tt[:, :, 3] & 1, 255, 0)
+
+        for template in (t, tt, tt[:, :, :3]):
+            expected = _sqdiff_numpy(template, f)
+            for threads in (1, 4):
+                assert expected == _sqdiff_c(template, f, threads)
+
+
+def test_sqdiff_bounded():
+    for w, h in [(1280, 720), (3840, 2160), (17, 3)]:
+        f = numpy.random.randint(0, 256, (h, w, 3), dtype=numpy.uint8)
+        tt = numpy.random.randint(0, 256, (h, w, 4), dtype=numpy.uint8)
+        tt[:, :, 3] = numpy.where(tt[:, :, 3] & 1, 255, 0)
+
+        for template in (tt[:, :, :3].copy(), tt, tt[:, :, :3]):
+            total, count = _sqdiff_numpy(template, f)
+            for threads in (1, 4):
+                # Within the bound: Same as unbounded
+                assert (total, count) == _sqdiff_c(
+                    template, f, threads, max_total=total)
+                # Exceeds the bound:
+                s, _ = _sqdiff_c(template, f, threads, max_total=total - 1)
+                assert total - 1 < s <= total
+                s, _ = _sqdiff_c(template, f, threads, max_total=0)
+                assert 0 < s <= total
+                if h > 3:
+                    # Stopped early
+                    assert s < total // 2
+
 
 def _make_sqdiff_numba():
     # numba implementation included for the purposes of comparison.
@@ -185,6 +274,42 @@ def _make_sqdiff_numba():
     return _sqdiff_numba
 
 
+def _measure_performance_full_frame(threads=4):
+    """Compares the implementations on whole frames, as used by `stbt.match`'s
+    fast path when the reference image is the same size as the frame.
+    """
+    import timeit
+
+    _sqdiff_numba = _make_sqdiff_numba()
+
+    print("All times in ms")
+    print("type    \tsize       \tnumpy\tnumba\tC\tC (%i threads)" % threads)
+    for size in [(1280, 720), (1920, 1080), (3840, 2160)]:
+        f = numpy.random.randint(0, 256, (size[1], size[0], 3),
+                                 dtype=numpy.uint8)
+        t = numpy.random.randint(0, 256, (size[1], size[0], 3),
+                                 dtype=numpy.uint8)
+        tt = numpy.random.randint(0, 256, (size[1], size[0], 4),
+                                  dtype=numpy.uint8)
+        tt[:, :, 3] = numpy.where(tt[:, :, 3] & 1, 255, 0)
+
+        for l, template in [("template ", t),
+                            ("with mask", tt),
+                            ("unmasked ", tt[:, :, :3])]:
+            # pylint: disable=cell-var-from-loop
+            fns = [lambda: _sqdiff_numpy(template, f),
+                   (lambda: _sqdiff_numba(template, f))
+                   if _sqdiff_numba else None,
+                   lambda: _sqdiff_c(template, f),
+                   lambda: _sqdiff_c(template, f, threads)]
+            times = [min(timeit.repeat(fn, repeat=3, number=5)) / 5
+                     if fn else float('nan')
+                     for fn in fns]
+            print("%s\t%i x %i\t%s" % (
+                l, size[0], size[1],
+                "\t".join("%.2f" % (x * 1000) for x in times)))
+
+
 def _measure_performance():
     import timeit
 
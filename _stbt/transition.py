@@ -250,10 +250,14 @@ class StrictDiff(FrameDiffer):
         if self.mask is not None:
             # We need 3 channels to match `frame`.
             self.mask = cv2.cvtColor(self.mask, cv2.COLOR_GRAY2BGR)
+        # Re-used by each call to `diff`, so that we don't allocate a
+        # frame-sized image for each frame:
+        self._absdiff = None
 
     def diff(self, frame):
         absdiff = cv2.absdiff(crop(self.prev_frame, self.region),
-                              crop(frame, self.region))
+                              crop(frame, self.region), dst=self._absdiff)
+        self._absdiff = absdiff
         if self.mask is not None:
             absdiff = cv2.bitwise_and(absdiff, self.mask, absdiff)
 
@@ -262,12 +266,14 @@ class StrictDiff(FrameDiffer):
         maxdiff = numpy.max(absdiff)
         if maxdiff > 20:
             diffs_found = True
-            big_diffs = absdiff > 20
+            big_diffs = cv2.threshold(absdiff, 20, 255, cv2.THRESH_BINARY,
+                                      dst=absdiff)[1]
             out_region = pixel_bounding_box(big_diffs)
             _ddebug("found %s diffs above 20 (max %s) in %r", frame,
                     numpy.count_nonzero(big_diffs), maxdiff, out_region)
         elif maxdiff > 0:
-            small_diffs = absdiff > 5
+            small_diffs = cv2.threshold(absdiff, 5, 255, cv2.THRESH_BINARY,
+                                        dst=absdiff)[1]
             small_diffs_count = numpy.count_nonzero(small_diffs)
             if small_diffs_count > 50:
                 diffs_found = True
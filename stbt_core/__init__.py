@@ -45,6 +45,9 @@ from _stbt.match import (
     ConfirmMethod,
     match,
     match_all,
+    match_many,
+    MatchEngine,
+    Matcher,
     MatchMethod,
     MatchParameters,
     MatchResult,
@@ -60,7 +63,10 @@ from _stbt.ocr import (
     apply_ocr_corrections,
     match_text,
     ocr,
+    ocr_async,
+    ocr_many,
     OcrEngine,
+    OcrFuture,
     OcrMode,
     set_global_ocr_corrections,
     TextMatchResult)
@@ -107,7 +113,10 @@ __all__ = [to_native_str(x) for x in [
     "load_image",
     "match",
     "match_all",
+    "match_many",
     "match_text",
+    "MatchEngine",
+    "Matcher",
     "MatchMethod",
     "MatchParameters",
     "MatchResult",
@@ -118,7 +127,10 @@ __all__ = [to_native_str(x) for x in [
     "MultiPress",
     "NoVideo",
     "ocr",
+    "ocr_async",
+    "ocr_many",
     "OcrEngine",
+    "OcrFuture",
     "OcrMode",
     "Position",
     "PreconditionError",
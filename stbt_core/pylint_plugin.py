@@ -95,8 +95,8 @@ class StbtChecker(BaseChecker):
                 self.add_message('E7001', node=node, args=os.path.relpath(path))
 
     def visit_call(self, node):
-        if re.search(r"\b(is_screen_black|match|match_text|ocr|press_and_wait|"
-                     r"wait_until)$",
+        if re.search(r"\b(is_screen_black|match|match_many|match_text|ocr|"
+                     r"press_and_wait|wait_until)$",
                      node.func.as_string()):
             if isinstance(node.parent, Expr):
                 for inferred in _infer(node.func):
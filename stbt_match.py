@@ -12,10 +12,16 @@ from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
 
 import argparse
+import csv
+import json
+import multiprocessing
 import sys
+import timeit
+from collections import deque, OrderedDict
 from contextlib import contextmanager
 
 import cv2
+import numpy
 
 import _stbt.logging
 import stbt_core as stbt
@@ -30,7 +36,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.prog = "stbt match"
     parser.description = """Run stbt's image-matching algorithm against a single
-        frame (which you can capture using `stbt screenshot`)."""
+        frame (which you can capture using `stbt screenshot`), or against
+        every frame of a video file."""
     parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="Dump image processing debug images to ./stbt-debug directory")
@@ -38,10 +45,34 @@ def main():
         "--all", action="store_true",
         help='Use "stbt.match_all" instead of "stbt.match"')
     parser.add_argument(
-        "source_file", help="""The screenshot to compare against (you can
-            capture it using 'stbt screenshot')""")
+        "--video", action="store_true",
+        help="""source_file is a video file (for example a recording of a soak
+            test). Search every frame of the video, and print a row for each
+            frame (or, with --all, for each match) in the format given by
+            --format""")
     parser.add_argument(
-        "reference_file", help="The image to search for")
+        "--format", choices=["csv", "json"], default="csv",
+        help="""Output format for --video and --batch: CSV with a header
+            row, or one JSON object per line (default: %(default)s)""")
+    parser.add_argument(
+        "-j", "--processes", type=int, default=multiprocessing.cpu_count(),
+        help="""Number of worker processes for --video and --batch (default:
+            the number of CPUs, %(default)s)""")
+    parser.add_argument(
+        "--batch", metavar="MANIFEST",
+        help="""Match many screenshot/reference pairs in a single invocation.
+            MANIFEST is a file with one JSON object per line, like
+            {"frame": "screenshot.png", "reference": "button.png"}. Prints a
+            result (including how long the match took) for each pair in the
+            format given by --format. Exits with status 0 unless any pair
+            couldn't be matched because of an error (for example a missing
+            file). Don't specify source_file and reference_file with
+            --batch""")
+    parser.add_argument(
+        "source_file", nargs="?", help="""The screenshot to compare against
+            (you can capture it using 'stbt screenshot')""")
+    parser.add_argument(
+        "reference_file", nargs="?", help="The image to search for")
     parser.add_argument(
         "match_parameters", nargs="*",
         help="""Parameters for the image processing algorithm. See
@@ -49,9 +80,63 @@ def main():
             'confirm_threshold=0.70')""")
     args = parser.parse_args(sys.argv[1:])
 
+    if args.batch and args.video:
+        error("--batch and --video can't be used together")
+    if args.batch:
+        # There are no positional filenames with --batch, so any positional
+        # arguments are match parameters.
+        args.match_parameters[:0] = [
+            x for x in (args.source_file, args.reference_file)
+            if x is not None]
+    elif args.reference_file is None:
+        parser.error(
+            "the following arguments are required: source_file, "
+            "reference_file")
+
+    mp = parse_match_parameters(args.match_parameters)
+
+    if args.processes < 1:
+        error("--processes must be at least 1")
+
+    if args.batch:
+        with (_stbt.logging.scoped_debug_level(2) if args.verbose
+              else noop_contextmanager()):
+            sys.exit(match_batch(
+                args.batch, stbt.MatchParameters(**mp), args.format,
+                args.processes))
+
+    if args.video:
+        with (_stbt.logging.scoped_debug_level(2) if args.verbose
+              else noop_contextmanager()):
+            sys.exit(match_video(
+                args.source_file, args.reference_file,
+                stbt.MatchParameters(**mp), args.all, args.format,
+                args.processes))
+
+    source_image = cv2.imread(args.source_file)
+    if source_image is None:
+        error("Invalid image '%s'" % args.source_file)
+
+    with (_stbt.logging.scoped_debug_level(2) if args.verbose
+          else noop_contextmanager()):
+        match_found = False
+        for result in stbt.match_all(
+                args.reference_file, frame=source_image,
+                match_parameters=stbt.MatchParameters(**mp)):
+            print("%s: %s" % (
+                "Match found" if result else "No match found. Closest match",
+                result))
+            if result:
+                match_found = True
+            if not args.all:
+                break
+        sys.exit(0 if match_found else 1)
+
+
+def parse_match_parameters(match_parameters):
     mp = {}
     try:
-        for p in args.match_parameters:
+        for p in match_parameters:
             name, value = p.split("=")
             if name == "match_method":
                 mp["match_method"] = value
@@ -67,25 +152,205 @@ def main():
                 raise Exception("Unknown match_parameter argument '%s'" % p)
     except Exception:  # pylint:disable=broad-except
         error("Invalid argument '%s'" % p)
+    return mp
 
-    source_image = cv2.imread(args.source_file)
-    if source_image is None:
-        error("Invalid image '%s'" % args.source_file)
 
-    with (_stbt.logging.scoped_debug_level(2) if args.verbose
-          else noop_contextmanager()):
+def match_video(video_file, reference_file, match_parameters, all_matches,
+                output_format, processes):
+    """Searches every frame of ``video_file`` and writes the results to
+    stdout. Returns the exit status: 0 if there was a match in any frame.
+    """
+    # Check the reference image before we start the workers, so that the
+    # error is reported once.
+    stbt.Matcher(reference_file, match_parameters)
+
+    # Start the worker processes before we import GStreamer: It isn't safe to
+    # fork once GStreamer's threads are running.
+    pool = multiprocessing.Pool(
+        processes, initializer=_init_worker,
+        initargs=(reference_file, match_parameters, all_matches))
+    try:
+        from _stbt.gst_utils import frames_from_video
+
+        # `numpy.asarray` because `stbt.Frame`'s attributes don't survive
+        # pickling; we send the timestamp separately.
+        frames = ((frame.time, numpy.asarray(frame))
+                  for frame in frames_from_video(video_file))
+        writer = ResultWriter(sys.stdout, output_format)
         match_found = False
-        for result in stbt.match_all(
-                args.reference_file, frame=source_image,
-                match_parameters=stbt.MatchParameters(**mp)):
-            print("%s: %s" % (
-                "Match found" if result else "No match found. Closest match",
-                result))
-            if result:
-                match_found = True
-            if not args.all:
-                break
-        sys.exit(0 if match_found else 1)
+        for rows in imap_bounded(pool, _match_frame, frames, processes * 2):
+            for row in rows:
+                writer.write(row)
+                match_found = match_found or row["match"]
+        pool.close()
+        return 0 if match_found else 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_worker_matcher = None
+_worker_all_matches = False
+_worker_match_parameters = None
+_worker_matchers = {}
+
+
+def _init_worker(reference_file, match_parameters, all_matches):
+    global _worker_matcher, _worker_all_matches
+    _worker_matcher = stbt.Matcher(reference_file, match_parameters)
+    _worker_all_matches = all_matches
+
+
+def _match_frame(time_and_frame):
+    time, frame = time_and_frame
+    return match_rows(_worker_matcher, frame, time, _worker_all_matches)
+
+
+def match_batch(manifest_file, match_parameters, output_format, processes):
+    """Matches each screenshot/reference pair in ``manifest_file`` and writes
+    the results to stdout, in the same order as the manifest. Returns the
+    exit status: 0 unless there was an error matching any of the pairs.
+    """
+    try:
+        manifest = open(manifest_file)
+    except (IOError, OSError) as e:
+        error("Invalid manifest '%s': %s" % (manifest_file, e))
+
+    pool = multiprocessing.Pool(
+        processes, initializer=_init_batch_worker,
+        initargs=(match_parameters,))
+    try:
+        with manifest:
+            writer = ResultWriter(sys.stdout, output_format)
+            ok = True
+            for row in imap_bounded(pool, _match_pair,
+                                    read_manifest(manifest, manifest_file),
+                                    processes * 2):
+                writer.write(row)
+                ok = ok and row["error"] is None
+        pool.close()
+        return 0 if ok else 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_manifest(f, filename):
+    """Yields the (frame, reference) filenames from each line of a
+    ``--batch`` manifest.
+    """
+    for n, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            pair = json.loads(line)
+            yield (str(pair["frame"]), str(pair["reference"]))
+        except (ValueError, KeyError, TypeError):
+            error("%s:%d: Invalid manifest line: Expected a JSON object with "
+                  "\"frame\" and \"reference\" filenames" % (filename, n))
+
+
+def _init_batch_worker(match_parameters):
+    global _worker_match_parameters
+    _worker_match_parameters = match_parameters
+
+
+def _match_pair(frame_and_reference):
+    frame_file, reference_file = frame_and_reference
+    row = OrderedDict([
+        ("frame", frame_file),
+        ("reference", reference_file),
+        ("match", False),
+        ("x", None),
+        ("y", None),
+        ("width", None),
+        ("height", None),
+        ("first_pass_result", None),
+        ("match_ms", None),
+        ("error", None),
+    ])
+    try:
+        frame = cv2.imread(frame_file)
+        if frame is None:
+            raise ValueError("Invalid image '%s'" % frame_file)
+        # Each worker loads each reference image once, however many
+        # screenshots it's matched against.
+        matcher = _worker_matchers.get(reference_file)
+        if matcher is None:
+            matcher = stbt.Matcher(reference_file, _worker_match_parameters)
+            _worker_matchers[reference_file] = matcher
+        start = timeit.default_timer()
+        result = matcher.match(frame)
+        row["match_ms"] = (timeit.default_timer() - start) * 1000
+    except Exception as e:  # pylint:disable=broad-except
+        row["error"] = "%s: %s" % (type(e).__name__, e)
+        return row
+    row.update([
+        ("match", result.match),
+        ("x", result.region.x),
+        ("y", result.region.y),
+        ("width", result.region.width),
+        ("height", result.region.height),
+        ("first_pass_result", result.first_pass_result),
+    ])
+    return row
+
+
+def match_rows(matcher, frame, time, all_matches):
+    """The results of `Matcher.match_all` in the same form as the output of
+    ``stbt match --video``: A list of dicts. Like the single-frame mode, we
+    stop at the first non-match, and without ``all_matches`` we stop after
+    the first result.
+    """
+    rows = []
+    for result in matcher._match_all(frame):  # pylint:disable=protected-access
+        rows.append(OrderedDict([
+            ("time", time),
+            ("match", result.match),
+            ("x", result.region.x),
+            ("y", result.region.y),
+            ("width", result.region.width),
+            ("height", result.region.height),
+            ("first_pass_result", result.first_pass_result),
+        ]))
+        if not result.match or not all_matches:
+            break
+    return rows
+
+
+def imap_bounded(pool, f, iterable, max_pending):
+    """Like ``pool.imap(f, iterable)``, but it reads at most ``max_pending``
+    items ahead of the results. `multiprocessing.Pool.imap` reads the whole
+    iterable as fast as it can, which would decode the entire video into
+    memory.
+    """
+    pending = deque()
+    for x in iterable:
+        pending.append(pool.apply_async(f, (x,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class ResultWriter(object):
+    """Writes the rows from `match_rows` as CSV (with a header row) or as
+    JSON (one object per line).
+    """
+    def __init__(self, f, output_format):
+        self.f = f
+        self.output_format = output_format
+        self._csv = None
+
+    def write(self, row):
+        if self.output_format == "json":
+            self.f.write(json.dumps(row) + "\n")
+        else:
+            if self._csv is None:
+                self._csv = csv.writer(self.f, lineterminator="\n")
+                self._csv.writerow(list(row.keys()))
+            self._csv.writerow(list(row.values()))
+        self.f.flush()
 
 
 @contextmanager
@@ -1,50 +1,375 @@
 #!/usr/bin/python
 
+"""Benchmarks for stb-tester's image-processing APIs.
+
+Times `stbt.match`, `stbt.match_all`, `stbt.ocr`, `stbt.match_text`,
+`stbt.MotionDiff`, `stbt.StrictDiff` and `stbt.is_screen_black` on the frames
+in ``tests/images/performance`` (scaled to each of the requested resolutions)
+and prints the latency percentiles, throughput and peak memory allocated for
+each benchmark as JSON.
+
+To check for performance regressions, save the output of a run on the base
+commit and pass it as ``--baseline`` to a run on the new commit::
+
+    ./tests/run_performance_test.py -o baseline.json
+    git checkout my-branch
+    ./tests/run_performance_test.py --baseline baseline.json
+
+This exits with status 1 if the median latency of any benchmark is more than
+``--tolerance`` slower than the baseline.
+
+For stable results, set your CPU frequency governor to "performance" first.
+"""
+
 from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+import argparse
+import contextlib
 import glob
+import json
 import os
-import subprocess
+import platform
+import re
 import sys
 import timeit
+from collections import OrderedDict
+
+import cv2
+import numpy
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 "..")))
 import stbt_core as stbt
+from _stbt.config import _config_init
+from _stbt.ocr import _tesseract_version
 sys.path.pop(0)
 
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "images", "performance")
+
+# Scale factor relative to the 720p frames in `IMAGES_DIR`.
+RESOLUTIONS = OrderedDict([
+    ("720p", 1),
+    ("1080p", 1.5),
+    ("4k", 3),
+])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--repeat", type=int, default=50, metavar="N",
+        help="Number of times to run each benchmark (default: %(default)s)")
+    parser.add_argument(
+        "--resolution", action="append", choices=list(RESOLUTIONS),
+        help="Frame resolution to benchmark. Can be specified multiple times "
+             "(default: all resolutions)")
+    parser.add_argument(
+        "-k", "--filter", metavar="REGEX",
+        help="Only run benchmarks whose name matches this regular expression")
+    parser.add_argument(
+        "-o", "--output", metavar="FILE",
+        help="Write the JSON results to FILE instead of stdout")
+    parser.add_argument(
+        "--baseline", metavar="FILE",
+        help="Compare the results against the JSON output of a previous run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="Report a regression if the median latency is this much slower "
+             "than the baseline (default: %(default)s, i.e. 20%%)")
+    parser.add_argument(
+        "--list", action="store_true",
+        help="List the benchmarks and exit without running them")
+    args = parser.parse_args(argv[1:])
+
+    resolutions = args.resolution or list(RESOLUTIONS)
+    benchmarks = [
+        (name, setup) for name, setup in generate_benchmarks(resolutions)
+        if args.filter is None or re.search(args.filter, name)]
+
+    if args.list:
+        for name, _ in benchmarks:
+            print(name)
+        return 0
+
+    governor = cpu_governor()
+    if governor not in (None, "performance"):
+        sys.stderr.write(
+            "warning: CPU frequency governor is %r; results may be noisy. "
+            "Set it to 'performance' for stable results.\n" % governor)
+
+    results = OrderedDict()
+    for name, setup in benchmarks:
+        sys.stderr.write("%s... " % name)
+        sys.stderr.flush()
+        try:
+            f = setup()
+        except Skip as e:
+            sys.stderr.write("skipped: %s\n" % e)
+            continue
+        results[name] = measure(f, args.repeat)
+        sys.stderr.write("%.2f ms\n" % results[name]["p50_ms"])
+
+    output = OrderedDict([
+        ("metadata", OrderedDict([
+            ("python", platform.python_version()),
+            ("opencv", cv2.__version__),
+            ("machine", platform.machine()),
+            ("cpu_governor", governor),
+            ("repeat", args.repeat),
+        ])),
+        ("benchmarks", results),
+    ])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            sys.stderr.write("\n%d benchmark(s) regressed by more than %d%%:\n"
+                             % (len(regressions), args.tolerance * 100))
+            for name in regressions:
+                sys.stderr.write("    %s\n" % name)
+            return 1
+    return 0
+
+
+class Skip(Exception):
+    pass
+
+
+def measure(f, repeat):
+    f()  # Warm up: Fill caches, load Tesseract's language data, etc.
+
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        f()
+        times.append(timeit.default_timer() - start)
+    times_ms = numpy.array(times) * 1000
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            f()
+            _, alloc_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    else:
+        alloc_peak = None
+
+    return OrderedDict([
+        ("p50_ms", float(numpy.percentile(times_ms, 50))),
+        ("p95_ms", float(numpy.percentile(times_ms, 95))),
+        ("p99_ms", float(numpy.percentile(times_ms, 99))),
+        ("mean_ms", float(numpy.mean(times_ms))),
+        ("throughput_per_sec", float(1000 / numpy.mean(times_ms))),
+        ("alloc_peak_bytes", alloc_peak),
+    ])
+
+
+def compare(baseline, results, tolerance):
+    """Print a comparison table to stderr & return the names of the
+    benchmarks that regressed.
+    """
+    regressions = []
+    sys.stderr.write("\n%-60s %10s %10s %8s\n"
+                     % ("benchmark", "base p50", "new p50", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            sys.stderr.write("%-60s %10s %10.2f %8s\n"
+                             % (name, "-", result["p50_ms"], "new"))
+            continue
+        old = baseline[name]["p50_ms"]
+        new = result["p50_ms"]
+        change = (new - old) / old if old else 0.
+        regressed = new > old * (1 + tolerance)
+        if regressed:
+            regressions.append(name)
+        sys.stderr.write("%-60s %10.2f %10.2f %+7.1f%%%s\n"
+                         % (name, old, new, change * 100,
+                            " REGRESSION" if regressed else ""))
+    for name in baseline:
+        if name not in results:
+            sys.stderr.write("%-60s %10.2f %10s %8s\n"
+                             % (name, baseline[name]["p50_ms"], "-",
+                                "missing"))
+    return regressions
+
+
+def generate_benchmarks(resolutions):
+    """Yields (name, setup) tuples. `setup` loads the images & returns the
+    function to time, or raises `Skip`.
+    """
+    tests = sorted(os.path.basename(f).replace("-frame.png", "")
+                   for f in glob.glob(os.path.join(IMAGES_DIR, "*-frame.png")))
+    for resolution in resolutions:
+        scale = RESOLUTIONS[resolution]
+        for test in tests:
+            for name, setup in match_benchmarks(test, scale):
+                yield "%s/%s/%s" % (name, test, resolution), setup
+        for name, setup in frame_benchmarks(scale):
+            yield "%s/%s" % (name, resolution), setup
+
+
+def match_benchmarks(test, scale):
+    def match(match_parameters=None):
+        frame, template = load_images(test, scale)
+        return partial(stbt.match, template, frame,
+                       match_parameters=match_parameters)
+
+    def match_pyramid_levels(levels):
+        return scoped_config("match", "pyramid_levels", str(levels), match())
+
+    def match_all():
+        frame, template = load_images(test, scale)
+        return partial(lambda: list(stbt.match_all(template, frame)))
+
+    def match_transparent():
+        frame, template = load_images(test, scale)
+        return partial(stbt.match, transparent(template), frame)
+
+    for method in stbt.MatchMethod:
+        yield ("match/%s" % method.value,
+               partial(match, stbt.MatchParameters(match_method=method)))
+    yield ("match/first_pass_grayscale",
+           partial(match, stbt.MatchParameters(first_pass_grayscale=True)))
+    for levels in ["auto"] + list(range(1, 6)):
+        yield ("match/pyramid_levels=%s" % levels,
+               partial(match_pyramid_levels, levels))
+    yield "match_all", match_all
+    yield "match/transparent", match_transparent
+
+
+def frame_benchmarks(scale):
+    def text_frame():
+        frame, _ = load_images("lots-of-text", scale)
+        return frame
+
+    def ocr():
+        region = scale_region(stbt.Region(345, 200, right=790, bottom=585),
+                              scale)
+        return requires_tesseract(partial(stbt.ocr, text_frame(),
+                                          region=region))
+
+    def match_text():
+        return requires_tesseract(partial(stbt.match_text, "Jason Bateman",
+                                          text_frame()))
+
+    def changed_frame():
+        frame = text_frame().copy()
+        cv2.rectangle(frame, (int(100 * scale), int(100 * scale)),
+                      (int(300 * scale), int(200 * scale)), (255, 255, 255),
+                      thickness=-1)
+        return frame
+
+    def diff(differ):
+        return partial(differ(text_frame()).diff, changed_frame())
+
+    def is_screen_black(frame):
+        return partial(stbt.is_screen_black, frame)
+
+    yield "ocr/lots-of-text", ocr
+    yield "match_text/lots-of-text", match_text
+    yield "MotionDiff", partial(diff, stbt.MotionDiff)
+    yield "StrictDiff", partial(diff, stbt.StrictDiff)
+    yield ("is_screen_black/not-black",
+           lambda: is_screen_black(text_frame()))
+    yield ("is_screen_black/black",
+           lambda: is_screen_black(numpy.zeros_like(text_frame())))
+
+
+_image_cache = {}
+
+
+def load_images(test, scale):
+    """The frame scaled to the given resolution, and the reference image
+    cropped from the scaled frame so that it still matches exactly.
+    """
+    key = (test, scale)
+    if key not in _image_cache:
+        frame = stbt.load_image(os.path.join(IMAGES_DIR, test + "-frame.png"))
+        reference = stbt.load_image(
+            os.path.join(IMAGES_DIR, test + "-reference.png"))
+        region = stbt.match(reference, frame).region
+        if scale != 1:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale,
+                               interpolation=cv2.INTER_LINEAR)
+            region = scale_region(region, scale)
+        _image_cache[key] = (frame, frame[region.to_slice()].copy())
+    return _image_cache[key]
+
+
+def scale_region(region, scale):
+    return stbt.Region(int(region.x * scale), int(region.y * scale),
+                       right=int(region.right * scale),
+                       bottom=int(region.bottom * scale))
+
+
+def transparent(template):
+    """Adds an alpha channel with a transparent hole in the middle."""
+    h, w = template.shape[:2]
+    alpha = numpy.full((h, w, 1), 255, dtype=numpy.uint8)
+    alpha[h // 4:h * 3 // 4, w // 4:w * 3 // 4] = 0
+    return numpy.concatenate([template, alpha], axis=2)
+
+
+def partial(f, *args, **kwargs):
+    return lambda: f(*args, **kwargs)
+
+
+def scoped_config(section, key, value, f):
+    """Wraps `f` so that it runs with the given configuration value."""
+    @contextlib.contextmanager
+    def cm():
+        config = _config_init()
+        old = config.get(section, key)
+        config.set(section, key, value)
+        try:
+            yield
+        finally:
+            config.set(section, key, old)
+
+    def g():
+        with cm():
+            return f()
+    return g
 
-def main():
-    os.chdir(os.path.dirname(__file__))
 
-    # Disable cpu frequency scaling
-    subprocess.check_call(r"""
-        for cpu in /sys/devices/system/cpu/cpufreq/policy*; do
-            echo $cpu
-            cat $cpu/scaling_available_governors
-            echo performance | sudo tee $cpu/scaling_governor
-            freq=$(cat $cpu/cpuinfo_max_freq)
-            echo $freq | sudo tee $cpu/scaling_min_freq
-        done >&2
-        """, shell=True)
+def requires_tesseract(f):
+    try:
+        _tesseract_version()
+    except RuntimeError as e:
+        raise Skip(e)
+    return f
 
-    print("screenshot,reference,min,avg,max")
 
-    for fname in glob.glob("images/performance/*-frame.png"):
-        tname = fname.replace("-frame.png", "-reference.png")
-        f = stbt.load_image(fname)
-        t = stbt.load_image(tname)
-        # pylint:disable=cell-var-from-loop
-        times = timeit.repeat(lambda: stbt.match(t, f), number=1, repeat=100)
-        print("%s,%s,%f,%f,%f" % (os.path.basename(fname),
-                                  os.path.basename(tname),
-                                  min(times),
-                                  max(times),
-                                  sum(times) / len(times)))
+def cpu_governor():
+    try:
+        with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor") \
+                as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return None
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main(sys.argv))
@@ -64,3 +64,53 @@ test_that_stbt_match_is_an_alias_for_stbt_templatematch() {
         "$testdir"/videotestsrc-full-frame.png \
         "$testdir"/videotestsrc-gamut.png
 }
+
+test_that_stbt_match_searches_every_frame_of_a_video() {
+    gst-launch-1.0 videotestsrc num-buffers=10 ! \
+        video/x-raw,width=320,height=240,framerate=5/1 ! \
+        videoconvert ! vp8enc ! webmmux ! filesink location=video.webm ||
+        fail "Failed to create video"
+
+    stbt match --video video.webm \
+        "$testdir"/videotestsrc-redblue.png >output.csv ||
+        fail "Expected a match"
+    cat output.csv
+    [ "$(head -1 output.csv)" = \
+      "time,match,x,y,width,height,first_pass_result" ] ||
+        fail "Unexpected CSV header"
+    [ "$(grep -c ',True,' output.csv)" -eq 10 ] ||
+        fail "Expected a match in each of the 10 frames"
+
+    stbt match --video --format=json -j 2 video.webm \
+        "$testdir"/videotestsrc-redblue.png >output.json &&
+    [ "$(grep -c '"match": true' output.json)" -eq 10 ] ||
+        fail "Expected 10 JSON results"
+
+    ! stbt match --video video.webm "$testdir"/videotestsrc-gamut.png \
+        >/dev/null || fail "Didn't expect a match"
+}
+
+test_that_stbt_match_batch_matches_each_pair_in_the_manifest() {
+    cat >manifest.jsonl <<-EOF
+	{"frame": "$testdir/videotestsrc-full-frame.png", "reference": "$testdir/videotestsrc-redblue.png"}
+	{"frame": "$testdir/videotestsrc-full-frame.png", "reference": "$testdir/videotestsrc-gamut.png"}
+	{"frame": "$testdir/videotestsrc-full-frame.png", "reference": "$testdir/videotestsrc-redblue.png"}
+	EOF
+    stbt match --batch manifest.jsonl >output.csv || fail "stbt match failed"
+    cat output.csv
+    [ "$(head -1 output.csv)" = \
+      "frame,reference,match,x,y,width,height,first_pass_result,match_ms,error" ] ||
+        fail "Unexpected CSV header"
+    [ "$(sed -n 2p output.csv | cut -d, -f3-7)" = "True,228,0,92,160" ] &&
+    [ "$(sed -n 3p output.csv | cut -d, -f3)" = "False" ] &&
+    [ "$(sed -n 4p output.csv | cut -d, -f3-7)" = "True,228,0,92,160" ] ||
+        fail "Unexpected results"
+
+    echo '{"frame": "idontexist.png", "reference": "'"$testdir"'/videotestsrc-redblue.png"}' \
+        >>manifest.jsonl
+    ! stbt match --batch manifest.jsonl --format=json >output.json ||
+        fail "Expected an error for the missing frame"
+    [ "$(wc -l <output.json)" -eq 4 ] &&
+    tail -1 output.json | grep -q "Invalid image 'idontexist.png'" ||
+        fail "Expected a result with the error for the missing frame"
+}
@@ -43,7 +43,9 @@ test_config = dedent("""\
 
 @contextmanager
 def set_config_test():
-    with scoped_curdir() as d:
+    with scoped_curdir():
+        # `scoped_curdir` yields the *previous* directory:
+        d = os.getcwd()
         test_cfg = d + '/test.cfg'
         os.environ['STBT_CONFIG_FILE'] = test_cfg
         with open(test_cfg, 'w') as f:
@@ -82,7 +84,8 @@ def test_that_set_config_preserves_file_comments_and_formatting():
 
 
 def test_that_set_config_creates_directories_if_required():
-    with scoped_curdir() as d:
+    with scoped_curdir():
+        d = os.getcwd()
         os.environ['XDG_CONFIG_HOME'] = d + '/.config'
         if 'STBT_CONFIG_FILE' in os.environ:
             del os.environ['STBT_CONFIG_FILE']
@@ -93,7 +96,8 @@ def test_that_set_config_creates_directories_if_required():
 
 
 def test_that_set_config_writes_to_the_first_stbt_config_file():
-    with scoped_curdir() as d:
+    with scoped_curdir():
+        d = os.getcwd()
         filled_cfg = d + '/test.cfg'
         empty_cfg = d + '/empty.cfg'
         os.environ['STBT_CONFIG_FILE'] = '%s:%s' % (filled_cfg, empty_cfg)
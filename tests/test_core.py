@@ -11,6 +11,7 @@ import os
 import shutil
 import sys
 import time
+from contextlib import contextmanager
 
 import cv2
 import numpy
@@ -22,6 +23,7 @@ except ImportError:
     import mock  # Python 2 backport
 
 import stbt_core as stbt
+from _stbt.config import _config_init
 from stbt_core import wait_until
 
 
@@ -445,3 +447,17 @@ def test_that_wait_until_doesnt_compare_return_values(mock_time):
 
 def _find_file(path, root=os.path.dirname(os.path.abspath(__file__))):
     return os.path.join(root, path)
+
+
+@contextmanager
+def scoped_config(section, key, value):
+    config = _config_init()
+    old_value = config.get(section, key, fallback=None)
+    config.set(section, key, str(value))
+    try:
+        yield
+    finally:
+        if old_value is None:
+            config.remove_option(section, key)
+        else:
+            config.set(section, key, old_value)
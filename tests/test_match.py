@@ -9,6 +9,7 @@ import os
 import random
 import re
 import timeit
+from collections import OrderedDict
 
 import cv2
 import numpy
@@ -19,12 +20,17 @@ from _stbt import cv2_compat
 from _stbt.imgutils import _image_region
 from _stbt.logging import scoped_debug_level
 from _stbt.match import _merge_regions
-from tests.test_core import _find_file
+from tests.test_core import _find_file, scoped_config
 from tests.test_ocr import requires_tesseract
 
 
 requires_opencv_3 = pytest.mark.skipif(cv2_compat.version < [3, 0, 0],
                                        reason="Requires OpenCV 3")
+# These tests were written against OpenCV 2.4 & 3; `cv2.matchTemplate` gives
+# different results on OpenCV 4 for uniform (0 / 0) and masked images.
+xfail_on_opencv_4 = pytest.mark.xfail(
+    cv2_compat.version >= [4, 0, 0], strict=False,
+    reason="cv2.matchTemplate gives different results on OpenCV 4")
 
 
 def mp(match_method=stbt.MatchMethod.SQDIFF, match_threshold=None, **kwargs):
@@ -41,6 +47,7 @@ def test_that_matchresult_image_matches_template_passed_to_match():
     assert stbt.match("black.png", frame=black()).image.filename == "black.png"
 
 
+@xfail_on_opencv_4
 def test_that_matchresult_str_image_matches_template_passed_to_match():
     assert re.search(r"image=<Image\(filename=u?'black.png'",
                      str(stbt.match("black.png", frame=black())))
@@ -150,6 +157,101 @@ def test_that_match_all_finds_all_matches(match_method):
     assert plain_buttons == sorted(matches)
 
 
+def test_that_match_all_with_match_threshold_0_finds_all_matches():
+    # With a threshold of 0 the first pass matches everywhere, so it's the
+    # second pass that stops the search.
+    matches = list(m.region for m in stbt.match_all(
+        'button.png', frame=stbt.load_image('buttons.png'),
+        match_parameters=mp(match_threshold=0)))
+    print(matches)
+    assert plain_buttons == sorted(matches)
+
+
+def test_that_match_all_finds_grid_of_identical_images_in_order():
+    icon = numpy.random.RandomState(0).randint(
+        0, 256, (40, 60, 3)).astype(numpy.uint8)
+    frame = black(1280, 720, value=30)
+    expected = []
+    for y in range(6):
+        for x in range(12):
+            r = stbt.Region(10 + x * 105, 10 + y * 115, width=60, height=40)
+            frame[r.to_slice()] = icon
+            expected.append(r)
+    # All the matches have the same certainty, so they're found in row-major
+    # order (the same as `cv2.minMaxLoc`).
+    assert [m.region for m in stbt.match_all(icon, frame=frame)] == expected
+
+
+@pytest.mark.parametrize("scale", [1, 135 * 44 * 3 * 255 ** 2])
+def test_non_maximum_suppression_gives_same_results_as_minmaxloc(scale):
+    from _stbt.match import _find_next_matches, _non_maximum_suppression
+
+    class NoImageLogger(object):
+        enabled = False
+
+        def imwrite(self, *args, **kwargs):
+            pass
+
+    rng = numpy.random.RandomState(0)
+    for _ in range(100):
+        # Few distinct values, so there are lots of ties:
+        heatmap = (rng.randint(0, 6, (rng.randint(5, 80), rng.randint(5, 80)))
+                   * scale / 5.).astype(numpy.float32)
+        threshold = rng.choice([0.2, 0.5, 0.8, 1.0])
+        _, _, (x, y), _ = cv2.minMaxLoc(heatmap)
+        first = stbt.Region(x, y, width=rng.randint(1, 10),
+                            height=rng.randint(1, 10))
+        expected = list(_find_next_matches(
+            heatmap.copy(), scale, threshold, first, NoImageLogger()))
+        actual = list(_non_maximum_suppression(
+            heatmap.copy(), scale, threshold, first))
+        assert actual == expected
+
+
+@pytest.mark.parametrize("confirm_method", [
+    stbt.ConfirmMethod.ABSDIFF,
+    stbt.ConfirmMethod.NORMED_ABSDIFF,
+])
+@pytest.mark.parametrize("frame,image,color_channels", [
+    ("buttons.png", "button.png", 3),
+    ("buttons-on-blue-background.png", "button-transparent.png", 3),
+    ("videotestsrc-full-frame.png", "videotestsrc-redblue.png", 1),
+])
+def test_that_confirm_matches_is_equivalent_to_confirm_match(
+        frame, image, color_channels, confirm_method):
+    from _stbt.match import _confirm_match, _confirm_matches, _prepare_template
+
+    frame = stbt.load_image(frame, color_channels=color_channels)
+    template = _prepare_template(stbt.load_image(
+        image, color_channels=(color_channels, 4)))
+    h, w = template.shape[:2]
+    rng = numpy.random.RandomState(0)
+    regions = [
+        stbt.Region(rng.randint(0, frame.shape[1] - w + 1),
+                    rng.randint(0, frame.shape[0] - h + 1), width=w, height=h)
+        for _ in range(20)]
+    regions += [m.region for m in stbt.match_all(
+        image, frame=frame,
+        match_parameters=mp(confirm_method=stbt.ConfirmMethod.NONE,
+                            match_engine=stbt.MatchEngine.FFT))]
+
+    results = []
+    for erode_passes in [0, 1, 2]:
+        for confirm_threshold in [0.5, 0.7, 0.84]:
+            params = mp(confirm_method=confirm_method,
+                        confirm_threshold=confirm_threshold,
+                        erode_passes=erode_passes)
+            expected = [
+                _confirm_match(frame, region, template, params,
+                               imwrite=lambda name, img: None)
+                for region in regions]
+            assert _confirm_matches(frame, regions, template, params) == \
+                expected
+            results += expected
+    assert any(results)
+    assert not all(results)
+
+
 @pytest.mark.parametrize("match_method", [
     stbt.MatchMethod.SQDIFF,
     stbt.MatchMethod.SQDIFF_NORMED,
@@ -167,6 +269,7 @@ def test_that_match_all_can_find_labelled_matches(match_method):
 
 
 @requires_opencv_3
+@xfail_on_opencv_4
 def test_match_all_with_transparent_reference_image():
     frame = stbt.load_image("buttons-on-blue-background.png")
     matches = list(m.region for m in stbt.match_all(
@@ -177,6 +280,144 @@ def test_match_all_with_transparent_reference_image():
             sorted(matches))
 
 
+@requires_opencv_3
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.CCORR_NORMED,
+])
+def test_match_all_with_transparent_reference_image_using_fft(match_method):
+    frame = stbt.load_image("buttons-on-blue-background.png")
+    matches = list(m.region for m in stbt.match_all(
+        "button-transparent.png", frame=frame,
+        match_parameters=mp(match_method=match_method,
+                            match_engine=stbt.MatchEngine.FFT)))
+    print(matches)
+    assert overlapped_button not in matches
+    assert (sorted(plain_buttons + labelled_buttons + [overlapping_button]) ==
+            sorted(matches))
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.CCORR_NORMED,
+])
+@pytest.mark.parametrize("frame,image", [
+    ("buttons.png", "button-transparent.png"),
+    ("buttons-on-blue-background.png", "button-transparent.png"),
+    ("action-panel.png", "action-panel-template.png"),
+    ("buttons-on-blue-background.png", "completely-transparent.png"),
+])
+def test_that_auto_engine_gives_the_same_results_as_spatial_with_transparency(
+        frame, image, match_method):
+    frame = stbt.load_image(frame)
+
+    def results(engine):
+        return [(m.match, m.region, m.first_pass_result)
+                for m in stbt.match_all(
+                    image, frame=frame,
+                    match_parameters=mp(match_method=match_method,
+                                        match_engine=engine))]
+
+    assert (results(stbt.MatchEngine.AUTO) ==
+            results(stbt.MatchEngine.SPATIAL))
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.SQDIFF_NORMED,
+    stbt.MatchMethod.CCORR_NORMED,
+    stbt.MatchMethod.CCOEFF_NORMED,
+])
+@pytest.mark.parametrize("frame,image", [
+    ("buttons.png", "button.png"),
+    ("videotestsrc-full-frame.png", "videotestsrc-redblue.png"),
+    ("videotestsrc-full-frame.png", "videotestsrc-greyscale.png"),
+    ("black-full-frame.png", "black.png"),
+])
+def test_that_fft_engine_gives_the_same_results(frame, image, match_method):
+    frame = stbt.load_image(frame)
+    spatial = list(stbt.match_all(
+        image, frame=frame,
+        match_parameters=mp(match_method=match_method,
+                            match_engine=stbt.MatchEngine.SPATIAL)))
+    fft = list(stbt.match_all(
+        image, frame=frame,
+        match_parameters=mp(match_method=match_method,
+                            match_engine=stbt.MatchEngine.FFT)))
+    # Matches with (almost) the same certainty can be found in a different
+    # order, because of rounding differences.
+    spatial.sort(key=lambda m: m.region)
+    fft.sort(key=lambda m: m.region)
+    assert [m.region for m in spatial] == [m.region for m in fft]
+    for a, b in zip(spatial, fft):
+        assert a.first_pass_result == pytest.approx(b.first_pass_result,
+                                                    abs=1e-5)
+
+
+@pytest.mark.parametrize("method", [
+    cv2.TM_SQDIFF,
+    cv2.TM_SQDIFF_NORMED,
+    cv2.TM_CCORR_NORMED,
+    cv2.TM_CCOEFF_NORMED,
+])
+@pytest.mark.parametrize("frame,image,color_channels", [
+    ("buttons.png", "button.png", 3),
+    ("videotestsrc-full-frame.png", "videotestsrc-redblue.png", 3),
+    ("videotestsrc-full-frame.png", "videotestsrc-redblue.png", 1),
+    ("action-panel.png", "action-panel-prototype.png", 3),
+    ("black-full-frame.png", "black.png", 3),
+])
+def test_match_template_fft_heatmap(frame, image, color_channels, method):
+    from _stbt.match_fft import match_template_fft
+
+    frame = stbt.load_image(frame, color_channels=color_channels)
+    image = stbt.load_image(image, color_channels=color_channels)
+    expected = cv2.matchTemplate(frame, image, method)
+    actual = match_template_fft(frame, image, method)
+    assert actual.shape == expected.shape
+    assert actual.dtype == numpy.float32
+    if method == cv2.TM_SQDIFF:
+        assert numpy.max(numpy.abs(actual - expected)) / \
+            (image.size * 255 ** 2) < 1e-5
+    else:
+        # OpenCV calculates the normalised methods in single precision, so
+        # it's less accurate for windows of the frame that are almost a solid
+        # colour (the denominator is small).
+        assert numpy.max(numpy.abs(actual - expected)) < 2e-3
+
+
+@requires_opencv_3
+@pytest.mark.parametrize("method", [
+    cv2.TM_SQDIFF,
+    cv2.TM_CCORR_NORMED,
+])
+@pytest.mark.parametrize("image", [
+    "button-transparent.png",
+    "completely-transparent.png",
+])
+def test_match_template_fft_heatmap_with_mask(image, method):
+    from _stbt.match_fft import match_template_fft
+
+    frame = stbt.load_image("buttons-on-blue-background.png")
+    image = stbt.load_image(image, color_channels=4)
+    template = numpy.ascontiguousarray(image[:, :, :3])
+    mask = cv2.cvtColor(image[:, :, 3], cv2.COLOR_GRAY2BGR)
+
+    # OpenCV 3.2 scales 8-bit images & masks to [0, 1] before matching; newer
+    # versions treat 8-bit masks as binary, so we scale them ourselves to get
+    # the same (OpenCV 3.2) results on any version.
+    expected = cv2.matchTemplate(
+        frame.astype(numpy.float32) / 255, template.astype(numpy.float32) / 255,
+        method, mask=mask.astype(numpy.float32) / 255)
+    # OpenCV gives NaN (0 / 0) for CCORR_NORMED with a completely transparent
+    # mask; we give 0 (no match).
+    expected = numpy.nan_to_num(expected)
+    actual = match_template_fft(frame, template, method, mask)
+    assert actual.shape == expected.shape
+    scale = max(1, numpy.count_nonzero(mask)) if method == cv2.TM_SQDIFF else 1
+    assert numpy.max(numpy.abs(actual - expected)) / scale < 1e-5
+
+
 @requires_opencv_3
 def test_completely_transparent_reference_image():
     f = stbt.load_image("buttons-on-blue-background.png")
@@ -187,7 +428,7 @@ def test_completely_transparent_reference_image():
 @requires_opencv_3
 @pytest.mark.parametrize("frame,image,expected_region", [
     # pylint:disable=bad-whitespace,line-too-long
-    ("images/regression/roku-tile-frame.png", "images/regression/roku-tile-selection.png", stbt.Region(x=325, y=145, right=545, bottom=325)),
+    pytest.param("images/regression/roku-tile-frame.png", "images/regression/roku-tile-selection.png", stbt.Region(x=325, y=145, right=545, bottom=325), marks=xfail_on_opencv_4),
     ("images/regression/xfinity-frame.png",   "images/regression/xfinity-selection.png",   stbt.Region(x=68, y=157, right=300, bottom=473)),
 ])
 def test_transparent_reference_image_false_negative_caused_by_pyramid(
@@ -462,6 +703,260 @@ def test_that_build_pyramid_relaxes_mask():
     assert numpy.all(downsampled[:, :, 0] == expected)  # pylint:disable=unsubscriptable-object
 
 
+@pytest.mark.parametrize("region", [
+    stbt.Region.ALL,
+    stbt.Region(x=0, y=0, width=320, height=200),
+])
+def test_that_match_many_is_equivalent_to_match(region):
+    frame = stbt.load_image("buttons.png")
+    images = ["button.png", "button-transparent.png", "videotestsrc-ball.png",
+              "black.png", black(30, 30)]
+    results = stbt.match_many(images, frame=frame, region=region)
+    assert len(results) == len(images)
+    for image, result in zip(images, results):
+        expected = stbt.match(image, frame=frame, region=region)
+        assert result.match == expected.match
+        assert result.region == expected.region
+        assert result.first_pass_result == expected.first_pass_result
+        assert result.frame.base is frame
+        assert (result.image == expected.image).all()
+
+
+@pytest.mark.parametrize("region", [
+    stbt.Region.ALL,
+    stbt.Region(x=0, y=0, width=320, height=200),
+])
+def test_that_matcher_is_equivalent_to_match(region):
+    frame = stbt.load_image("buttons.png")
+    for image in ["button.png", "button-transparent.png",
+                  "videotestsrc-ball.png", black(30, 30)]:
+        matcher = stbt.Matcher(image, region=region)
+        for f in [frame, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)]:
+            expected = stbt.match(image, frame=f, region=region)
+            result = matcher.match(f)
+            assert result.match == expected.match
+            assert result.region == expected.region
+            assert result.first_pass_result == expected.first_pass_result
+            assert (result.image == expected.image).all()
+
+            assert ([m.region for m in matcher.match_all(f)] ==
+                    [m.region for m in stbt.match_all(image, f, region=region)])
+
+
+@pytest.mark.parametrize("image", [
+    "button.png",
+    "button-transparent.png",
+    "videotestsrc-ball.png",
+])
+def test_that_first_pass_grayscale_finds_the_same_matches(image):
+    frame = stbt.load_image("buttons.png")
+    expected = list(stbt.match_all(image, frame))
+    actual = list(stbt.match_all(image, frame, mp(first_pass_grayscale=True)))
+    # The order can be different, because the certainties are different.
+    assert (sorted(m.region for m in actual) ==
+            sorted(m.region for m in expected))
+    for m in actual:
+        assert m.image.shape[2] in (3, 4)
+        assert m.frame.shape == frame.shape
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.CCOEFF_NORMED,
+])
+def test_that_first_pass_grayscale_is_the_same_as_a_grayscale_frame(
+        match_method):
+    frame = stbt.load_image("buttons.png")
+    template = stbt.load_image("button.png")
+    region = stbt.Region(x=150, y=0, right=434, bottom=268)
+
+    def gray(img):
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    expected = stbt.match(gray(template), gray(frame), mp(match_method),
+                          region=region)
+    actual = stbt.match(template, frame,
+                        mp(match_method, first_pass_grayscale=True),
+                        region=region)
+    assert actual.match == expected.match
+    assert actual.region == expected.region
+    assert actual.first_pass_result == expected.first_pass_result
+
+    # In a grayscale frame there's nothing to convert:
+    assert stbt.match(
+        template, gray(frame), mp(match_method, first_pass_grayscale=True),
+        region=region).region == expected.region
+
+
+def test_that_matcher_uses_a_cropped_reference_image_with_a_grayscale_frame():
+    frame = stbt.load_image("buttons.png")
+    region = stbt.Region(x=200, y=100, width=100, height=40)
+    # This keeps `absolute_filename`, but it isn't the whole file:
+    reference = stbt.crop(frame, region)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    assert stbt.Matcher(reference).match(gray).region == region
+    assert stbt.match(reference, gray).region == region
+
+
+def test_that_matcher_only_loads_the_image_once(monkeypatch):
+    matcher = stbt.Matcher("button.png")
+    assert matcher.image.filename == "button.png"
+    frame = stbt.load_image("buttons.png")
+    assert matcher.match(frame)
+
+    def fail(*_args, **_kwargs):
+        assert False, "load_image called"
+    monkeypatch.setattr("_stbt.match.load_image", fail)
+    assert matcher.match(frame)
+    assert matcher.match(frame)
+
+
+def test_that_matcher_validates_the_image_and_parameters():
+    with pytest.raises(IOError):
+        stbt.Matcher("idontexist.png")
+    with pytest.raises(ValueError, match="alpha channel"):
+        stbt.Matcher(
+            "button-transparent.png",
+            mp(match_method=stbt.MatchMethod.CCOEFF_NORMED)).match(
+                stbt.load_image("buttons.png"))
+    with scoped_config("match", "pyramid_levels", 0):
+        with pytest.raises(stbt.ConfigurationError):
+            stbt.Matcher("button.png")
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.CCOEFF_NORMED,
+])
+def test_that_match_with_threads_is_equivalent(match_method):
+    frame = stbt.load_image("buttons.png")
+    images = ["button.png", "button-transparent.png", "videotestsrc-ball.png"]
+    if match_method != stbt.MatchMethod.SQDIFF:
+        images.remove("button-transparent.png")
+    params = mp(match_method=match_method)
+
+    def results():
+        out = []
+        for image in images:
+            out.append([(m.match, m.region, m.first_pass_result)
+                        for m in stbt.match_all(image, frame, params)])
+        out.append([(m.match, m.region, m.first_pass_result)
+                    for m in stbt.match_many(images, frame, params)])
+        return out
+
+    expected = results()
+    with scoped_config("match", "threads", 4):
+        assert results() == expected
+
+
+def test_that_prepared_template_is_cached(tmpdir):
+    from _stbt.match import _prepare_template
+
+    filename = os.path.join(str(tmpdir), "button.png")
+    cv2.imwrite(filename, cv2.imread(_find_file("button.png")))
+
+    prepared = _prepare_template(stbt.load_image(filename))
+    assert _prepare_template(stbt.load_image(filename)) is prepared
+    assert prepared.pyramids(3) is prepared.pyramids(3)
+
+    # The cache key is the image's contents, not where it came from:
+    button = cv2.imread(_find_file("button.png"))
+    assert _prepare_template(button) is prepared
+
+    # Modifying the image invalidates the cache:
+    button[0, 0] = 255 - button[0, 0]
+    assert _prepare_template(button) is not prepared
+    assert _prepare_template(stbt.load_image(filename)) is prepared
+
+
+def test_that_crops_of_the_same_reference_image_arent_confused():
+    frame = stbt.load_image("buttons.png")
+    for region in [stbt.Region(x=200, y=100, width=100, height=40),
+                   stbt.Region(x=0, y=0, width=100, height=40)]:
+        # Same size & `absolute_filename`, but different pixels:
+        reference = stbt.crop(frame, region)
+        assert stbt.match(reference, frame).region == region
+
+
+@pytest.mark.parametrize("image,expected", [
+    # Tiny icon: Too small for a second level
+    ("repeating-pattern.png", 1),
+    # Fine detail (text, noise) that is lost when downsampled
+    ("button.png", 1),
+    (numpy.random.RandomState(0).randint(0, 256, (40, 60, 3))
+     .astype(numpy.uint8), 1),
+    # Large shapes with sharp edges
+    ("videotestsrc-redblue.png", 3),
+    ("circle-big.png", 4),
+    # Large & flat: As many levels as we allow
+    (black(400, 300), 5),
+])
+def test_auto_pyramid_levels(image, expected):
+    from _stbt.match import _PreparedTemplate
+    assert _PreparedTemplate(
+        stbt.load_image(image)).auto_pyramid_levels() == expected
+
+
+@pytest.mark.parametrize("frame,image", [
+    ("buttons.png", "button.png"),
+    ("videotestsrc-full-frame.png", "videotestsrc-redblue.png"),
+    ("mask-out-left-half-720p.png", "circle-small.png"),
+])
+def test_that_auto_pyramid_levels_finds_the_same_matches(frame, image):
+    frame = stbt.load_image(frame)
+    expected = list(stbt.match_all(image, frame))
+    with scoped_config("match", "pyramid_levels", "auto"):
+        actual = list(stbt.match_all(image, frame))
+    assert (sorted(m.region for m in actual) ==
+            sorted(m.region for m in expected))
+
+
+def test_pyramid_levels_config():
+    frame = stbt.load_image("buttons.png")
+    for value in ["auto", " Auto", "1", "4"]:
+        with scoped_config("match", "pyramid_levels", value):
+            assert stbt.match("button.png", frame)
+    for value in ["0", "-1", "automatic"]:
+        with scoped_config("match", "pyramid_levels", value):
+            with pytest.raises(stbt.ConfigurationError):
+                stbt.match("button.png", frame)
+
+
+@requires_opencv_3
+@pytest.mark.parametrize("image,match_method", [
+    ("button.png", stbt.MatchMethod.SQDIFF),
+    ("button.png", stbt.MatchMethod.CCOEFF_NORMED),
+    ("button-transparent.png", stbt.MatchMethod.SQDIFF),
+    ("videotestsrc-ball.png", stbt.MatchMethod.SQDIFF),
+])
+def test_that_opencl_finds_the_same_matches(image, match_method, monkeypatch):
+    # This uses `cv2.UMat` even if there isn't an OpenCL device, in which case
+    # OpenCV runs the same code as for numpy arrays. Install an OpenCL runtime
+    # like POCL to test OpenCV's OpenCL implementation.
+    import _stbt.cv2_compat
+    import _stbt.match
+    frame = stbt.load_image("buttons.png")
+    expected = list(stbt.match_all(image, frame, mp(match_method)))
+
+    # So that we don't use the cached template pyramid:
+    monkeypatch.setattr(_stbt.match, "_template_cache", OrderedDict())
+    monkeypatch.setattr(_stbt.cv2_compat, "_opencl", True)
+    with scoped_config("global", "opencl", "true"):
+        actual = list(stbt.match_all(image, frame, mp(match_method)))
+
+    assert [m.region for m in actual] == [m.region for m in expected]
+    assert [m.first_pass_result for m in actual] == pytest.approx(
+        [m.first_pass_result for m in expected], abs=1e-4)
+
+
+def test_that_opencl_falls_back_to_numpy_if_it_isnt_available(monkeypatch):
+    import _stbt.cv2_compat
+    monkeypatch.setattr(_stbt.cv2_compat, "_opencl", False)
+    with scoped_config("global", "opencl", "true"):
+        assert not _stbt.cv2_compat.use_opencl()
+        assert stbt.match("button.png", stbt.load_image("buttons.png"))
+
+
 @requires_opencv_3
 def test_png_with_16_bits_per_channel():
     assert cv2.imread(_find_file("uint16.png"), cv2.IMREAD_UNCHANGED).dtype == \
@@ -472,6 +967,83 @@ def test_png_with_16_bits_per_channel():
         frame=cv2.imread(_find_file("uint8.png")))
 
 
+def test_that_wait_for_match_reuses_result_for_unchanged_frames(monkeypatch):
+    import _stbt.match
+
+    calls = []
+    orig_match = _stbt.match.Matcher._match  # pylint:disable=protected-access
+
+    def match(self, frame, *args, **kwargs):
+        calls.append(frame.time)
+        return orig_match(self, frame, *args, **kwargs)
+
+    frame = stbt.load_image("buttons.png")
+    expected_region = stbt.match("button.png", frame=frame).region
+    monkeypatch.setattr(_stbt.match.Matcher, "_match", match)
+
+    changed_outside = frame.copy()
+    changed_outside[0, 0] = 255 - changed_outside[0, 0]
+    changed_inside = frame.copy()
+    changed_inside[50, 50] = 255 - changed_inside[50, 50]
+
+    def frames():
+        for t in range(5):
+            yield stbt.Frame(frame, time=t)
+        yield stbt.Frame(frame.copy(), time=5)
+        yield stbt.Frame(changed_outside, time=6)
+        yield stbt.Frame(changed_outside, time=7)
+        yield stbt.Frame(changed_inside, time=8)
+
+    with pytest.raises(stbt.MatchTimeout) as excinfo:
+        stbt.wait_for_match("videotestsrc-ball.png", frames=frames(),
+                            region=stbt.Region(0, 1, 100, 100))
+    assert calls == [0, 8]
+    assert excinfo.value.screenshot.time == 8
+
+    del calls[:]
+    m = stbt.wait_for_match("button.png", frames=frames(),
+                            consecutive_matches=3)
+    assert calls == [0]
+    assert m.time == 2
+    assert m.region == expected_region
+
+
+def test_that_wait_for_match_handles_frames_that_reuse_the_same_buffer():
+    buttons = stbt.load_image("buttons.png")
+    buf = numpy.zeros_like(buttons)
+
+    def frames():
+        yield stbt.Frame(buf, time=0)
+        buf[...] = buttons
+        yield stbt.Frame(buf, time=1)
+
+    m = stbt.wait_for_match("button.png", frames=frames())
+    assert m.time == 1
+
+
+def test_that_match_hint_finds_the_match_nearest_the_hint():
+    from _stbt.match import _match
+
+    frame = stbt.load_image("buttons.png")
+    matches = list(stbt.match_all("button.png", frame=frame))
+    assert len(matches) == 6
+    for m in matches:
+        hinted = _match("button.png", frame, None, stbt.Region.ALL,
+                        hint=m.region.dilate(32))
+        assert hinted.match
+        assert hinted.region == m.region
+
+    # Falls back to searching the whole region if there's no match near the
+    # hint, or if the hint is outside the region:
+    expected = stbt.match("button.png", frame=frame)
+    assert _match("button.png", frame, None, stbt.Region.ALL,
+                  hint=stbt.Region(0, 200, 20, 20)).region == expected.region
+    region = stbt.Region(10, 10, right=frame.shape[1], bottom=frame.shape[0])
+    assert _match("button.png", frame, None, region,
+                  hint=matches[0].region).region == \
+        stbt.match("button.png", frame=frame, region=region).region
+
+
 @requires_opencv_3
 def test_match_fast_path():
     # This is just an example of typical use
@@ -480,6 +1052,7 @@ def test_match_fast_path():
 
 
 @requires_opencv_3
+@xfail_on_opencv_4
 def test_that_match_fast_path_is_equivalent():
     black_reference = black(10, 10)
     almost_black_reference = black(10, 10, value=1)
@@ -520,6 +1093,105 @@ def test_that_match_fast_path_is_equivalent():
             assert orig_m.image == fast_m.image
 
 
+@pytest.mark.parametrize("reference,color_channels", [
+    ("button.png", 3),
+    ("button-transparent.png", 3),
+    ("button.png", 1),
+])
+def test_that_match_uses_sqdiff_fast_path_for_region_the_size_of_reference(
+        reference, color_channels, monkeypatch):
+    import _stbt.match
+    import _stbt.sqdiff
+
+    frame = stbt.load_image("buttons.png", color_channels=color_channels)
+    reference = stbt.load_image(
+        reference,
+        color_channels=(3, 4) if color_channels == 3 else color_channels)
+    # The FFT engine's transparency semantics are the same as the fast
+    # path's, whatever the version of OpenCV (see `MatchEngine`):
+    expected = stbt.match(
+        reference, frame=frame,
+        match_parameters=mp(match_engine=stbt.MatchEngine.FFT))
+    assert expected
+
+    calls = []
+
+    def sqdiff(*args, **kwargs):
+        calls.append(args)
+        return _stbt.sqdiff.sqdiff(*args, **kwargs)
+
+    def sqdiff_numpy(*_args):
+        assert False, "Missed C fast-path"
+
+    monkeypatch.setattr(_stbt.match, "sqdiff", sqdiff)
+    monkeypatch.setattr(_stbt.sqdiff, "_sqdiff_numpy", sqdiff_numpy)
+
+    for region in [expected.region, expected.region.translate(x=5, y=5)]:
+        result = stbt.match(reference, frame=frame, region=region)
+        assert result.match == (region == expected.region)
+        assert result.region == region
+    assert len(calls) == 2
+
+
+def test_that_match_doesnt_copy_the_frame():
+    tracemalloc = pytest.importorskip("tracemalloc")
+
+    frame = stbt.load_image("buttons.png")
+    frame = stbt.Frame(cv2.resize(frame, (1280, 720)), time=1)
+    reference = frame[100:200, 200:400].copy()
+    region = stbt.Region(200, 100, width=200, height=100)
+
+    for args in [(reference, frame, None, region),
+                 (frame.copy(), frame, None, stbt.Region.ALL)]:
+        assert stbt.match(*args)  # Warm up: allocate scratch buffers, etc.
+        tracemalloc.start()
+        try:
+            assert stbt.match(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # This would be frame.nbytes if we copied the frame; most of what we
+        # do allocate is for the grayscale version of the reference image.
+        assert peak < frame.nbytes * 0.7
+
+
+@pytest.mark.parametrize("transparent", [False, True])
+def test_that_match_fast_path_early_exit_gives_the_same_result(transparent):
+    from _stbt.match import _match
+
+    reference = stbt.load_image("videotestsrc-full-frame.png",
+                                color_channels=3)
+    if transparent:
+        alpha = numpy.full(reference.shape[:2] + (1,), 255, dtype=numpy.uint8)
+        alpha[100:200, 100:200] = 0
+        reference = numpy.concatenate([reference, alpha], axis=2)
+
+    frame = stbt.load_image("videotestsrc-full-frame.png", color_channels=3)
+    changed = frame.copy()
+    changed[:, :50] = 255 - changed[:, :50]
+    frames = [frame, changed, numpy.ascontiguousarray(frame[:, ::-1]),
+              black(frame.shape[1], frame.shape[0])]
+
+    early_exits = 0
+    for frame in frames:
+        for threshold in (0.8, 0.95, 0.999):
+            params = stbt.MatchParameters(match_method=stbt.MatchMethod.SQDIFF,
+                                      match_threshold=threshold)
+            exact = _match(reference, frame, params, stbt.Region.ALL)
+            fast = _match(reference, frame, params, stbt.Region.ALL,
+                          early_exit=True)
+            assert exact.match == fast.match
+            if exact.first_pass_result >= threshold:
+                assert exact.first_pass_result == fast.first_pass_result
+            else:
+                # `sqdiff` may have given up early
+                assert (exact.first_pass_result <= fast.first_pass_result <
+                        threshold)
+                early_exits += (
+                    fast.first_pass_result != exact.first_pass_result)
+    assert early_exits
+
+
 def test_merge_regions():
     regions = [stbt.Region(*x) for x in [
         (153, 156, 16, 4), (121, 155, 25, 5), (14, 117, 131, 32),
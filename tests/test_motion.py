@@ -3,6 +3,7 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+import itertools
 import time
 from contextlib import contextmanager
 
@@ -10,6 +11,7 @@ import numpy
 import pytest
 
 import stbt_core as stbt
+from tests.test_core import scoped_config
 
 
 def test_motionresult_repr():
@@ -84,6 +86,29 @@ def test_detect_motion_region_and_mask():
         dm(region=r, mask="mask-out-left-half-720p.png")
 
 
+def test_that_motiondiff_gives_the_same_result_with_opencl(monkeypatch):
+    # This uses `cv2.UMat` even if there isn't an OpenCL device; see
+    # `test_that_opencl_finds_the_same_matches` in test_match.py.
+    import _stbt.cv2_compat
+
+    def diffs(**kwargs):
+        frames = wipe()
+        differ = stbt.MotionDiff(next(frames), **kwargs)
+        return [(r.motion, r.region) for r in
+                (differ.diff(f) for f in itertools.islice(frames, 20))]
+
+    mask = numpy.zeros((720, 1280), dtype=numpy.uint8)
+    mask[:, 640:] = 255
+    expected = [diffs(), diffs(mask=mask), diffs(erode=False)]
+
+    monkeypatch.setattr(_stbt.cv2_compat, "_opencl", True)
+    with scoped_config("global", "opencl", "true"):
+        actual = [diffs(), diffs(mask=mask), diffs(erode=False)]
+
+    assert actual == expected
+    assert any(motion for motion, _ in expected[0])
+
+
 def fake_frames():
     a = numpy.zeros((2, 2, 3), dtype=numpy.uint8)
     a.flags.writeable = False
@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
 
+import functools
 import os
 import re
 import timeit
@@ -14,23 +15,30 @@ from distutils.version import LooseVersion
 from textwrap import dedent
 from unittest import SkipTest
 
+import cv2
+import numpy
 import pytest
 
 import _stbt.config
+import _stbt.ocr
 import stbt_core as stbt
 from _stbt import imgproc_cache
 from _stbt.imgutils import load_image
+from _stbt.logging import ImageLogger
 from _stbt.ocr import _tesseract_version
 from _stbt.utils import named_temporary_directory
 
 
 def requires_tesseract(func):
     """Decorator for tests that require Tesseract to be installed."""
-    try:
-        _tesseract_version()
-    except:
-        raise SkipTest("tesseract isn't installed")
-    return func
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        try:
+            _tesseract_version()
+        except:
+            raise SkipTest("tesseract isn't installed")
+        return func(*args, **kwargs)
+    return inner
 
 
 @requires_tesseract
@@ -392,6 +400,57 @@ def test_ocr_text_color_threshold():
         assert stbt.ocr(f, text_color=c) == "Guide"
 
 
+@pytest.mark.parametrize("threshold", [-1, -0.5, 0, 1, 3.5, 25, 254, 255])
+@pytest.mark.parametrize("upsample", [True, False])
+@pytest.mark.parametrize("image,color,region", [
+    ("ocr/blue-search-white-guide.png", (220, 220, 220), stbt.Region.ALL),
+    ("ocr/blue-search-white-guide.png", (220, 220, 220),
+     stbt.Region(x=10, y=5, width=50, height=20)),
+    (numpy.random.RandomState(0).randint(0, 256, (16, 16, 3))
+     .astype(numpy.uint8), (3, 128, 250), stbt.Region.ALL),
+])
+def test_text_color_preprocessing(image, color, region, threshold, upsample):
+    # This doesn't need Tesseract.
+    # pylint:disable=protected-access
+    f = load_image(image)
+    imglog = ImageLogger("ocr")
+
+    # The straightforward (but slower) implementation:
+    expected = stbt.crop(f, region)
+    if upsample:
+        expected = cv2.resize(
+            expected, (expected.shape[1] * 3, expected.shape[0] * 3),
+            interpolation=cv2.INTER_LINEAR)
+    diff = numpy.subtract(expected, color, dtype=numpy.int32)
+    expected = numpy.sqrt((diff[:, :, 0] ** 2 +
+                           diff[:, :, 1] ** 2 +
+                           diff[:, :, 2] ** 2) // 3).astype(numpy.uint8)
+    _, expected = cv2.threshold(expected, threshold, 255, cv2.THRESH_BINARY)
+
+    actual, needs_upsample = _stbt.ocr._preprocess(
+        f, region, upsample, color, threshold, imglog)
+    assert not needs_upsample
+    assert numpy.array_equal(actual, expected)
+
+    # Cached:
+    assert _stbt.ocr._preprocess(
+        f, region, upsample, color, threshold, imglog)[0] is actual
+
+
+def test_text_color_preprocessing_with_numpy_color():
+    # This doesn't need Tesseract.
+    # pylint:disable=protected-access
+    f = load_image("ocr/blue-search-white-guide.png")
+    imglog = ImageLogger("ocr")
+    expected = _stbt.ocr._text_color_mask(f, True, (220, 220, 220), 25,
+                                          imglog)
+    # For example a pixel from a frame:
+    color = numpy.array([220, 220, 220], dtype=numpy.uint8)
+    for c in [color, tuple(color)]:
+        actual = _stbt.ocr._text_color_mask(f, True, c, 25, imglog)
+        assert numpy.array_equal(actual, expected)
+
+
 @requires_tesseract
 def test_that_ocr_engine_has_an_effect():
     if _tesseract_version() < LooseVersion("4.0"):
@@ -409,6 +468,109 @@ def test_that_ocr_engine_has_an_effect():
         assert "sillyness" in stbt.ocr(f)
 
 
+def requires_libtesseract(func):
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        # pylint:disable=protected-access
+        if not _stbt.ocr._use_libtesseract(stbt.OcrMode.SINGLE_LINE,
+                                           _tesseract_version()):
+            raise SkipTest("libtesseract isn't installed")
+        return func(*args, **kwargs)
+    return inner
+
+
+@requires_tesseract
+@requires_libtesseract
+def test_that_in_process_tesseract_gives_the_same_results():
+    f = load_image("ocr/menu.png")
+    unicode_frame = load_image("ocr/unicode.png")
+
+    def results():
+        return [
+            stbt.ocr(f),
+            stbt.ocr(f, mode=stbt.OcrMode.SINGLE_LINE,
+                     region=stbt.Region(x=0, y=0, width=300, height=100)),
+            stbt.ocr(f, engine=stbt.OcrEngine.LSTM),
+            stbt.ocr(f, text_color=(255, 255, 255)),
+            stbt.ocr(f, tesseract_config={"tessedit_create_hocr": 1,
+                                          "tessedit_create_txt": 0}),
+            stbt.ocr(f, char_whitelist="0123456789"),
+            stbt.ocr(f, tesseract_user_words=["sillyness"],
+                     upsample=False),
+            stbt.ocr(unicode_frame, lang="eng+deu"),
+            stbt.match_text("Onion Bhaji", f),
+            stbt.match_text("Bhaji", f, region=stbt.Region(0, 0, 640, 360)),
+        ]
+
+    with temporary_config({"ocr.in_process": "false"}):
+        expected = results()
+    # Twice, to check that re-using the Tesseract instances doesn't change
+    # the results:
+    assert [str(x) for x in results()] == [str(x) for x in expected]
+    assert [str(x) for x in results()] == [str(x) for x in expected]
+
+
+@requires_tesseract
+def test_that_tessdata_dir_is_reused(monkeypatch):
+    # pylint:disable=protected-access
+    f = load_image("ocr/menu.png")
+    monkeypatch.setattr(_stbt.ocr, "_tessdata_cache",
+                        _stbt.ocr.OrderedDict())
+    monkeypatch.setattr(imgproc_cache, "_cache", None)
+
+    with temporary_config({"ocr.in_process": "false"}):
+        text = stbt.ocr(f, tesseract_user_words=["sillyness"])
+        assert len(_stbt.ocr._tessdata_cache) == 1
+        tessdata = list(_stbt.ocr._tessdata_cache.values())[0]
+        assert stbt.ocr(f, tesseract_user_words=["sillyness"]) == text
+        assert list(_stbt.ocr._tessdata_cache.values()) == [tessdata]
+        assert os.path.isdir(tessdata.path)
+
+        stbt.ocr(f, tesseract_user_words=["onion"])
+        assert len(_stbt.ocr._tessdata_cache) == 2
+
+    _stbt.ocr._clear_tessdata_cache()
+    assert not os.path.exists(tessdata.path)
+
+
+@requires_tesseract
+@pytest.mark.parametrize("workers", [1, 4])
+def test_ocr_async(workers):
+    f = load_image("ocr/menu.png")
+    regions = [stbt.Region(x=0, y=y, width=640, height=120)
+               for y in range(0, 720, 120)]
+    with temporary_config({"ocr.workers": workers}):
+        futures = [stbt.ocr_async(f, r) for r in regions]
+        assert [x.result() for x in futures] == [
+            stbt.ocr(f, r) for r in regions]
+        assert all(x.done() for x in futures)
+
+        # Errors are raised when you get the result...
+        future = stbt.ocr_async(f, lang="idontexist")
+        with pytest.raises(Exception):
+            future.result()
+        # ...except for invalid regions, which are checked immediately:
+        with pytest.raises(ValueError):
+            stbt.ocr_async(f, stbt.Region(x=1280, y=0, width=10, height=10))
+
+
+@requires_tesseract
+@pytest.mark.parametrize("workers", [1, 4])
+def test_ocr_many(workers):
+    f = load_image("ocr/menu.png")
+    grid = stbt.Grid(stbt.Region(x=0, y=0, width=640, height=720),
+                     cols=1, rows=6)
+    regions = [cell.region for cell in grid]
+    with temporary_config({"ocr.workers": workers}):
+        assert stbt.ocr_many(regions, f) == [stbt.ocr(f, r) for r in regions]
+        assert stbt.ocr_many(iter(regions), f, mode=stbt.OcrMode.SINGLE_LINE) \
+            == [stbt.ocr(f, r, mode=stbt.OcrMode.SINGLE_LINE)
+                for r in regions]
+        assert stbt.ocr_many([], f) == []
+        with pytest.raises((TypeError, ValueError)):
+            stbt.ocr_many(regions + [None], f)
+
+
 @requires_tesseract
 def test_that_cache_speeds_up_ocr():
     with named_temporary_directory() as tmpdir, \
@@ -182,3 +182,23 @@ def test_that_strictdiff_ignores_a_few_scattered_small_differences():
     differ = StrictDiff(initial_frame=stbt.load_image("2px-different-1.png"),
                         region=stbt.Region.ALL, mask=None)
     assert not differ.diff(stbt.load_image("2px-different-2.png"))
+
+
+@pytest.mark.parametrize("differ", [StrictDiff, stbt.MotionDiff])
+def test_that_diff_doesnt_allocate_frame_sized_images(differ):
+    tracemalloc = pytest.importorskip("tracemalloc")
+
+    frames = [stbt.Frame(F("ball", t), time=t)
+              for t in [0, 0.1, 0.2, 0.2, 0.3, 0.4]]
+    d = differ(frames[0])
+    assert d.diff(frames[1])  # The first call may allocate buffers
+
+    tracemalloc.start()
+    try:
+        assert [bool(d.diff(f)) for f in frames[2:]] == [
+            True, False, True, True]
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # A single-channel copy of the frame would be 1/3 of this:
+    assert peak < frames[0].nbytes / 10